@@ -21,8 +21,12 @@ setup(name='squirrel',
             'matplotlib>=3.3.1',
             'mako',
             'seaborn',
-            'pandas'
+            'pandas',
+            'numpy'
         ],
+      extras_require={
+            'parquet': ['pyarrow']
+        },
       description='Some QUIck Reconstruction to Resolve Evolutionary Links',
       url='https://github.com/cov-lineages/squirrel',
       author='Aine OToole',
@@ -7,6 +7,9 @@ from squirrel.utils.initialising import *
 import squirrel.utils.io_parsing as io
 import squirrel.utils.cns_qc as qc
 import squirrel.utils.reconstruction_functions as recon
+import squirrel.utils.annotate as annotation
+from squirrel.utils.branch_snp_index import BranchSNPIndex
+from squirrel.utils.reconstruction_result import ReconstructionResult,get_reconstruction_result_file
 from squirrel.utils.make_report import *
 
 import squirrel.utils.misc as misc
@@ -22,10 +25,47 @@ thisdir = os.path.abspath(os.path.dirname(__file__))
 cwd = os.getcwd()
 
 
+def annotate(sysargs):
+    parser = argparse.ArgumentParser(prog = f"{_program} annotate",
+    description='squirrel annotate: gene, codon, amino acid and APOBEC3 context annotation of SNPs against the reference genome',
+    usage='''squirrel annotate <variants> [options]''')
+
+    parser.add_argument('input', help='VCF (or .vcf.gz), csv/tsv with `site`, `ref` and `alt` columns, or nextclade csv/tsv with a `substitutions` column.')
+    parser.add_argument('-o','--outfile', action="store",help="Output csv. Default: <input>.annotated.csv")
+    parser.add_argument("--clade",action="store",help="Clade whose reference genome and gene boundaries to annotate against. Default: `cladeii`")
+    parser.add_argument("--reference",action="store",help="Annotate against this reference fasta instead of the clade reference.")
+    parser.add_argument("--gene-boundaries",action="store",help="Annotate with this gene boundaries csv instead of the clade one.")
+
+    args = parser.parse_args(sysargs)
+
+    config = setup_config_dict(cwd)
+    if args.clade:
+        config[KEY_CLADE] = args.clade
+    get_datafiles(config)
+    if args.reference:
+        config[KEY_REFERENCE_FASTA] = os.path.join(cwd,args.reference)
+    if args.gene_boundaries:
+        config[KEY_GENE_BOUNDARIES] = os.path.join(cwd,args.gene_boundaries)
+
+    variant_file = os.path.join(cwd,args.input)
+    if args.outfile:
+        outfile = os.path.join(cwd,args.outfile)
+    else:
+        stem = os.path.basename(variant_file).split(".")[0]
+        outfile = os.path.join(os.path.dirname(variant_file),f"{stem}.annotated.csv")
+
+    annotation.run_annotate(variant_file,outfile,config)
+
+
 def main(sysargs = sys.argv[1:]):
+    if sysargs and sysargs[0] == "annotate":
+        annotate(sysargs[1:])
+        sys.exit(0)
+
     parser = argparse.ArgumentParser(prog = _program,
     description='squirrel: Some QUIck Rearranging to Resolve Evolutionary Links',
-    usage='''squirrel <input> [options]''')
+    usage='''squirrel <input> [options]
+       squirrel annotate <variants> [options]''')
 
     io_group = parser.add_argument_group('Input-Output options')
     io_group.add_argument('input', nargs="*", help='Input fasta file of sequences to analyse.')
@@ -33,6 +73,7 @@ def main(sysargs = sys.argv[1:]):
     io_group.add_argument('--outfile', action="store",help="Optional output file name. Default: <input>.aln.fasta")
     io_group.add_argument('--tempdir',action="store",help="Specify where you want the temp stuff to go. Default: $TMPDIR")
     io_group.add_argument("--no-temp",action="store_true",help="Output all intermediate files, for dev purposes.")
+    io_group.add_argument("--parquet",action="store_true",help="Also write the reconstruction and QC tables as typed Parquet files, sorted by site. Requires pyarrow.")
 
     a_group = parser.add_argument_group("Alignment options")
     a_group.add_argument("-qc","--seq-qc",action="store_true",help="Flag potentially problematic SNPs and sequences. Default: don't run QC")
@@ -46,13 +87,29 @@ def main(sysargs = sys.argv[1:]):
     a_group.add_argument("--concatenate",action="store_true",help="Concatenate coding sequences for each genome, separated by `NNN`. Default: write out as separate records")
     a_group.add_argument("--clade",action="store",help="Specify whether the alignment is primarily for `cladei` or `cladeii` (can also specify a or b, e.g. `cladeia`, `cladeiib`). This will determine reference used for alignment, mask file and background set used if `--include-background` flag used in conjunction with the `--run-phylo` option. Default: `cladeii`")
     
+    qc_group = parser.add_argument_group("QC options")
+    qc_group.add_argument("--max-n-content",action="store",type=float,help="Flag sequences with a higher proportion of N than this for exclusion. Default: 0.2")
+    qc_group.add_argument("--max-gap-content",action="store",type=float,help="Flag sequences with a higher proportion of gaps than this for exclusion. Default: not applied")
+    qc_group.add_argument("--max-ambiguities",action="store",type=int,help="Flag sequences with more IUPAC ambiguity codes (other than N) than this for exclusion. Default: not applied")
+    qc_group.add_argument("--max-n-run",action="store",type=int,help="Flag sequences with a longer run of N than this for exclusion. Default: not applied")
+    qc_group.add_argument("--min-length",action="store",type=int,help="Flag sequences shorter than this for exclusion. Default: not applied")
+    qc_group.add_argument("--qc-out-of-core",action="store_true",help="Run alignment QC on column blocks streamed from disk across `--threads` workers, for alignments too large to hold in memory.")
+    qc_group.add_argument("--auto-exclude",action="store_true",help="Drop the sequences flagged in `suggested_to_exclude.csv` and mask the sites flagged by alignment QC in the built alignment, then carry on to phylogenetics in the same run. Requires `-qc`.")
+    qc_group.add_argument("--qc-max-memory",action="store",type=float,help="Approximate memory ceiling (GB) for `--qc-out-of-core`. Default: 4")
+
     p_group = parser.add_argument_group("Phylo options")
     p_group.add_argument("-p","--run-phylo",action="store_true",help="Run phylogenetics pipeline")
     p_group.add_argument("-a","--run-apobec3-phylo",action="store_true",help="Run phylogenetics & APOBEC3-mutation reconstruction pipeline")
+    p_group.add_argument("--asr-engine",action="store",help="Ancestral state reconstruction for `-a`. Options: iqtree (marginal reconstruction with `iqtree -asr`), parsimony (fitch parsimony in squirrel on the IQ-TREE tree, no state file). Default: iqtree")
+    p_group.add_argument("--compress-site-patterns",action="store_true",help="Give IQ-TREE each distinct sequence once and only the columns that are not constant, with the constant columns as `-fconst` counts. Identical sequences are added back to the tree at zero length and the state file is mapped back to genome sites.")
     p_group.add_argument("--outgroups",action="store",help="Specify which MPXV outgroup(s) in the alignment to use in the phylogeny. These will get pruned out from the final tree.")
     p_group.add_argument("-bg","--include-background",action="store_true",help="Include a default background set of sequences for the phylogenetics pipeline. The set will be determined by the `--clade` specified.")
     p_group.add_argument("-bf","--background-file",action="store",help="Include this additional FASTA file as background to the phylogenetics.")
     p_group.add_argument("-bm","--binary-partition-mask",action="store_true",help="Calculate and write binary partition mask")
+    p_group.add_argument("--root-to-tip",action="store_true",help="Count all, APOBEC3 and non-APOBEC3 SNPs from the root to each tip and fit a root-to-tip regression against date. Requires `-a`. Dates are read from the last `|` field of the tip names unless `--metadata` is given")
+    p_group.add_argument("--metadata",action="store",help="Csv with a date for each sequence, for `--root-to-tip`. Dates can be yyyy-mm-dd, yyyy-mm or yyyy")
+    p_group.add_argument("--metadata-id-column",action="store",help="Column in `--metadata` with the sequence names. Default: name")
+    p_group.add_argument("--metadata-date-column",action="store",help="Column in `--metadata` with the dates. Default: date")
     p_group.add_argument("--bm-separate-dimers",action="store_true",help="Write partition mask with 0 for non-apo, 1 for GA and 2 for TC target sites")
 
     pf_group = parser.add_argument_group("Tree figure options")
@@ -66,6 +123,7 @@ def main(sysargs = sys.argv[1:]):
 
     m_group = parser.add_argument_group('Misc options')
     m_group.add_argument("-v","--version", action='version', version=f"squirrel {__version__}")
+    m_group.add_argument("--cache-dir",action="store",help="Directory for cached intermediate files reused across runs (e.g. aligned assembly references). Default: $XDG_CACHE_HOME/squirrel or ~/.cache/squirrel")
     m_group.add_argument("--verbose",action="store_true",help="Print lots of stuff to screen")
     m_group.add_argument("-t","--threads",action="store",default=1,type=int, help="Number of threads")
 
@@ -86,12 +144,14 @@ def main(sysargs = sys.argv[1:]):
     get_datafiles(config)
     io.set_up_threads(args.threads,config)
     config[KEY_OUTDIR] = io.set_up_outdir(args.outdir,cwd,config[KEY_OUTDIR])
+    io.set_up_cache_dir(args.cache_dir,cwd,config)
+    io.parquet_options(args.parquet,config)
 
     io.parse_tf_options(args.tree_figure_only,args.tree_file,args.branch_reconstruction_file,args.fig_width,args.fig_height,args.point_style,args.point_justify,cwd,config)
     if args.tree_figure_only:
         new_tree = f"{config[KEY_TREE]}.rerender"
         outfile = os.path.join(config[KEY_OUTDIR],"")
-        recon.make_reconstruction_tree_figure_w_labels(new_tree,config[KEY_BRANCH_RECONSTRUCTION],config[KEY_TREE],config[KEY_POINT_STYLE],config[KEY_POINT_JUSTIFY],config[KEY_FIG_WIDTH],config[KEY_FIG_HEIGHT])
+        recon.make_reconstruction_tree_figure_w_labels(new_tree,BranchSNPIndex.from_csv(config[KEY_BRANCH_RECONSTRUCTION]),config[KEY_TREE],config[KEY_POINT_STYLE],config[KEY_POINT_JUSTIFY],config[KEY_FIG_WIDTH],config[KEY_FIG_HEIGHT])
         print(green("Success! New tree figure written."))
         sys.exit(0)
     
@@ -108,17 +168,22 @@ def main(sysargs = sys.argv[1:]):
     if args.exclude:
         config[KEY_INPUT_FASTA] = io.find_exclude_file(cwd,config[KEY_INPUT_FASTA],args.exclude,config)
 
+    io.auto_exclude_options(args.auto_exclude,args.seq_qc,config)
+    io.qc_out_of_core_options(args.qc_out_of_core,args.qc_max_memory,args.seq_qc,config)
     if args.seq_qc:
         print(green("QC mode activated. Squirrel will flag:"))
-        print("- Clumps of unique SNPs\n- SNPs adjacent to Ns\n- Sequences with high N content")
+        print("- Clumps of unique SNPs\n- SNPs adjacent to Ns\n- Sequences with high N content (or breaching other QC thresholds)")
         config[KEY_SEQ_QC] = True
+        io.qc_options(args.max_n_content,args.max_gap_content,args.max_ambiguities,args.max_n_run,args.min_length,config)
         exclude_file = os.path.join(config[KEY_OUTDIR],"suggested_to_exclude.csv")
-        qc.check_flag_N_content(config[KEY_INPUT_FASTA],exclude_file,config)
+        stats_file = os.path.join(config[KEY_OUTDIR],f"{config[KEY_OUTFILE_STEM]}.sequence_qc.csv")
+        qc.check_sequence_qc(config[KEY_INPUT_FASTA],exclude_file,stats_file,config)
     
     assembly_refs = []
     if args.seq_qc and args.run_apobec3_phylo:
         print("- Reversions to reference\n- Convergent mutations")
-        assembly_refs = qc.find_assembly_refs(cwd,args.assembly_refs,config)
+        assembly_refs_file = qc.find_assembly_refs(cwd,args.assembly_refs,config)
+        assembly_refs = qc.get_aligned_assembly_refs(assembly_refs_file,get_snakefile(thisdir,"msa"),args.verbose,config)
         # args.run_phylo = True
 
     # config[KEY_FIG_HEIGHT] = recon.get_fig_height(config[KEY_INPUT_FASTA])
@@ -126,6 +191,9 @@ def main(sysargs = sys.argv[1:]):
     
 
     config[KEY_INPUT_FASTA] = io.phylo_options(args.run_phylo,args.run_apobec3_phylo,args.outgroups,args.include_background,args.binary_partition_mask,config[KEY_INPUT_FASTA],config)
+    io.asr_engine_options(args.asr_engine,args.run_apobec3_phylo,config)
+    io.compress_site_patterns_options(args.compress_site_patterns,config)
+    io.root_to_tip_options(args.root_to_tip,args.metadata,args.metadata_id_column,args.metadata_date_column,args.run_apobec3_phylo,cwd,config)
 
     snakefile = get_snakefile(thisdir,"msa")
 
@@ -134,6 +202,9 @@ def main(sysargs = sys.argv[1:]):
 
     if status:
 
+        if config[KEY_AUTO_EXCLUDE]:
+            qc.auto_exclude_from_alignment(exclude_file,config)
+
         if config[KEY_RUN_PHYLO]:
             phylo_snakefile = get_snakefile(thisdir,"phylo")
             config[KEY_PHYLOGENY] = f"{config[KEY_OUTFILE_STEM]}.tree"
@@ -151,9 +222,15 @@ def main(sysargs = sys.argv[1:]):
                 if config[KEY_RUN_APOBEC3_PHYLO]:
                     if args.binary_partition_mask:
                         outfile = os.path.join(config[KEY_OUTDIR],f"{config[KEY_OUTFILE_STEM]}.binary_partition_mask.csv")
-                        branch_reconstruction = os.path.join(config[KEY_OUTDIR],f"{config[KEY_OUTFILE_STEM]}.tree.branch_snps.reconstruction.csv")
-                        recon.find_binary_partition_mask(branch_reconstruction,args.bm_separate_dimers,config[KEY_REFERENCE_FASTA],outfile)
+                        treefile = os.path.join(config[KEY_OUTDIR],config[KEY_PHYLOGENY])
+                        result = ReconstructionResult.load(get_reconstruction_result_file(treefile))
+                        recon.find_binary_partition_mask(result.branch_snp_index,args.bm_separate_dimers,config[KEY_REFERENCE_FASTA],outfile)
                         print(green(f"Binary partition mask string written to: "),outfile)
+                    if config[KEY_ROOT_TO_TIP]:
+                        treefile = os.path.join(config[KEY_OUTDIR],config[KEY_PHYLOGENY])
+                        root_to_tip_counts,regression_out = recon.run_root_to_tip(treefile,config)
+                        print(green(f"Root-to-tip counts written to: "),root_to_tip_counts)
+                        print(green(f"Root-to-tip regression written to: "),regression_out)
                     print(green("Ancestral reconstruction & phylogenetics complete."))
                 else:
                     print(green("Phylogenetics complete."))
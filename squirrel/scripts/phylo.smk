@@ -4,17 +4,40 @@ from Bio import SeqIO
 from Bio.Seq import Seq
 import csv
 from squirrel.utils.log_colours import green,cyan
+import squirrel.utils.newick as newick
+import squirrel.utils.site_patterns as site_patterns
 
 rule all:
     input:
         os.path.join(config[KEY_OUTDIR],config[KEY_PHYLOGENY])
 
+if config[KEY_COMPRESS_SITE_PATTERNS]:
+    # iqtree gets each distinct sequence once and only the columns that are not
+    # constant, the constant columns are given as -fconst counts
+    rule compress_site_patterns:
+        input:
+            aln = config[KEY_OUTFILE]
+        params:
+            outgroups = config[KEY_OUTGROUPS]
+        output:
+            aln = os.path.join(config[KEY_TEMPDIR],f"site_patterns.fasta"),
+            fconst = os.path.join(config[KEY_TEMPDIR],f"site_patterns.fconst")
+        run:
+            site_patterns.compress_alignment(input.aln,output.aln,output.fconst,params.outgroups)
+
+    IQTREE_ALIGNMENT = rules.compress_site_patterns.output.aln
+    IQTREE_FCONST = f"-fconst $(cat '{rules.compress_site_patterns.output.fconst}')"
+else:
+    IQTREE_ALIGNMENT = config[KEY_OUTFILE]
+    IQTREE_FCONST = ""
+
 rule iqtree:
     input:
-        aln = config[KEY_OUTFILE]
+        aln = IQTREE_ALIGNMENT
     params:
         outgroup = config[KEY_OUTGROUP_STRING],
-        threads = config[KEY_PHYLO_THREADS]
+        threads = config[KEY_PHYLO_THREADS],
+        fconst = IQTREE_FCONST
     output:
         temp_aln = os.path.join(config[KEY_TEMPDIR],f"iqtree.fasta"),
         tree = os.path.join(config[KEY_TEMPDIR],f"iqtree.fasta.treefile")
@@ -27,26 +50,33 @@ rule iqtree:
                 -nt {params.threads} \
                 -blmin  0.0000000001 \
                 -redo \
+                {params.fconst} \
                 -o '{params.outgroup}' 
         """
 
+if config[KEY_COMPRESS_SITE_PATTERNS]:
+    # identical sequences go back into the tree as zero-length siblings
+    rule expand_site_patterns:
+        input:
+            tree = rules.iqtree.output.tree,
+            aln = config[KEY_OUTFILE]
+        params:
+            outgroups = config[KEY_OUTGROUPS]
+        output:
+            tree = os.path.join(config[KEY_TEMPDIR],f"site_patterns.treefile")
+        run:
+            site_patterns.expand_tree(input.tree,input.aln,output.tree,params.outgroups)
+
+    TREE = rules.expand_site_patterns.output.tree
+else:
+    TREE = rules.iqtree.output.tree
+
 rule prune_outgroup:
     input:
-        tree = rules.iqtree.output.tree
+        tree = TREE
     params:
-        treefile = f"iqtree.fasta.treefile",
-        temp_outtree = "iqtree.pruned.tree",
-        outdir = config[KEY_OUTDIR],
-        tempdir = config[KEY_TEMPDIR],
-        outtree = config[KEY_PHYLOGENY],
-        outgroup = config[KEY_OUTGROUP_SENTENCE]
+        outgroups = config[KEY_OUTGROUPS]
     output:
         tree = os.path.join(config[KEY_OUTDIR],config[KEY_PHYLOGENY])
-    shell:
-        """
-        cd  {params.tempdir:q} &&
-        jclusterfunk prune  -i "{params.treefile}" \
-                            -o "{params.temp_outtree}" \
-                            -t '{params.outgroup}' &&
-        cp {params.temp_outtree:q} {output.tree:q}
-        """
+    run:
+        newick.write_pruned_tree(input.tree,output.tree,params.outgroups)
@@ -5,6 +5,8 @@ from Bio.Seq import Seq
 import csv
 from squirrel.utils.log_colours import green,cyan
 import squirrel.utils.reconstruction_functions as recon
+import squirrel.utils.newick as newick
+import squirrel.utils.site_patterns as site_patterns
 
 rule all:
     input:
@@ -12,61 +14,155 @@ rule all:
         os.path.join(config[KEY_OUTDIR],config[KEY_PHYLOGENY_SVG])
 
 
-rule iqtree:
-    input:
-        aln = config[KEY_OUTFILE]
-    params:
-        outgroup = config[KEY_OUTGROUP_STRING],
-        threads = config[KEY_PHYLO_THREADS]
-    output:
-        temp_aln = os.path.join(config[KEY_TEMPDIR],f"iqtree.fasta"),
-        tree = os.path.join(config[KEY_TEMPDIR],f"iqtree.fasta.treefile"),
-        state_file = os.path.join(config[KEY_OUTDIR],f"{config[KEY_PHYLOGENY]}.state")
-    shell:
-        """
-        cp {input.aln:q} {output.temp_aln:q} && 
-        iqtree  -s {output.temp_aln:q} \
-                -m HKY \
-                -czb \
-                -nt {params.threads} \
-                -blmin  0.0000000001 \
-                -redo \
-                -asr \
-                -o '{params.outgroup}' &&
-        cp '{output.temp_aln}.state' {output.state_file:q}
-        """
+if config[KEY_COMPRESS_SITE_PATTERNS]:
+    # iqtree gets each distinct sequence once and only the columns that are not
+    # constant, the constant columns are given as -fconst counts
+    rule compress_site_patterns:
+        input:
+            aln = config[KEY_OUTFILE]
+        params:
+            outgroups = config[KEY_OUTGROUPS]
+        output:
+            aln = os.path.join(config[KEY_TEMPDIR],f"site_patterns.fasta"),
+            fconst = os.path.join(config[KEY_TEMPDIR],f"site_patterns.fconst")
+        run:
+            site_patterns.compress_alignment(input.aln,output.aln,output.fconst,params.outgroups)
+
+    IQTREE_ALIGNMENT = rules.compress_site_patterns.output.aln
+    IQTREE_FCONST = f"-fconst $(cat '{rules.compress_site_patterns.output.fconst}')"
+    IQTREE_STATE_FILE = os.path.join(config[KEY_TEMPDIR],f"site_patterns.state")
+else:
+    IQTREE_ALIGNMENT = config[KEY_OUTFILE]
+    IQTREE_FCONST = ""
+    IQTREE_STATE_FILE = os.path.join(config[KEY_OUTDIR],f"{config[KEY_PHYLOGENY]}.state")
+
+if config[KEY_ASR_ENGINE] == "parsimony":
+    # ancestral states come from parsimony in squirrel, so iqtree only builds the
+    # tree and the internal nodes are labelled NodeN as iqtree -asr would
+    rule iqtree:
+        input:
+            aln = IQTREE_ALIGNMENT
+        params:
+            outgroup = config[KEY_OUTGROUP_STRING],
+            threads = config[KEY_PHYLO_THREADS],
+            fconst = IQTREE_FCONST
+        output:
+            temp_aln = os.path.join(config[KEY_TEMPDIR],f"iqtree.fasta"),
+            tree = os.path.join(config[KEY_TEMPDIR],f"iqtree.fasta.treefile")
+        shell:
+            """
+            cp {input.aln:q} {output.temp_aln:q} && 
+            iqtree  -s {output.temp_aln:q} \
+                    -m HKY \
+                    -czb \
+                    -nt {params.threads} \
+                    -blmin  0.0000000001 \
+                    -redo \
+                    {params.fconst} \
+                    -o '{params.outgroup}'
+            """
+
+    IQTREE_TREE = rules.iqtree.output.tree
+else:
+    rule iqtree:
+        input:
+            aln = IQTREE_ALIGNMENT
+        params:
+            outgroup = config[KEY_OUTGROUP_STRING],
+            threads = config[KEY_PHYLO_THREADS],
+            fconst = IQTREE_FCONST
+        output:
+            temp_aln = os.path.join(config[KEY_TEMPDIR],f"iqtree.fasta"),
+            tree = os.path.join(config[KEY_TEMPDIR],f"iqtree.fasta.treefile"),
+            state_file = IQTREE_STATE_FILE
+        shell:
+            """
+            cp {input.aln:q} {output.temp_aln:q} && 
+            iqtree  -s {output.temp_aln:q} \
+                    -m HKY \
+                    -czb \
+                    -nt {params.threads} \
+                    -blmin  0.0000000001 \
+                    -redo \
+                    -asr \
+                    {params.fconst} \
+                    -o '{params.outgroup}' &&
+            cp '{output.temp_aln}.state' {output.state_file:q}
+            """
+
+    IQTREE_TREE = rules.iqtree.output.tree
+
+if config[KEY_COMPRESS_SITE_PATTERNS]:
+    # identical sequences go back into the tree as zero-length siblings and the
+    # states back onto genome sites
+    rule expand_site_patterns:
+        input:
+            tree = IQTREE_TREE,
+            aln = config[KEY_OUTFILE]
+        params:
+            outgroups = config[KEY_OUTGROUPS]
+        output:
+            tree = os.path.join(config[KEY_TEMPDIR],f"site_patterns.treefile")
+        run:
+            site_patterns.expand_tree(input.tree,input.aln,output.tree,params.outgroups)
+
+    TREE = rules.expand_site_patterns.output.tree
+else:
+    TREE = IQTREE_TREE
+
+if config[KEY_ASR_ENGINE] == "parsimony":
+    rule label_nodes:
+        input:
+            tree = TREE
+        output:
+            tree = os.path.join(config[KEY_TEMPDIR],f"iqtree.labelled.treefile")
+        run:
+            newick.write_labelled_tree(input.tree,output.tree)
+
+    ASR_TREE = rules.label_nodes.output.tree
+    STATE_FILES = []
+elif config[KEY_COMPRESS_SITE_PATTERNS]:
+    rule expand_state_file:
+        input:
+            state_file = rules.iqtree.output.state_file,
+            tree = TREE,
+            aln = config[KEY_OUTFILE]
+        params:
+            outgroups = config[KEY_OUTGROUPS]
+        output:
+            state_file = os.path.join(config[KEY_OUTDIR],f"{config[KEY_PHYLOGENY]}.state")
+        run:
+            site_patterns.expand_state_file(input.state_file,input.tree,input.aln,output.state_file,params.outgroups)
+
+    ASR_TREE = TREE
+    STATE_FILES = [rules.expand_state_file.output.state_file]
+else:
+    ASR_TREE = TREE
+    STATE_FILES = [rules.iqtree.output.state_file]
 
 rule prune_outgroup:
     input:
-        tree = rules.iqtree.output.tree
+        tree = ASR_TREE
     params:
-        treefile = f"iqtree.fasta.treefile",
-        temp_outtree = "iqtree.pruned.tree",
-        outdir = config[KEY_OUTDIR],
-        tempdir = config[KEY_TEMPDIR],
-        outtree = config[KEY_PHYLOGENY],
-        outgroup = config[KEY_OUTGROUP_SENTENCE]
+        outgroups = config[KEY_OUTGROUPS]
     output:
         tree = os.path.join(config[KEY_OUTDIR],config[KEY_PHYLOGENY])
-    shell:
-        """
-        cd  {params.tempdir:q} &&
-        jclusterfunk prune  -i "{params.treefile}" \
-                            -o "{params.temp_outtree}" \
-                            -t '{params.outgroup}' &&
-        cp {params.temp_outtree:q} {output.tree:q}
-        """
+    run:
+        newick.write_pruned_tree(input.tree,output.tree,params.outgroups)
 
 
 rule reconstruction_analysis:
     input:
         tree = rules.prune_outgroup.output.tree,
-        state_file = rules.iqtree.output.state_file,
+        asr_tree = ASR_TREE,
+        state_files = STATE_FILES,
         alignment = config[KEY_OUTFILE]
     params:
-        outdir = config[KEY_OUTDIR]
+        outdir = config[KEY_OUTDIR],
+        threads = config[KEY_THREADS]
     output:
-        tree = os.path.join(config[KEY_OUTDIR],config[KEY_PHYLOGENY_SVG])
+        tree = os.path.join(config[KEY_OUTDIR],config[KEY_PHYLOGENY_SVG]),
+        result = os.path.join(config[KEY_OUTDIR],f"{config[KEY_PHYLOGENY]}.reconstruction.npz")
     run:
         directory = params.outdir
         point_style = config[KEY_POINT_STYLE]
@@ -74,4 +170,7 @@ rule reconstruction_analysis:
         # width= config[KEY_FIG_HEIGHT]
         # height = recon.get_fig_height(input.alignment)
 
-        recon.run_full_analysis(directory, input.alignment, input.tree,input.state_file,config,point_style,point_justify,config[KEY_FIG_WIDTH],config[KEY_FIG_HEIGHT])
+        # no state file with --asr-engine parsimony, the states are reconstructed on the unpruned tree
+        state_file = input.state_files[0] if input.state_files else None
+
+        recon.run_full_analysis(directory, input.alignment, input.tree,state_file,config,point_style,point_justify,config[KEY_FIG_WIDTH],config[KEY_FIG_HEIGHT],input.asr_tree,params.threads)
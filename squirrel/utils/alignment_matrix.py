@@ -0,0 +1,94 @@
+#!/usr/bin/env python3
+import sys
+import numpy as np
+from Bio import SeqIO
+
+from squirrel.utils.log_colours import green,cyan
+
+# ascii codes, so an alignment can be held as an N x L uint8 matrix
+BASES = np.frombuffer(b"ATGC",dtype=np.uint8)
+N_BYTE = ord("N")
+GAP_BYTE = ord("-")
+
+
+def load_alignment_matrix(alignment):
+    """
+    reads a fasta alignment into an N x L uint8 matrix of ascii codes
+    returns the record ids (in file order) and the matrix
+    """
+    ids = []
+    rows = []
+    for record in SeqIO.parse(alignment,"fasta"):
+        ids.append(record.id)
+        rows.append(np.frombuffer(str(record.seq).encode(),dtype=np.uint8))
+
+    if not rows:
+        sys.stderr.write(cyan(f'Error: no sequences found in alignment: ') + f'{alignment}\n')
+        sys.exit(-1)
+    if len(set(len(row) for row in rows)) > 1:
+        sys.stderr.write(cyan(f'Error: sequences in alignment are not all the same length: ') + f'{alignment}\n')
+        sys.exit(-1)
+
+    return ids,np.vstack(rows)
+
+
+def window_contains(aln,cols,value,before,after,first_col=0):
+    """
+    for each row and each of the given columns, flags whether
+    aln[row, col-before:col+after+1] contains value
+
+    first_col is the alignment position of the first column in aln,
+    windows that would start before the first alignment column are empty,
+    matching python slicing with a negative start
+    """
+    hit = np.zeros((aln.shape[0],len(cols)),dtype=bool)
+    for offset in range(-before,after+1):
+        idx = cols + offset
+        valid = (idx >= 0) & (idx < aln.shape[1])
+        hit[:,valid] |= aln[:,idx[valid]] == value
+    hit[:,cols+first_col < before] = False
+    return hit
+
+
+def write_alignment_memmap(alignment,outfile):
+    """
+    streams a fasta alignment into a row-major uint8 file on disk one record
+    at a time, so it can be read back in column blocks with np.memmap
+    returns the record ids and the (N, L) shape of the matrix
+    """
+    ids = []
+    aln_len = None
+    with open(outfile,"wb") as fw:
+        for record in SeqIO.parse(alignment,"fasta"):
+            seq = str(record.seq).encode()
+            if aln_len is None:
+                aln_len = len(seq)
+            elif len(seq) != aln_len:
+                sys.stderr.write(cyan(f'Error: sequences in alignment are not all the same length: ') + f'{alignment}\n')
+                sys.exit(-1)
+            ids.append(record.id)
+            fw.write(seq)
+
+    if not ids:
+        sys.stderr.write(cyan(f'Error: no sequences found in alignment: ') + f'{alignment}\n')
+        sys.exit(-1)
+
+    return ids,(len(ids),aln_len)
+
+
+def read_column_block(matrix_file,shape,start,end):
+    aln = np.memmap(matrix_file,dtype=np.uint8,mode="r",shape=shape)
+    return np.array(aln[:,start:end])
+
+
+def get_column_blocks(aln_len,block_width,overlap):
+    """
+    splits the alignment columns into blocks of block_width, each padded
+    with overlap columns either side so windows work at the block edges
+    returns (read_start, read_end, core_start, core_end) per block
+    """
+    blocks = []
+    for start in range(0,aln_len,block_width):
+        end = min(start+block_width,aln_len)
+        blocks.append((max(0,start-overlap),min(aln_len,end+overlap),start,end))
+    return blocks
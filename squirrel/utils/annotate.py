@@ -0,0 +1,103 @@
+#!/usr/bin/env python3
+import os
+import re
+import sys
+import gzip
+import pandas as pd
+
+from squirrel.utils.log_colours import green,cyan
+from squirrel.utils.config import *
+from squirrel.utils.gene_model import GeneModel
+
+SUBSTITUTION_PATTERN = r"([ACGTN])(\d+)([ACGTN])"
+
+
+def read_vcf(variant_file):
+    """
+    reads the snps from a vcf (or vcf.gz), multi-allelic ALT fields are split
+    into one row per allele and anything that is not a single base change is skipped
+    """
+    opener = gzip.open if variant_file.endswith(".gz") else open
+    with opener(variant_file,"rt") as f:
+        header = None
+        for l in f:
+            if l.startswith("#CHROM"):
+                header = l.lstrip("#").rstrip("\n").split("\t")
+                break
+        if header is None:
+            sys.stderr.write(cyan(f'Error: no #CHROM header line found in vcf: ') + f'{variant_file}\n')
+            sys.exit(-1)
+        variants = pd.read_csv(f,sep="\t",names=header,usecols=["CHROM","POS","REF","ALT"],
+                               dtype={"CHROM":str,"POS":"int64","REF":str,"ALT":str},na_filter=False)
+
+    variants["ALT"] = variants["ALT"].str.split(",")
+    variants = variants.explode("ALT",ignore_index=True)
+    return variants.rename(columns={"POS":"site","REF":"ref","ALT":"alt"})
+
+def read_substitutions(variants):
+    """
+    expands a nextclade style `substitutions` column (e.g. C3037T,G8393A) into
+    one row per snp, keeping the sequence name
+    """
+    id_column = "seqName" if "seqName" in variants.columns else variants.columns[0]
+    substitutions = variants[[id_column,"substitutions"]].copy()
+    substitutions["substitutions"] = substitutions["substitutions"].fillna("").str.split(",")
+    substitutions = substitutions.explode("substitutions",ignore_index=True)
+
+    parsed = substitutions["substitutions"].str.fullmatch(SUBSTITUTION_PATTERN)
+    substitutions = substitutions[parsed.fillna(False).astype(bool)]
+    parts = substitutions["substitutions"].str.extract(SUBSTITUTION_PATTERN)
+    return pd.DataFrame({id_column:substitutions[id_column].to_numpy(),
+                         "site":parts[1].astype("int64").to_numpy(),
+                         "ref":parts[0].to_numpy(),
+                         "alt":parts[2].to_numpy()})
+
+def read_variants(variant_file):
+    """
+    reads snps to annotate from a vcf, a csv/tsv with `site`, `ref` and `alt`
+    columns (1-based sites, any other columns are kept), or a nextclade csv/tsv
+    with a `substitutions` column
+    """
+    if not os.path.exists(variant_file):
+        sys.stderr.write(cyan(f'Error: cannot find variant file at: ') + f'{variant_file}\n')
+        sys.exit(-1)
+
+    if re.search(r"\.vcf(\.gz)?$",variant_file):
+        variants = read_vcf(variant_file)
+    else:
+        sep = "\t" if re.search(r"\.(tsv|txt)(\.gz)?$",variant_file) else ","
+        variants = pd.read_csv(variant_file,sep=sep,dtype=str,keep_default_na=False)
+        if "substitutions" in variants.columns:
+            variants = read_substitutions(variants)
+        elif all(col in variants.columns for col in ["site","ref","alt"]):
+            variants["site"] = pd.to_numeric(variants["site"],errors="coerce")
+            variants = variants[variants["site"].notna()].astype({"site":"int64"})
+        else:
+            sys.stderr.write(cyan(f'Error: variant file needs `site`, `ref` and `alt` columns or a nextclade `substitutions` column: ') + f'{variant_file}\n')
+            sys.exit(-1)
+
+    snps = (variants["ref"].str.len() == 1) & (variants["alt"].str.len() == 1)
+    if not snps.all():
+        print(cyan(f"Note: skipping {int((~snps).sum())} variants that are not single base substitutions."))
+    return variants[snps].reset_index(drop=True)
+
+def annotate_variants(variants,gene_model):
+    """
+    annotates a dataframe of variants (site, ref, alt) with the gene model,
+    the input columns are kept in front of the annotation
+    """
+    annotation = gene_model.annotate(variants["site"].to_numpy(),variants["ref"].to_numpy(),variants["alt"].to_numpy())
+    mismatches = int((~annotation["ref_match"]).sum())
+    if mismatches:
+        print(cyan(f"Note: {mismatches} variants have a ref base that does not match the reference genome."))
+
+    annotation = annotation.drop(columns=["site","ref","alt"])
+    annotated = variants.iloc[annotation["variant"].to_numpy()].reset_index(drop=True)
+    return pd.concat([annotated,annotation.drop(columns=["variant"]).reset_index(drop=True)],axis=1)
+
+def run_annotate(variant_file,outfile,config):
+    gene_model = GeneModel.from_files(config[KEY_GENE_BOUNDARIES],config[KEY_GRANTHAM_SCORES],config[KEY_REFERENCE_FASTA])
+    variants = read_variants(variant_file)
+    annotated = annotate_variants(variants,gene_model)
+    annotated.to_csv(outfile,index=False,na_rep="NA")
+    print(green(f"Annotated {len(variants)} variants:") + f" {outfile}")
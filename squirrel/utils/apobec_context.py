@@ -0,0 +1,66 @@
+#!/usr/bin/env python3
+import numpy as np
+
+# apobec3 target codes: the G of a GA dimer and the C of a TC dimer
+NOT_TARGET = 0
+GA_TARGET = 1
+TC_TARGET = 2
+
+APOBEC3_DIMERS = {"GA":GA_TARGET,"TC":TC_TARGET}
+
+
+def target_codes(bases,next_bases,prev_bases):
+    """
+    apobec3 target code for every position of arrays of ascii codes (any shape),
+    given the bases either side: GA_TARGET for a G followed by an A, TC_TARGET
+    for a C preceded by a T and NOT_TARGET otherwise
+    """
+    return np.where((bases == ord("G")) & (next_bases == ord("A")),GA_TARGET,
+                    np.where((bases == ord("C")) & (prev_bases == ord("T")),TC_TARGET,NOT_TARGET)).astype(np.uint8)
+
+def reference_targets(reference_seq):
+    """
+    target codes for every position of a reference held as a uint8 array
+    """
+    reference_seq = np.asarray(reference_seq,dtype=np.uint8)
+    next_bases = np.r_[reference_seq[1:],np.uint8(0)]
+    prev_bases = np.r_[np.uint8(0),reference_seq[:-1]]
+    return target_codes(reference_seq,next_bases,prev_bases)
+
+def node_context(node_states,sites,rows=None):
+    """
+    the states of every node and tip (or just the given rows) either side of
+    each site (0 where the neighbouring site is not in the state file) and their
+    target code at every site, all as row x site arrays
+    returns next states, previous states and target codes
+    """
+    sites = np.asarray(sites,dtype=np.int64)
+    if rows is None:
+        rows = np.arange(len(node_states.names))
+    rows = np.asarray(rows,dtype=np.int64)[:,None]
+    neighbours = []
+    for offset in [1,-1]:
+        cols = node_states.cols(sites+offset)
+        context = node_states.matrix[rows,np.maximum(cols,0)]
+        context[:,cols == -1] = 0
+        neighbours.append(context)
+    next_states,prev_states = neighbours
+    states = node_states.matrix[rows,np.maximum(node_states.cols(sites),0)]
+    return next_states,prev_states,target_codes(states,next_states,prev_states)
+
+def snp_contexts(parent_bases,child_bases,parent_targets):
+    """
+    apobec3 context of snps from the parent (or reference) base, the child (or
+    alt) base and the parent's target code at the site: GA_TARGET for G->A at a
+    GA target, TC_TARGET for C->T at a TC target and NOT_TARGET otherwise
+    """
+    g_to_a = (parent_bases == ord("G")) & (child_bases == ord("A")) & (parent_targets == GA_TARGET)
+    c_to_t = (parent_bases == ord("C")) & (child_bases == ord("T")) & (parent_targets == TC_TARGET)
+    return np.where(g_to_a,GA_TARGET,np.where(c_to_t,TC_TARGET,NOT_TARGET)).astype(np.uint8)
+
+def dimer_contexts(dimer_names):
+    """
+    apobec3 context of each dimer string of the branch snps (only G->A snps
+    are given GA dimers and only C->T snps TC dimers)
+    """
+    return np.array([APOBEC3_DIMERS.get(dimer,NOT_TARGET) for dimer in dimer_names],dtype=np.uint8)
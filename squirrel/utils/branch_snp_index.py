@@ -0,0 +1,240 @@
+#!/usr/bin/env python3
+import csv
+import numpy as np
+
+from squirrel.utils.apobec_context import dimer_contexts
+from squirrel.utils.tree_arrays import load_tree
+
+
+def first_appearance_codes(keys):
+    """
+    integer codes for keys, numbered in the order each key first appears
+    returns the per-row codes and the unique keys in that order
+    """
+    unique_keys,first,inverse = np.unique(keys,return_index=True,return_inverse=True)
+    order = np.argsort(first)
+    rank = np.empty(len(order),dtype=np.int64)
+    rank[order] = np.arange(len(order))
+    return rank[inverse.reshape(-1)],unique_keys[order]
+
+def group_rows(codes,n_codes):
+    """
+    row indexes sorted by code (keeping file order within a code) and
+    offsets so rows[offsets[i]:offsets[i+1]] are the rows for code i
+    """
+    rows = np.argsort(codes,kind="stable")
+    offsets = np.searchsorted(codes[rows],np.arange(n_codes+1))
+    return rows,offsets
+
+
+class BranchSNPIndex:
+    """
+    Compact, read-only index of the branch snps from an ancestral reconstruction.
+
+    Rows are held as parallel numpy arrays in file order, with node, snp and dimer
+    strings dictionary-encoded. Branch, site and snp lookups are slices of
+    precomputed sort orders, so the branch snp csv only needs to be read once
+    and every consumer (reversions, convergence, homoplasies, amino acids and
+    the tree figures) queries the same index.
+
+    Each row also carries its apobec3 context code (see apobec_context), taken
+    from the reconstruction's target arrays or, for a csv, from the dimers, so
+    apobec3 classification is an array lookup.
+    """
+
+    def __init__(self,node_names,parent_idx,child_idx,sites,snp_names,snp_idx,dimer_names,dimer_idx,apobec=None):
+        self.node_names = list(node_names)
+        self.node_index = {name:i for i,name in enumerate(self.node_names)}
+        self.snp_names = list(snp_names)
+        self.dimer_names = list(dimer_names)
+
+        self.parent_idx = np.asarray(parent_idx,dtype=np.int32)
+        self.child_idx = np.asarray(child_idx,dtype=np.int32)
+        self.sites = np.asarray(sites,dtype=np.int32)
+        self.snp_idx = np.asarray(snp_idx,dtype=np.int16)
+        self.dimer_idx = np.asarray(dimer_idx,dtype=np.int16)
+        if apobec is None:
+            apobec = dimer_contexts(self.dimer_names)[self.dimer_idx] if self.dimer_names else np.zeros(len(self.sites))
+        self.apobec = np.asarray(apobec,dtype=np.uint8)
+
+        n_nodes = max(len(self.node_names),1)
+
+        # branches numbered in the order they first appear in the file
+        branch_keys = self.parent_idx.astype(np.int64)*n_nodes + self.child_idx
+        self.branch_idx,branch_keys = first_appearance_codes(branch_keys)
+        self.branch_names = [f"{self.node_names[k//n_nodes]}_{self.node_names[k%n_nodes]}" for k in branch_keys]
+        self.branch_lookup = {name:i for i,name in enumerate(self.branch_names)}
+        self.branch_rows,self.branch_offsets = group_rows(self.branch_idx,len(self.branch_names))
+
+        # sites in the order they first appear
+        self.site_idx,self.site_values = first_appearance_codes(self.sites)
+        self.site_lookup = {int(site):i for i,site in enumerate(self.site_values)}
+        self.site_rows,self.site_offsets = group_rows(self.site_idx,len(self.site_values))
+
+        # distinct (site, snp, dimer) mutations, to find the same snp on several branches
+        snp_keys = (self.site_idx*len(self.snp_names) + self.snp_idx)*len(self.dimer_names) + self.dimer_idx
+        self.mutation_idx,mutation_keys = first_appearance_codes(snp_keys)
+        self.mutation_rows,self.mutation_offsets = group_rows(self.mutation_idx,len(mutation_keys))
+
+        self.node_parent = None
+
+    @classmethod
+    def from_csv(cls,branch_snps,treefile=None):
+        node_index = {}
+        snp_index = {}
+        dimer_index = {}
+        parent_idx = []
+        child_idx = []
+        sites = []
+        snp_idx = []
+        dimer_idx = []
+        with open(branch_snps,"r") as f:
+            reader = csv.DictReader(f)
+            for row in reader:
+                parent_idx.append(node_index.setdefault(row['parent'],len(node_index)))
+                child_idx.append(node_index.setdefault(row['child'],len(node_index)))
+                sites.append(int(row['site']))
+                snp_idx.append(snp_index.setdefault(row['snp'],len(snp_index)))
+                dimer_idx.append(dimer_index.setdefault(row['dimer'],len(dimer_index)))
+
+        index = cls(node_index,parent_idx,child_idx,sites,snp_index,snp_idx,dimer_index,dimer_idx)
+        if treefile:
+            index.add_tree(treefile)
+        return index
+
+    def write_csv(self,outfile):
+        """
+        writes the rows back out as a branch snp csv, in the order they were added
+        """
+        node_names = np.array(self.node_names,dtype=object)
+        snp_names = np.array(self.snp_names,dtype=object)
+        dimer_names = np.array(self.dimer_names,dtype=object)
+        with open(outfile,"w") as fw:
+            fw.write("parent,child,site,snp,dimer\n")
+            fw.writelines(f"{parent},{child},{site},{snp},{dimer}\n" for parent,child,site,snp,dimer in
+                          zip(node_names[self.parent_idx],node_names[self.child_idx],self.sites.tolist(),
+                              snp_names[self.snp_idx],dimer_names[self.dimer_idx]))
+
+    def __contains__(self,branch):
+        return branch in self.branch_lookup
+
+    def __getitem__(self,branch):
+        return self.branch_snps(branch)
+
+    def __len__(self):
+        return len(self.sites)
+
+    def _rows(self,rows,offsets,i):
+        return rows[offsets[i]:offsets[i+1]]
+
+    def _snp_tuple(self,row):
+        return (str(self.sites[row]),self.snp_names[self.snp_idx[row]],self.dimer_names[self.dimer_idx[row]])
+
+    def branches(self):
+        return list(self.branch_names)
+
+    def branch_snps(self,branch):
+        """
+        (site, snp, dimer) tuples for a branch named parent_child, in file order
+        """
+        if branch not in self.branch_lookup:
+            return []
+        rows = self._rows(self.branch_rows,self.branch_offsets,self.branch_lookup[branch])
+        return [self._snp_tuple(row) for row in rows]
+
+    def site_list(self):
+        """
+        every site with a snp, in the order they first appear
+        """
+        return [int(site) for site in self.site_values]
+
+    def site_snps(self,site):
+        """
+        [parent, child, snp, dimer] for each branch with a snp at the site
+        """
+        if site not in self.site_lookup:
+            return []
+        rows = self._rows(self.site_rows,self.site_offsets,self.site_lookup[site])
+        return [[self.node_names[self.parent_idx[row]],
+                 self.node_names[self.child_idx[row]],
+                 self.snp_names[self.snp_idx[row]],
+                 self.dimer_names[self.dimer_idx[row]]] for row in rows]
+
+    def site_apobec(self,site):
+        """
+        whether each snp at the site (in the order of site_snps) is in an apobec3 context
+        """
+        if site not in self.site_lookup:
+            return []
+        rows = self._rows(self.site_rows,self.site_offsets,self.site_lookup[site])
+        return (self.apobec[rows] > 0).tolist()
+
+    def branch_apobec(self,branch):
+        """
+        whether each snp on the branch (in the order of branch_snps) is in an apobec3 context
+        """
+        if branch not in self.branch_lookup:
+            return []
+        rows = self._rows(self.branch_rows,self.branch_offsets,self.branch_lookup[branch])
+        return (self.apobec[rows] > 0).tolist()
+
+    def site_branches(self,site):
+        if site not in self.site_lookup:
+            return []
+        rows = self._rows(self.site_rows,self.site_offsets,self.site_lookup[site])
+        return [self.branch_names[self.branch_idx[row]] for row in rows]
+
+    def homoplasies(self):
+        """
+        sites with a snp on more than one branch and how many times they occur
+        """
+        counts = np.diff(self.site_offsets)
+        return {int(self.site_values[i]):int(counts[i]) for i in np.flatnonzero(counts > 1)}
+
+    def convergent_snps(self):
+        """
+        the same (site, snp, dimer) occurring on more than one branch
+        returns ((site, snp, dimer), [branches]) in order of first appearance
+        """
+        convergent = []
+        for i in np.flatnonzero(np.diff(self.mutation_offsets) > 1):
+            rows = self._rows(self.mutation_rows,self.mutation_offsets,i)
+            branches = list(dict.fromkeys(self.branch_names[self.branch_idx[row]] for row in rows))
+            if len(branches) > 1:
+                convergent.append((self._snp_tuple(rows[0]),branches))
+        return convergent
+
+    def add_tree(self,treefile):
+        """
+        records every node's parent from the tree, including branches without
+        snps, so paths from the root to any tip can be looked up
+        """
+        tree = load_tree(treefile)
+        parents = {name:(tree.names[p] if p != -1 else None) for name,p in zip(tree.names,tree.parent.tolist())}
+
+        for node in parents:
+            if node not in self.node_index:
+                self.node_index[node] = len(self.node_names)
+                self.node_names.append(node)
+        self.node_parent = np.full(len(self.node_names),-1,dtype=np.int32)
+        for node,parent in parents.items():
+            if parent is not None:
+                if parent not in self.node_index:
+                    self.node_index[parent] = len(self.node_names)
+                    self.node_names.append(parent)
+                    self.node_parent = np.append(self.node_parent,np.int32(-1))
+                self.node_parent[self.node_index[node]] = self.node_index[parent]
+
+    def path_to_root(self,tip):
+        """
+        branches (parent_child) on the path from the root down to the tip
+        """
+        if self.node_parent is None:
+            raise ValueError("BranchSNPIndex needs a tree (add_tree) for path lookups")
+        path = []
+        node = self.node_index[tip]
+        while self.node_parent[node] != -1:
+            parent = self.node_parent[node]
+            path.append(f"{self.node_names[parent]}_{self.node_names[node]}")
+            node = parent
+        return path[::-1]
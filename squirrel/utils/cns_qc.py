@@ -8,8 +8,18 @@ from Bio import AlignIO
 from Bio.Align.AlignInfo import SummaryInfo
 import collections
 import csv
+import pickle
+import hashlib
 from squirrel.utils.config import *
+import squirrel.utils.misc as misc
+import squirrel.utils.columnar as columnar
+from squirrel.utils.reconstruction_result import ReconstructionResult,get_reconstruction_result_file,ROOT_NODE
+from squirrel.utils.node_states import NodeStates,load_state_file
+from squirrel.utils.tree_arrays import load_tree
+from squirrel.utils.alignment_matrix import load_alignment_matrix,window_contains,write_alignment_memmap,read_column_block,get_column_blocks,BASES,N_BYTE,GAP_BYTE
 import math
+import numpy as np
+import multiprocessing as mp
 import baltic as bt
 import matplotlib as mpl
 import matplotlib.pyplot as plt
@@ -27,230 +37,294 @@ new_rc_params = {'text.usetex': False,
 mpl.rcParams.update(new_rc_params)
 plt.rcParams['font.family'] = 'Helvetica'
 
+# rough peak memory per alignment cell (uint8 block plus masks and count indexes)
+QC_BYTES_PER_CELL = 24
+
+# qc cache entries kept for each kind of result, older ones are removed
+QC_CACHE_ENTRIES = 4
+
+# IUPAC ambiguity codes, excluding N which is counted separately
+AMBIGUITY_CODES = "RYSWKMBDHVryswkmbdhv"
+
+
+def get_qc_cache_file(name,paths,config,*extra):
+    """
+    qc results are cached in <outfile_stem>.qc_cache next to the alignment,
+    keyed by the content of the input files, the mask config, the qc
+    thresholds and the squirrel version
+    """
+    settings = [config[key] for key in [KEY_NO_MASK,KEY_TO_MASK,KEY_ADDITIONAL_MASK,KEY_SEQUENCE_MASK,
+                                        KEY_MAX_N_CONTENT,KEY_MAX_GAP_CONTENT,KEY_MAX_AMBIGUITIES,
+                                        KEY_MAX_N_RUN,KEY_MIN_LENGTH]]
+    qc_hash = misc.hash_files(paths,*settings,config["version"],*extra)
+    cache_dir = os.path.join(config[KEY_OUTDIR],f"{config[KEY_OUTFILE_STEM]}.qc_cache")
+    return os.path.join(cache_dir,f"{name}.{qc_hash}.pkl")
+
+def load_qc_cache(cache_file):
+    if not os.path.exists(cache_file):
+        return None
+    with open(cache_file,"rb") as f:
+        result = pickle.load(f)
+    print(green("Reusing cached QC results:"),cache_file)
+    return result
+
+def write_qc_cache(cache_file,result):
+    """
+    writes the result and keeps only the QC_CACHE_ENTRIES most recent entries
+    of the same kind (name), so the cache does not grow with every changed input
+    """
+    cache_dir = os.path.dirname(cache_file)
+    try:
+        os.makedirs(cache_dir,exist_ok=True)
+        with open(cache_file,"wb") as fw:
+            pickle.dump(result,fw)
+
+        name = os.path.basename(cache_file).split(".")[0]
+        entries = [os.path.join(cache_dir,entry) for entry in os.listdir(cache_dir)
+                   if entry.split(".")[0] == name and entry.endswith(".pkl")]
+        entries.sort(key=os.path.getmtime,reverse=True)
+        for entry in entries[QC_CACHE_ENTRIES:]:
+            if entry != cache_file:
+                os.remove(entry)
+    except OSError:
+        print(cyan(f"Note: could not write QC cache to {cache_dir}."))
 
 def find_assembly_refs(cwd,assembly_refs,config):
-    refs = []
-    ref_ids = []
     if not assembly_refs:
         print(cyan(f'Note: no assembly references supplied.\nDefaulting to installed assembly references:'))
-        for record in SeqIO.parse(config[KEY_ASSEMBLY_REFERENCES],"fasta"):
-            refs.append(record)
-            ref_ids.append(record.id)
-        for i in ref_ids:
-            print(f"- {i}")
+        path_to_try = config[KEY_ASSEMBLY_REFERENCES]
     else:
         path_to_try = os.path.join(cwd,assembly_refs)
-        try:
-            for record in SeqIO.parse(path_to_try,"fasta"):
-                refs.append(record)
-                ref_ids.append(record.id)
-                
-        except:
+        if not os.path.exists(path_to_try):
             sys.stderr.write(cyan(f'Error: cannot find/parse reference fasta file at: ') + f'{path_to_try}\n' + cyan('Please check file path and format.\n'))
             sys.exit(-1)
-
         print(green(f'Assembly references supplied:'))
-        for i in ref_ids:
-            print(f"- {i}")
-
-    config[KEY_ASSEMBLY_REFERENCES] = ref_ids
 
-    return refs
+    return path_to_try
 
-def recurse_back(node,root_node):
-    path = [node.traits["label"]]
-    p = node.parent
-    root_name = root_node.traits["label"]
-    while p.traits["label"] != root_name:
-        path.append(p.traits["label"])
-        p = p.parent
-
-    path.append(root_name)
-    return path
-
-def get_path_to_root(treefile):
-    
+def align_assembly_refs(assembly_refs_file,snakefile,verbose,config):
     """
-    traces back from a given tip through each parent 
-    and returns a list of branches that make up the 
-    phylo path from root to tip
-
+    runs the assembly references through the same minimap2/gofasta
+    alignment as the input sequences (without masking) and returns
+    their ids and uint8 rows in alignment coordinates
     """
-    my_tree=bt.loadNexus(treefile,absoluteTime=False)
-    root_node = ""
-    for k in my_tree.Objects:
-        current_node = k
-        if not root_node:
-            root_node = k
-
-        if k.branchType == 'leaf':
-            current_node.traits["label"]=k.name
-            
-            node_name = current_node.traits["label"]
-            try:
-                parent_name = current_node.parent.traits["label"]
-            except:
-                continue
-            
-    
-    branch_paths = {}
-    
-    for k in my_tree.Objects:
-        current_node = k
-        if current_node.branchType == 'leaf':
-            path = recurse_back(current_node,root_node)
-            branch_path = []
-            for i in range(len(path)-1, 0, -1):
-                try:
-                    branch = f"{path[i]}_{path[i-1]}"
-                    branch_path.append(branch)
-                except:
-                    print("breaks",path)
-#             print(current_node.traits["label"])
-#             print(branch_path)
-            branch_paths[current_node.traits["label"]] = branch_path
-    return branch_paths
-
-
-def read_in_branch_snps(branch_snps):
-    branch_snps_dict = collections.defaultdict(list)
-    with open(branch_snps,"r") as f:
-        reader = csv.DictReader(f)
-        for row in reader:
-            branch = f"{row['parent']}_{row['child']}"
-            branch_snps_dict[branch].append((row['site'],row['snp'],row['dimer'])) 
-    return branch_snps_dict
-
-def get_seq_at_node(state_file,nodename):
-    
+    ref_tempdir = os.path.join(config[KEY_TEMPDIR],"assembly_refs")
+    if not os.path.exists(ref_tempdir):
+        os.mkdir(ref_tempdir)
+
+    ref_config = dict(config)
+    ref_config[KEY_INPUT_FASTA] = assembly_refs_file
+    ref_config[KEY_TEMPDIR] = ref_tempdir
+    ref_config[KEY_OUTDIR] = ref_tempdir
+    ref_config[KEY_OUTFILE] = os.path.join(ref_tempdir,"assembly_refs.aln.fasta")
+    ref_config[KEY_NO_MASK] = True
+    ref_config[KEY_EXTRACT_CDS] = False
+
+    status = misc.run_snakemake(ref_config,snakefile,verbose,ref_config)
+    if not status:
+        sys.stderr.write(cyan(f'Error: could not align assembly references to the reference genome.\n'))
+        sys.exit(-1)
+
+    # the alignment replaces spaces and commas in the header with underscores
+    aligned_names = {}
+    for record in SeqIO.parse(assembly_refs_file,"fasta"):
+        aligned_names[record.description.replace(" ","_").replace(",","_")] = record.id
+
+    ids,aln = load_alignment_matrix(ref_config[KEY_OUTFILE])
+    ref_ids = [aligned_names.get(i,i) for i in ids]
+    for ref in aligned_names.values():
+        if ref not in ref_ids:
+            print(cyan(f"Note: assembly reference {ref} could not be aligned and will not be checked."))
+
+    return ref_ids,aln
+
+def get_aligned_assembly_refs(assembly_refs_file,snakefile,verbose,config):
     """
-    returns a dict keys off 1-based positions in the genome
-    and the value is a list of tuples (id, base) at a given node
-    allows you to look up for a given site what the base is for a
-    given internal node or tip
+    assembly references are aligned once and cached as uint8 arrays in alignment
+    coordinates, keyed by a hash of the reference files and trim settings, so
+    later runs load them straight from the cache
     """
-    seq = ""
-    with open(f"{state_file}","r") as f:
-        for l in f:
+    ref_hash = misc.hash_files([assembly_refs_file,config[KEY_REFERENCE_FASTA]],config[KEY_TRIM_END])
+    cache_file = os.path.join(config[KEY_CACHE_DIR],f"assembly_refs.{ref_hash}.npz")
 
-            if not l.startswith("#"):
-                try:
-                    node,site,state,probA,probC,probG,probT = l.rstrip("\n").split("\t")
-                except:
-                    print(l)
-                    break
-                if node == nodename:
-                    seq+=state
+    if os.path.exists(cache_file):
+        with np.load(cache_file) as cached:
+            ref_ids = [str(i) for i in cached["ids"]]
+            aln = cached["aln"]
+    else:
+        ref_ids,aln = align_assembly_refs(assembly_refs_file,snakefile,verbose,config)
+        try:
+            os.makedirs(config[KEY_CACHE_DIR],exist_ok=True)
+            np.savez(cache_file,ids=np.array(ref_ids),aln=aln)
+        except OSError:
+            print(cyan(f"Note: could not write assembly reference cache to {config[KEY_CACHE_DIR]}."))
 
-    return seq
+    for i in ref_ids:
+        print(f"- {i}")
 
-def load_assembly_refs(assembly_refs):
+    config[KEY_ASSEMBLY_REFERENCES] = ref_ids
 
-    refs = {}
-    for record in assembly_refs:
-        refs[record.id] = record.seq
-    return refs
+    return dict(zip(ref_ids,aln))
 
+def get_seq_at_node(state_file,nodename,length=None):
+    
+    """
+    returns the reconstructed sequence at a given internal node as a string,
+    read from the cached state file arrays. position i is site i+1, with N at
+    sites the state file does not have (it may only hold some sites, as for
+    --compress-site-patterns)
+    """
+    nodes,sites,states = load_state_file(state_file)
+    return NodeStates(nodes,sites,states).sequence(nodename,length)
+
+def get_reversion_record(site_path,i,branch,refs,root_node):
+    base = int(i[0])
+    allele = i[1][-1]
+
+    reversion_to = []
+    ref_alleles = []
+    for ref in refs:
+        var = chr(refs[ref][base-1])
+        ref_alleles.append(f"{ref}:{var}")
+        if allele == var:
+            reversion_to.append(ref)
+
+    root_var = root_node[base-1]
+    if allele == root_var:
+        reversion_to.append("Root")
+
+    # first time the site mutated on the path, and the most recent branch it mutated on
+    original_snp = site_path[0][1]
+    return {
+        "site":i[0],
+        "original_snp": original_snp[1],
+        "original_branch":site_path[-1][0],
+        "reversion_branch":branch,
+        "dinucleotide_context": original_snp[2],
+        "reversion_snp": i[1],
+        "reference_alleles": ";".join(ref_alleles),
+        "root_allele":root_node[base-1],
+        "reversion_to":";".join(reversion_to)
+    }
+
+def flag_reversions(treefile, branch_snp_index,state_file, refs, node_states=None):
+    """
+    single depth-first pass over the tree. for each site, keeps a stack of the
+    (branch, snp) pairs on the current root-to-node path where it mutated, so
+    each branch is only visited once and a snp at a site already on the stack
+    is a reversion. tips then collect the reversions along their path
+    the root sequence is taken from the node states if given, otherwise from
+    the state file, indexed by genome position either way
+    """
+    # the assembly references are in alignment coordinates, so as long as any site
+    length = max([len(seq) for seq in refs.values()],default=None)
+    if node_states is not None:
+        root_node = node_states.sequence(ROOT_NODE,length)
+    else:
+        root_node = get_seq_at_node(state_file,ROOT_NODE,length)
+    tree = load_tree(treefile)
+
+    # tips in the order of the tree objects
+    tip_order = np.zeros(len(tree),dtype=np.int64)
+    tip_order[tree.tips] = np.arange(len(tree.tips))
+    root = tree.root
+
+    site_paths = collections.defaultdict(list)
+    path_reversions = []
+    n_records = []
+    tip_reversions = {}
+
+    # node: [(first tip under the branch, depth), branch, reversion records] to replay
+    # the branches in the same order as walking each tip's path in turn
+    branch_records = {}
+    first_tip = np.zeros(len(tree),dtype=np.int64)
+
+    stack = [(child,1,False) for child in reversed(tree.node_children(root).tolist())]
+    while stack:
+        node,depth,visited = stack.pop()
+        branch = tree.branch_names[node]
+        if visited:
+            # leaving the branch, pop its snps back off the site stacks
+            for i in reversed(branch_snp_index[branch]):
+                site_paths[i[0]].pop()
+            del path_reversions[len(path_reversions)-n_records.pop():]
+            if tree.is_leaf[node]:
+                first_tip[node] = tip_order[node]
+            else:
+                first_tip[node] = first_tip[tree.node_children(node)].min()
+            if node in branch_records:
+                branch_records[node][0] = (int(first_tip[node]),depth)
+            continue
+
+        records = []
+        for i in branch_snp_index[branch]:
+            if site_paths[i[0]]:
+                records.append((i,get_reversion_record(site_paths[i[0]],i,branch,refs,root_node)))
+            site_paths[i[0]].append((branch,i))
+        path_reversions.extend(j[1] for j in records)
+        n_records.append(len(records))
+        if records:
+            branch_records[node] = [None,branch,records]
+
+        stack.append((node,depth,True))
+        if tree.is_leaf[node]:
+            tip_reversions[node] = list(path_reversions)
+        else:
+            for child in reversed(tree.node_children(node).tolist()):
+                stack.append((child,depth+1,False))
 
-def flag_reversions(branch_paths, branch_snp_dict,state_file, refs):
-    root_node = get_seq_at_node(state_file,"Node1")
     possible_reversions = []
+    for tip in sorted(tip_reversions,key=lambda k: tip_order[k]):
+        for record in tip_reversions[tip]:
+            row = {"taxon":tree.names[tip]}
+            row.update(record)
+            possible_reversions.append(row)
+
     branch_reversions = collections.defaultdict(set)
-    snp_to_branch = {}
     will_be_reverted = collections.defaultdict(set)
-    for tip in branch_paths:
-        path_snps = []
-        for branch in branch_paths[tip]:
-            snps = branch_snp_dict[branch]
-            for i in snps:
-                
-                if i[0] in [j[0] for j in path_snps]:
-                    base = int(i[0])
-                    
-                    allele = i[1][-1]
-                    
-                    branch_reversions[branch].add(f"{base}{allele}")
-                    will_be_reverted[snp_to_branch[i[0]]].add(f"{base}{i[1][0]}")
-                    reversion_to = []
-                    
-                    ref_alleles = []
-                    for ref in refs:
-                        var = refs[ref][base-1]
-                        ref_alleles.append(f"{ref}:{var}")
-                        if allele == var:
-                            reversion_to.append(ref)
-                        
-                    root_var = root_node[base-1]
-                    if allele == root_var:
-                        reversion_to.append("Root")
-                    
-                    original_snp = [k for k in path_snps if k[0] == i[0]][0]
-                    
-                    possible_reversions.append({
-                        "taxon":tip,
-                        "site":i[0],
-                        "original_snp": original_snp[1],
-                        "original_branch":snp_to_branch[i[0]],
-                        "reversion_branch":branch,
-                        "dinucleotide_context": original_snp[2],
-                        "reversion_snp": i[1],
-                        "reference_alleles": ";".join(ref_alleles),
-                        "root_allele":root_node[base-1],
-                        "reversion_to":";".join(reversion_to)
-                    })
-
-                
-                snp_to_branch[i[0]] = branch
-                path_snps.append(i)
+    for order,branch,records in sorted(branch_records.values(),key=lambda x: x[0]):
+        for i,record in records:
+            branch_reversions[branch].add(f"{int(i[0])}{i[1][-1]}")
+            will_be_reverted[record["original_branch"]].add(f"{int(i[0])}{i[1][0]}")
+
+    report_reversions(branch_reversions)
+    return possible_reversions,branch_reversions,will_be_reverted
+
+def report_reversions(branch_reversions):
     if branch_reversions:
         print(green("Reversions flagged:"))
         for i in branch_reversions:
             for j in branch_reversions[i]:
                 print(f"- {j} ({i})")
-    return possible_reversions,branch_reversions,will_be_reverted
-
 
-def flag_convergence(treefile, branch_snp_dict):
-    snp_to_branch = collections.defaultdict(set)
+def find_convergence(branch_snp_index):
+    """
+    the convergent snps, in the order they are reported, and the convergent
+    snps on each branch
+    """
     branch_convergence = collections.defaultdict(set)
 
-    my_tree=bt.loadNewick(treefile,absoluteTime=False)
-
-    for k in my_tree.Objects:
-        current_node = k
-        if k.branchType == 'leaf':
-            current_node.traits["label"]=k.name
-            node_name = current_node.traits["label"]
-            
-        try:
-            parent_name = current_node.parent.traits["label"]
-            node_name = current_node.traits["label"]
-        except:
-            continue
-        
-        branch = f"{parent_name}_{node_name}"
-
-        snps = branch_snp_dict[branch]
-        for i in snps:
-            snp_to_branch[i].add(branch)
     convergent_snps= []
-    for snp in snp_to_branch:
-        if len(snp_to_branch[snp])> 1:
-            report_snp = f"{snp[1][0]}{snp[0]}{snp[1][-1]}"
-            convergent_snps.append(report_snp)
-            for branch in snp_to_branch[snp]:
-                branch_convergence[branch].add(report_snp)
-
+    for snp,branches in branch_snp_index.convergent_snps():
+        report_snp = f"{snp[1][0]}{snp[0]}{snp[1][-1]}"
+        convergent_snps.append(report_snp)
+        for branch in branches:
+            branch_convergence[branch].add(report_snp)
+    return convergent_snps,branch_convergence
+
+def report_convergence(convergent_snps):
     if convergent_snps:
         print("Convergent snps flagged:")
         for i in convergent_snps:
             print(f"- {i}")
+
+def flag_convergence(branch_snp_index):
+    convergent_snps,branch_convergence = find_convergence(branch_snp_index)
+    report_convergence(convergent_snps)
     return branch_convergence
 
 
-def make_reversion_tree_figure(outfile,branch_snps,branch_reversions,will_be_reverted,treefile,w,h):
-    
-    branch_snps_dict = read_in_branch_snps(branch_snps)
+def make_reversion_tree_figure(outfile,branch_snp_index,branch_reversions,will_be_reverted,treefile,w,h):
 
     my_tree=bt.loadNewick(treefile,absoluteTime=False)
 
@@ -292,44 +366,30 @@ def make_reversion_tree_figure(outfile,branch_snps,branch_reversions,will_be_rev
 
     my_tree.addText(ax,x_attr=text_x_attr,target=target_func,text=text_func) #
     
-    for k in my_tree.Objects:
+    # the tree arrays number nodes in the order of my_tree.Objects
+    tree = load_tree(treefile)
+    for k,branch_name in zip(my_tree.Objects,tree.branch_names):
         current_node = k
-        if k.branchType == 'leaf':
-            current_node.traits["label"]=k.name
-
-        node_name = current_node.traits["label"]
-        try:
-            parent_name = current_node.parent.traits["label"]
-        except:
+        if branch_name is None:
             continue
-        branch_name= f"{parent_name}_{node_name}"
-        
-        if branch_name in branch_snps_dict:
+
+        if branch_name in branch_snp_index:
             snps = []
             reversions = []
             tb_reversions = []
             if branch_name in branch_reversions:
                 for s in branch_reversions[branch_name]:
                     reversions.append(s)
-#                 print(branch_name, len(branch_snps_dict[branch_name]))
+#                 print(branch_name, len(branch_snp_index[branch_name]))
             if branch_name in will_be_reverted:
                 for s in will_be_reverted[branch_name]:
                     tb_reversions.append(s)
             snp_placement = current_node.parent.height + increment
             rev_placement = (current_node.parent.height + current_node.height)/2
             tb_rev_placement = (current_node.parent.height + current_node.height)/2
-            for s in branch_snps_dict[branch_name]:
-                site,snp,dimer = s
-                if snp == "G->A":
-                    if dimer in ["GA"]:
-                        snps.append((1,"#995e62"))
-                    else:
-                        snps.append((2,"#d9b660"))
-                elif snp == "C->T":
-                    if dimer in ["TC"]:
-                        snps.append((1,"#995e62"))
-                    else:
-                        snps.append((2,"#d9b660"))
+            for is_apobec in branch_snp_index.branch_apobec(branch_name):
+                if is_apobec:
+                    snps.append((1,"#995e62"))
                 else:
                     snps.append((2,"#d9b660"))
             
@@ -358,9 +418,7 @@ def make_reversion_tree_figure(outfile,branch_snps,branch_reversions,will_be_rev
                    transparent=True)
     # plt.show()
 
-def make_convergence_tree_figure(outfile,branch_snps,branch_convergence,treefile,w,h):
-    
-    branch_snps_dict = read_in_branch_snps(branch_snps)
+def make_convergence_tree_figure(outfile,branch_snp_index,branch_convergence,treefile,w,h):
 
     my_tree=bt.loadNewick(treefile,absoluteTime=False)
     r2t = 200000*my_tree.treeHeight #rough number of snps root to tip
@@ -400,40 +458,26 @@ def make_convergence_tree_figure(outfile,branch_snps,branch_convergence,treefile
 
     my_tree.addText(ax,x_attr=text_x_attr,target=target_func,text=text_func) #
     
-    for k in my_tree.Objects:
+    # the tree arrays number nodes in the order of my_tree.Objects
+    tree = load_tree(treefile)
+    for k,branch_name in zip(my_tree.Objects,tree.branch_names):
         current_node = k
-        if k.branchType == 'leaf':
-            current_node.traits["label"]=k.name
-
-        node_name = current_node.traits["label"]
-        try:
-            parent_name = current_node.parent.traits["label"]
-        except:
+        if branch_name is None:
             continue
-        branch_name= f"{parent_name}_{node_name}"
-        
-        if branch_name in branch_snps_dict:
+
+        if branch_name in branch_snp_index:
             snps = []
             convergent_snps = []
             if branch_name in branch_convergence:
                 for s in branch_convergence[branch_name]:
                     convergent_snps.append(s)
-#                 print(branch_name, len(branch_snps_dict[branch_name]))
+#                 print(branch_name, len(branch_snp_index[branch_name]))
 
             snp_placement = current_node.parent.height + increment
             c_placement = (current_node.parent.height + current_node.height)/2
-            for s in branch_snps_dict[branch_name]:
-                site,snp,dimer = s
-                if snp == "G->A":
-                    if dimer in ["GA"]:
-                        snps.append((1,"#995e62"))
-                    else:
-                        snps.append((2,"#d9b660"))
-                elif snp == "C->T":
-                    if dimer in ["TC"]:
-                        snps.append((1,"#995e62"))
-                    else:
-                        snps.append((2,"#d9b660"))
+            for is_apobec in branch_snp_index.branch_apobec(branch_name):
+                if is_apobec:
+                    snps.append((1,"#995e62"))
                 else:
                     snps.append((2,"#d9b660"))
             
@@ -457,22 +501,112 @@ def make_convergence_tree_figure(outfile,branch_snps,branch_convergence,treefile
     plt.savefig(f"{outfile}.png",bbox_inches='tight', 
                    transparent=True)
 
-def check_flag_N_content(input_fasta,exclude_file,config):
-    with open(exclude_file,"w") as fw:
+def iter_fasta_chunks(input_fasta,chunk_size=1<<24):
+    """
+    reads the raw fasta bytes and yields chunks of roughly chunk_size
+    that always start at a record header, so each can be parsed on its own
+    """
+    chunk = []
+    size = 0
+    with open(input_fasta,"rb") as f:
+        for l in f:
+            if l.startswith(b">") and size >= chunk_size:
+                yield b"".join(chunk)
+                chunk = []
+                size = 0
+            chunk.append(l)
+            size += len(l)
+    if chunk:
+        yield b"".join(chunk)
+
+def get_sequence_stats(name,seq):
+    length = len(seq)
+    counts = np.bincount(np.frombuffer(seq,dtype=np.uint8),minlength=256)
+
+    n_count = int(counts[ord("N")] + counts[ord("n")])
+    gap_count = int(counts[ord("-")])
+    ambiguity_count = int(sum(counts[ord(i)] for i in AMBIGUITY_CODES))
+
+    longest_n_run = 0
+    if n_count:
+        is_n = np.frombuffer(seq.upper(),dtype=np.uint8) == N_BYTE
+        edges = np.diff(np.concatenate(([0],is_n.view(np.int8),[0])))
+        longest_n_run = int((np.flatnonzero(edges == -1) - np.flatnonzero(edges == 1)).max())
+
+    return {
+        "name": name,
+        "length": length,
+        "n_content": round(n_count/length,3) if length else 0,
+        "gap_content": round(gap_count/length,3) if length else 0,
+        "ambiguity_count": ambiguity_count,
+        "longest_n_run": longest_n_run
+    }
+
+def get_chunk_sequence_stats(chunk):
+    chunk_stats = []
+    for record in chunk.split(b"\n>"):
+        if record.startswith(b">"):
+            record = record[1:]
+        lines = record.split(b"\n")
+        name = lines[0].rstrip().decode()
+        seq = b"".join(lines[1:]).replace(b" ",b"").replace(b"\r",b"")
+        chunk_stats.append(get_sequence_stats(name,seq))
+    return chunk_stats
+
+def flag_sequence_stats(stats,config):
+    notes = []
+    if not stats["length"]:
+        notes.append("empty sequence")
+    if stats["n_content"] > config[KEY_MAX_N_CONTENT]:
+        notes.append(f"N content is {stats['n_content']}")
+    if config[KEY_MAX_GAP_CONTENT] is not None and stats["gap_content"] > config[KEY_MAX_GAP_CONTENT]:
+        notes.append(f"gap content is {stats['gap_content']}")
+    if config[KEY_MAX_AMBIGUITIES] is not None and stats["ambiguity_count"] > config[KEY_MAX_AMBIGUITIES]:
+        notes.append(f"{stats['ambiguity_count']} ambiguous bases")
+    if config[KEY_MAX_N_RUN] is not None and stats["longest_n_run"] > config[KEY_MAX_N_RUN]:
+        notes.append(f"longest N run is {stats['longest_n_run']}")
+    if config[KEY_MIN_LENGTH] is not None and stats["length"] < config[KEY_MIN_LENGTH]:
+        notes.append(f"length is {stats['length']}")
+    return notes
+
+def get_all_sequence_stats(input_fasta,threads):
+    chunks = iter_fasta_chunks(input_fasta)
+    if threads > 1:
+        with mp.Pool(threads) as pool:
+            return [stats for records in pool.imap(get_chunk_sequence_stats,chunks) for stats in records]
+    return [stats for records in map(get_chunk_sequence_stats,chunks) for stats in records]
+
+def check_sequence_qc(input_fasta,exclude_file,stats_file,config):
+    """
+    one pass over the raw fasta bytes, chunks of records are split across
+    a process pool to get per-sequence stats. writes every sequence's stats to
+    stats_file and those breaching the qc thresholds to exclude_file
+    """
+    cache_file = get_qc_cache_file("sequence_stats",[input_fasta],config)
+    all_stats = load_qc_cache(cache_file)
+    if all_stats is None:
+        all_stats = get_all_sequence_stats(input_fasta,config[KEY_THREADS])
+        write_qc_cache(cache_file,all_stats)
+
+    c = 0
+    with open(stats_file,"w") as fstats, open(exclude_file,"w") as fw:
+        stats_writer = csv.DictWriter(fstats, fieldnames = ["name","length","n_content","gap_content","ambiguity_count","longest_n_run"],delimiter=",",lineterminator="\n")
+        stats_writer.writeheader()
         writer=csv.DictWriter(fw, fieldnames = ["name","note"],delimiter=",",lineterminator="\n")
         writer.writeheader()
-        c =0
-        for record in SeqIO.parse(input_fasta,"fasta"):
-            n_count = str(record.seq).upper().count("N")
-            n_content = round(n_count/len(record),3)
-            if n_content > 0.2:
+        for stats in all_stats:
+            stats_writer.writerow(stats)
+            notes = flag_sequence_stats(stats,config)
+            if notes:
                 c +=1
                 row = {
-                    "name": record.description,
-                    "note": f"N content is {n_content}"
+                    "name": stats["name"],
+                    "note": ";".join(notes)
                     }
                 writer.writerow(row)
-        print(green(f"{c} sequences flagged as high N content (>0.2): "),exclude_file)
+
+    print(green(f"Per-sequence QC stats written to: "),stats_file)
+    print(green(f"{c} sequences flagged for exclusion (N content >{config[KEY_MAX_N_CONTENT]} or other thresholds): "),exclude_file)
 
 
 def sliding_window(elements, window_size):
@@ -482,138 +616,179 @@ def sliding_window(elements, window_size):
     for i in range(len(elements)):
         print(elements[i:i+window_size])
 
-def check_for_alignment_issues(alignment):
-    bases = ["A","T","G","C"]
-    
-    with open(alignment,"r") as f:
-        aln = AlignIO.read(f, "fasta")
-        aln_len = len(aln[0])
-        
-        snp_cols = set()
+def find_block_issues(aln,first_col,core_start,core_end):
+    """
+    runs the column-wise qc checks on a block of alignment columns
+    aln holds every sequence for columns [first_col, first_col+aln.shape[1]),
+    snps are only called in [core_start, core_end), any extra columns either
+    side are there so the N/gap windows see across block edges
+    returns (row, site) arrays for unique mutations, snps near N and snps near gaps
+    with 0-based alignment sites
+    """
+    n_seqs = aln.shape[0]
+    core = aln[:,core_start-first_col:core_end-first_col]
+
+    #find the columns with variable sites
+    base_counts = np.stack([(core == base).sum(axis=0) for base in BASES])
+    core_snp_cols = np.flatnonzero((base_counts > 0).sum(axis=0) > 1)
+    snp_cols = core_snp_cols + core_start - first_col
+    snp_sites = core_snp_cols + core_start
+
+    #do this for only the variable sites to save time & memory
+    var_aln = core[:,core_snp_cols]
+    var_counts = base_counts[:,core_snp_cols]
+
+    #get majority base for that site, ties go to the base seen first in the alignment
+    first_seen = np.stack([np.argmax(var_aln == base,axis=0) for base in BASES])
+    rank = var_counts*(n_seqs+1) + (n_seqs-first_seen)
+    cns = BASES[np.argmax(rank,axis=0)]
+
+    #any character seen in only one sequence at a site is a unique mutation
+    col_index = np.arange(len(snp_cols))*256 + var_aln
+    value_counts = np.bincount(col_index.ravel(),minlength=len(snp_cols)*256)
+    unique_rows,unique_cols = np.nonzero(value_counts[col_index] == 1)
+
+    # if the variant itself isn't n and isn't the majority base
+    variant = (var_aln != N_BYTE) & (var_aln != GAP_BYTE) & (var_aln != cns)
+
+    # if the snp is within a couple bases of an N, may be an issue with coverage/ alignment
+    near_n_rows,near_n_cols = np.nonzero(variant & window_contains(aln,snp_cols,N_BYTE,2,2,first_col))
+    near_gap_rows,near_gap_cols = np.nonzero(variant & window_contains(aln,snp_cols,GAP_BYTE,1,1,first_col))
+
+    return ((unique_rows,snp_sites[unique_cols]),
+            (near_n_rows,snp_sites[near_n_cols]),
+            (near_gap_rows,snp_sites[near_gap_cols]))
+
+def find_block_issues_from_file(block_args):
+    matrix_file,shape,read_start,read_end,core_start,core_end = block_args
+    aln = read_column_block(matrix_file,shape,read_start,read_end)
+    return find_block_issues(aln,read_start,core_start,core_end)
+
+def find_clustered_snps(ids,unique_rows,unique_sites):
+    #sort by sequence, then by position
+    order = np.lexsort((unique_sites,unique_rows))
+    unique_rows = unique_rows[order]
+    unique_sites = unique_sites[order]
+
+    clustered = np.zeros(len(unique_sites),dtype=bool)
+
+    # if a second snp is within a couple bases
+    pair = (unique_rows[1:] == unique_rows[:-1]) & (unique_sites[1:] < unique_sites[:-1]+2)
+    clustered[:-1] |= pair
+    clustered[1:] |= pair
+
+    # if three snps are within 10 bases
+    triple = (unique_rows[2:] == unique_rows[:-2]) & (unique_sites[2:] < unique_sites[:-2]+10)
+    clustered[:-2] |= triple
+    clustered[1:-1] |= triple
+    clustered[2:] |= triple
+
+    clustered_snps = collections.defaultdict(set)
+    for row,site in zip(unique_rows[clustered],unique_sites[clustered]):
+        clustered_snps[ids[row]].add(int(site))
+    return clustered_snps
+
+def sites_by_sequence(ids,rows,sites):
+    seq_sites = collections.defaultdict(set)
+    for row,site in zip(rows,sites):
+        seq_sites[ids[row]].add(int(site))
+    return seq_sites
 
-        #dict keyed by sequence and values a set of indexes
-        unique_mutations = collections.defaultdict(set)
-        
+def check_for_alignment_issues(alignment):
+    ids,aln = load_alignment_matrix(alignment)
 
-        snps_near_n = collections.defaultdict(set)
-        snps_near_gap = collections.defaultdict(set)
+    unique_mutations,snps_near_n,snps_near_gap = find_block_issues(aln,0,0,aln.shape[1])
 
-        for i in range(aln_len):
-            
-            col = set()
-            
-            for s in aln:
-                #find the columns with variable sites
-                if s.seq[i] in bases:
+    return summarise_alignment_issues(ids,unique_mutations,snps_near_n,snps_near_gap)
 
-                    col.add(s.seq[i])
-                    
-            if col:
-                if len(col)>1:
-                    #do this for only the variable sites to save time & memory
-                    snp_cols.add(i)
-                    
-                    col_dict = collections.defaultdict(list)
-                    #get majority base for that site
-                    col_counter = collections.Counter()
-                    for s in aln:
-                        col_dict[s.seq[i]].append(s.id)
-                        if s.seq[i] in bases:
-                            col_counter[s[i]]+=1
-                        
-                    cns = col_counter.most_common(1)[0][0]
-
-                    for j in col_dict:
-                        if len(col_dict[j]) == 1:
-                            unique_mutations[col_dict[j][0]].add(i)
-                    
-                    # if the snp is within a couple bases of an N, may be an issue with coverage/ alignment
-                    for s in aln:
-                        # if the variant itself isn't n and isn't the majority base
-                        if s[i] != "N" and s[i] != cns and s[i]!="-":
-                            
-                            if "N" in s.seq[i-2:i+3]:
-                                snps_near_n[s.id].add(i)
-
-                    for s in aln:
-                        if s[i] != "N" and s[i] != cns and s[i]!="-":
-                            if "-" in s.seq[i-1:i+2]:
-                                snps_near_gap[s.id].add(i)
+def check_for_alignment_issues_out_of_core(alignment,tempdir,threads,max_memory):
+    """
+    same checks as check_for_alignment_issues, but the alignment is streamed to
+    disk and processed in overlapping column blocks across a pool of workers
+    max_memory (GB) caps the combined size of the blocks held in memory at once
+    """
+    matrix_file = os.path.join(tempdir,"qc_alignment.uint8")
+    ids,shape = write_alignment_memmap(alignment,matrix_file)
+    n_seqs,aln_len = shape
+
+    # roughly the peak bytes used per cell while a block is being checked
+    bytes_per_col = n_seqs*QC_BYTES_PER_CELL
+    block_width = max(1,int(max_memory*1e9/(threads*bytes_per_col)))
+    blocks = get_column_blocks(aln_len,block_width,2)
+    print(green(f"Running alignment QC in {len(blocks)} column blocks of up to {block_width} sites."))
+
+    unique_mutations = ([],[])
+    snps_near_n = ([],[])
+    snps_near_gap = ([],[])
+    with mp.Pool(min(threads,len(blocks))) as pool:
+        block_args = [(matrix_file,shape) + block for block in blocks]
+        for block_unique,block_near_n,block_near_gap in pool.imap(find_block_issues_from_file,block_args):
+            for found,block_found in [(unique_mutations,block_unique),(snps_near_n,block_near_n),(snps_near_gap,block_near_gap)]:
+                found[0].append(block_found[0])
+                found[1].append(block_found[1])
+    os.remove(matrix_file)
+
+    unique_mutations,snps_near_n,snps_near_gap = [(np.concatenate(rows),np.concatenate(sites)) for rows,sites in [unique_mutations,snps_near_n,snps_near_gap]]
+
+    return summarise_alignment_issues(ids,unique_mutations,snps_near_n,snps_near_gap)
+
+def summarise_alignment_issues(ids,unique_mutations,snps_near_n,snps_near_gap):
+    clustered_snps = find_clustered_snps(ids,*unique_mutations)
+    snps_near_n = sites_by_sequence(ids,*snps_near_n)
+    snps_near_gap = sites_by_sequence(ids,*snps_near_gap)
+
+    sites_to_mask = {}
     
-        clustered_snps = collections.defaultdict(set)
-        clustered_sites = set()
-        for s in aln:
-            unique = unique_mutations[s.id]
-            s_unique = sorted(unique)
-            for i,val in enumerate(s_unique):
-
-                if len(s_unique) > i+1:
-                    # if a second snp is within a couple bases
-                    if s_unique[i+1] < val+2:
-                        clustered_snps[s.id].add(val)
-                        clustered_snps[s.id].add(s_unique[i+1])
-
-                if len(s_unique) > i+2:
-                    # if three snps are within 10 bases
-                    if s_unique[i+2] < val+10:
-                        clustered_snps[s.id].add(val)
-                        clustered_snps[s.id].add(s_unique[i+1])
-                        clustered_snps[s.id].add(s_unique[i+2])
-
-        
-        sites_to_mask = {}
+    for s_id in ids:
+
+        if s_id in clustered_snps:
+            sites = [i+1 for i in sorted(clustered_snps[s_id])]
+            for site in sites:
+                if site not in sites_to_mask:
+                    sites_to_mask[site] = {
+                        "Name": site,
+                        "Minimum": site,
+                        "Maximum": site,
+                        "Length": 1,
+                        "present_in": [s_id],
+                        "note": {"clustered_snps"}
+                    }
+                else:
+                    sites_to_mask[site]["present_in"].append(s_id)
+                    
+        if s_id in snps_near_n:
+            sites = [i+1 for i in sorted(snps_near_n[s_id])]
+            for site in sites:
+                if site not in sites_to_mask:
+                    sites_to_mask[site] = {
+                        "Name": site,
+                        "Minimum": site,
+                        "Maximum": site,
+                        "Length": 1,
+                        "present_in": [s_id],
+                        "note": {"N_adjacent"}
+                    }
+                else:
+                    sites_to_mask[site]["present_in"].append(s_id)
+                    sites_to_mask[site]["note"].add("N_adjacent")
         
-        for s in aln:
-
-            if s.id in clustered_snps:
-                sites = [i+1 for i in sorted(clustered_snps[s.id])]
-                for site in sites:
-                    if site not in sites_to_mask:
-                        sites_to_mask[site] = {
-                            "Name": site,
-                            "Minimum": site,
-                            "Maximum": site,
-                            "Length": 1,
-                            "present_in": [s.id],
-                            "note": {"clustered_snps"}
-                        }
-                    else:
-                        sites_to_mask[site]["present_in"].append(s.id)
-                        
-            if s.id in snps_near_n:
-                sites = [i+1 for i in sorted(snps_near_n[s.id])]
-                for site in sites:
-                    if site not in sites_to_mask:
-                        sites_to_mask[site] = {
-                            "Name": site,
-                            "Minimum": site,
-                            "Maximum": site,
-                            "Length": 1,
-                            "present_in": [s.id],
-                            "note": {"N_adjacent"}
-                        }
-                    else:
-                        sites_to_mask[site]["present_in"].append(s.id)
-                        sites_to_mask[site]["note"].add("N_adjacent")
-            
-            if s.id in snps_near_gap:
-                sites = [i+1 for i in sorted(snps_near_gap[s.id])]
-                for site in sites:
-                    if site not in sites_to_mask:
-                        sites_to_mask[site] = {
-                            "Name": site,
-                            "Minimum": site,
-                            "Maximum": site,
-                            "Length": 1,
-                            "present_in": [s.id],
-                            "note": {"gap_adjacent"}
-                        }
-                    else:
-                        sites_to_mask[site]["present_in"].append(s.id)
-                        sites_to_mask[site]["note"].add("gap_adjacent")
+        if s_id in snps_near_gap:
+            sites = [i+1 for i in sorted(snps_near_gap[s_id])]
+            for site in sites:
+                if site not in sites_to_mask:
+                    sites_to_mask[site] = {
+                        "Name": site,
+                        "Minimum": site,
+                        "Maximum": site,
+                        "Length": 1,
+                        "present_in": [s_id],
+                        "note": {"gap_adjacent"}
+                    }
+                else:
+                    sites_to_mask[site]["present_in"].append(s_id)
+                    sites_to_mask[site]["note"].add("gap_adjacent")
 
-        print(green(f"Number of possibly problematic SNPs: "),len(sites_to_mask))
-        return sites_to_mask
+    return sites_to_mask
 
 def merge_flagged_sites(sites_to_mask,branch_reversions,branch_convergence,out_report):
 
@@ -651,6 +826,7 @@ def merge_flagged_sites(sites_to_mask,branch_reversions,branch_convergence,out_r
                 sites_to_mask[site]["present_in"].append(f"{snp}|{branch}")
                 sites_to_mask[site]["note"].add("convergent_snp")
 
+    rows = []
     with open(out_report,"w") as fw:
         writer = csv.DictWriter(fw,lineterminator="\n",fieldnames=["Name","Minimum","Maximum","Length","present_in","note"])
         writer.writeheader()
@@ -664,26 +840,124 @@ def merge_flagged_sites(sites_to_mask,branch_reversions,branch_convergence,out_r
                 new_row["present_in"] = ";".join(row["present_in"])
             new_row["note"] = ";".join(row["note"])
             writer.writerow(new_row)
+            rows.append(new_row)
+    return rows
+
+def find_alignment_sites_to_mask(alignment,config):
+    cache_file = get_qc_cache_file("flagged_sites",[alignment],config)
+    sites_to_mask = load_qc_cache(cache_file)
+    if sites_to_mask is None:
+        if config[KEY_QC_OUT_OF_CORE]:
+            sites_to_mask = check_for_alignment_issues_out_of_core(alignment,config[KEY_TEMPDIR],config[KEY_THREADS],config[KEY_QC_MAX_MEMORY])
+        else:
+            sites_to_mask = check_for_alignment_issues(alignment)
+        write_qc_cache(cache_file,sites_to_mask)
+    print(green(f"Number of possibly problematic SNPs: "),len(sites_to_mask))
+    return sites_to_mask
+
+def read_exclude_names(exclude_file):
+    to_exclude = set()
+    with open(exclude_file,"r") as f:
+        reader = csv.DictReader(f)
+        for row in reader:
+            to_exclude.add(row["name"])
+    return to_exclude
+
+def get_auto_exclude_rows_file(config):
+    """
+    the alignment with the excluded sequences dropped but no sites masked yet
+    """
+    return os.path.join(config[KEY_TEMPDIR],"auto_exclude.rows.aln.fasta")
+
+def auto_exclude_from_alignment(exclude_file,config):
+    """
+    acts on the qc in the same run: drops the sequences in exclude_file from the
+    built alignment (row selection), re-runs the alignment checks on what is left
+    and masks the flagged columns with N (column selection, so site coordinates
+    stay the same for phylogenetics and reconstruction)
+    the alignment before exclusion is kept as <outfile_stem>.unfiltered.aln.fasta
+    and the kept rows before masking are left in the tempdir for the final qc
+    """
+    alignment = os.path.join(config[KEY_OUTDIR],config[KEY_OUTFILENAME])
+    unfiltered = os.path.join(config[KEY_OUTDIR],f"{config[KEY_OUTFILE_STEM]}.unfiltered.aln.fasta")
+    rows_kept = get_auto_exclude_rows_file(config)
+    os.replace(alignment,unfiltered)
+
+    # the alignment replaces spaces and commas in the header with underscores
+    to_exclude = {name.replace(" ","_").replace(",","_"):name for name in read_exclude_names(exclude_file)}
+    outgroups = set(config[KEY_OUTGROUPS]) if config[KEY_RUN_PHYLO] else set()
+    matched = set()
+    kept = 0
+    excluded = 0
+    with open(rows_kept,"w") as fw:
+        for record in SeqIO.parse(unfiltered,"fasta"):
+            name = record.id if record.id in to_exclude else record.description
+            if name in to_exclude:
+                matched.add(name)
+                if record.id in outgroups:
+                    print(cyan("Note: not excluding outgroup flagged by QC:"),record.id)
+                else:
+                    excluded +=1
+                    continue
+            fw.write(f">{record.description}\n{record.seq}\n")
+            kept +=1
+
+    for name in sorted(set(to_exclude) - matched):
+        print(cyan("Note: sequence flagged by QC not found in the alignment:"),to_exclude[name])
+
+    if not kept:
+        sys.stderr.write(cyan(f'Error: no sequences left in the alignment after auto-exclusion.\n'))
+        sys.exit(-1)
+
+    sites_to_mask = find_alignment_sites_to_mask(rows_kept,config)
+    cols = np.array(sorted(sites_to_mask),dtype=np.int64) - 1
+
+    with open(alignment,"w") as fw:
+        for record in SeqIO.parse(rows_kept,"fasta"):
+            seq = np.frombuffer(str(record.seq).encode(),dtype=np.uint8).copy()
+            seq[cols] = N_BYTE
+            fw.write(f">{record.description}\n{seq.tobytes().decode()}\n")
+
+    print(green(f"Auto-exclusion: {excluded} sequences dropped and {len(cols)} sites masked, {kept} sequences written to: ") + f"{alignment}")
+    print(green("Alignment before exclusion written to: ") + f"{unfiltered}")
 
 def run_phylo_snp_checks(assembly_references,config,h):
 
-    state_file = os.path.join(config[KEY_OUTDIR],f"{config[KEY_PHYLOGENY]}.state")
+    state_file = None
+    if config[KEY_ASR_ENGINE] != "parsimony":
+        state_file = os.path.join(config[KEY_OUTDIR],f"{config[KEY_PHYLOGENY]}.state")
     treefile = os.path.join(config[KEY_OUTDIR],f"{config[KEY_PHYLOGENY]}")
 
-    branch_snps = os.path.join(config[KEY_OUTDIR],f"{config[KEY_PHYLOGENY]}.branch_snps.reconstruction.csv")
+    result_file = get_reconstruction_result_file(treefile)
     reversion_figure_out = os.path.join(config[KEY_OUTDIR],f"{config[KEY_OUTFILENAME]}.reversions_fig")
     convergence_figure_out = os.path.join(config[KEY_OUTDIR],f"{config[KEY_OUTFILENAME]}.convergence_fig")
 
-    refs = load_assembly_refs(assembly_references)
-    
-
-    branch_snp_dict = read_in_branch_snps(branch_snps)
-    branch_paths= get_path_to_root(treefile)
+    refs = assembly_references
 
-    possible_reversions,branch_reversions,will_be_reverted = flag_reversions(branch_paths, branch_snp_dict,state_file, refs)  
-    branch_convergence = flag_convergence(treefile, branch_snp_dict)
-    make_reversion_tree_figure(reversion_figure_out,branch_snps,branch_reversions,will_be_reverted,treefile,25,h)
-    make_convergence_tree_figure(convergence_figure_out,branch_snps,branch_convergence,treefile,25,h)
+    alignment = os.path.join(config[KEY_OUTDIR],config[KEY_OUTFILENAME])
+    refs_hash = hashlib.sha256()
+    for ref in refs:
+        refs_hash.update(ref.encode())
+        refs_hash.update(refs[ref].tobytes())
+
+    result = ReconstructionResult.load(result_file)
+    branch_snp_index = result.branch_snp_index
+
+    inputs = [path for path in [alignment,treefile,state_file,result_file] if path]
+    cache_file = get_qc_cache_file("phylo_checks",inputs,config,refs_hash.hexdigest(),"convergent_snps")
+    cached = load_qc_cache(cache_file)
+    if cached is None:
+        possible_reversions,branch_reversions,will_be_reverted = flag_reversions(treefile, branch_snp_index,state_file, refs, result.node_states)
+        convergent_snps,branch_convergence = find_convergence(branch_snp_index)
+        report_convergence(convergent_snps)
+        write_qc_cache(cache_file,(branch_reversions,will_be_reverted,branch_convergence,convergent_snps))
+    else:
+        # the same summaries as an uncached run
+        branch_reversions,will_be_reverted,branch_convergence,convergent_snps = cached
+        report_reversions(branch_reversions)
+        report_convergence(convergent_snps)
+    make_reversion_tree_figure(reversion_figure_out,branch_snp_index,branch_reversions,will_be_reverted,treefile,25,h)
+    make_convergence_tree_figure(convergence_figure_out,branch_snp_index,branch_convergence,treefile,25,h)
 
     return branch_reversions, branch_convergence
 
@@ -696,9 +970,16 @@ def check_for_snp_anomalies(assembly_references,config,h):
     if config[KEY_RUN_APOBEC3_PHYLO]:
         branch_reversions, branch_convergence = run_phylo_snp_checks(assembly_references,config,h)
 
-    sites_to_mask = check_for_alignment_issues(alignment)
+    # after auto-exclusion the checks run on the kept sequences before masking,
+    # the N columns would otherwise flag every snp next to a masked site
+    if config[KEY_AUTO_EXCLUDE]:
+        alignment = get_auto_exclude_rows_file(config)
+    sites_to_mask = find_alignment_sites_to_mask(alignment,config)
 
-    merge_flagged_sites(sites_to_mask,branch_reversions,branch_convergence,mask_file)
+    rows = merge_flagged_sites(sites_to_mask,branch_reversions,branch_convergence,mask_file)
+    if config[KEY_PARQUET]:
+        table = columnar.rows_to_frame(rows,columnar.SUGGESTED_MASK_DTYPES)
+        columnar.write_parquet(table,columnar.get_parquet_file(mask_file),sort_by="Minimum")
     return mask_file
 
 
@@ -0,0 +1,72 @@
+#!/usr/bin/env python3
+import numpy as np
+import pandas as pd
+
+from squirrel.utils.log_colours import green,cyan
+from squirrel.utils.node_states import STATE_STRINGS
+
+# rows are sorted by site before writing, so each row group covers a narrow
+# site range and readers filtering on site can skip groups from the statistics
+PARQUET_ROW_GROUP_SIZE = 65536
+
+BRANCH_SNPS_DTYPES = {"parent":"category","child":"category","site":"int32","snp":"category","dimer":"category"}
+
+AMINO_ACID_DTYPES = {"site":"int32","gene":"category","direction":"category","snp":"category","dimer":"category",
+                     "apobec":"boolean","aa_position":"Int8","parent":"category","parent_codon":"category",
+                     "parent_aa":"category","child":"category","child_codon":"category","child_aa":"category",
+                     "mutation_category":"category","score":"Int16","prediction":"category",
+                     "homoplasy":"boolean","occurrence":"int32"}
+
+SUGGESTED_MASK_DTYPES = {"Name":"int32","Minimum":"int32","Maximum":"int32","Length":"int32",
+                         "present_in":"string","note":"category"}
+
+
+def get_parquet_file(csv_file):
+    if csv_file.endswith(".csv"):
+        return f"{csv_file[:-4]}.parquet"
+    return f"{csv_file}.parquet"
+
+def write_parquet(table,outfile,sort_by="site"):
+    table = table.sort_values(sort_by,kind="stable").reset_index(drop=True)
+    table.to_parquet(outfile,engine="pyarrow",index=False,row_group_size=PARQUET_ROW_GROUP_SIZE)
+    return outfile
+
+def rows_to_frame(rows,dtypes):
+    """
+    the typed table of rows of values (None where missing) in the column
+    order of dtypes, as the csv outputs are written from
+    """
+    return pd.DataFrame.from_records(rows,columns=list(dtypes)).astype(dtypes)
+
+def format_csv_row(row):
+    return ",".join("NA" if value is None else f"{value}" for value in row) + "\n"
+
+def branch_snps_frame(branch_snp_index):
+    """
+    the branch snps straight from the index arrays, in index order
+    """
+    index = branch_snp_index
+    node_names = np.array(index.node_names,dtype=object)
+    return pd.DataFrame({"parent":pd.Categorical(node_names[index.parent_idx]),
+                         "child":pd.Categorical(node_names[index.child_idx]),
+                         "site":index.sites.astype("int32"),
+                         "snp":pd.Categorical(np.array(index.snp_names,dtype=object)[index.snp_idx]),
+                         "dimer":pd.Categorical(np.array(index.dimer_names,dtype=object)[index.dimer_idx])})
+
+def state_differences_frame(result):
+    """
+    the sparse state differences of a ReconstructionResult as site, node, state
+    and is_root columns. the node column's categories are every node and tip,
+    in the order of the full table
+    """
+    node_states = result.node_states
+    sorted_rows = np.array(node_states.sorted_rows(),dtype=np.int64)
+    node_codes = np.empty(len(sorted_rows),dtype=np.int64)
+    node_codes[sorted_rows] = np.arange(len(sorted_rows))
+
+    blocks = list(result.iter_state_differences())
+    sites,node_rows,states = [np.concatenate([block[i] for block in blocks]) if blocks else np.zeros(0,dtype=np.int64) for i in range(3)]
+    return pd.DataFrame({"site":sites.astype("int32"),
+                         "node":pd.Categorical.from_codes(node_codes[node_rows],categories=[node_states.names[i] for i in sorted_rows]),
+                         "state":pd.Categorical(STATE_STRINGS[states.astype(np.int64)]),
+                         "is_root":np.r_[True,sites[1:] != sites[:-1]][:len(sites)]})
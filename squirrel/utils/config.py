@@ -23,11 +23,27 @@ KEY_TRIM_END="trim_end"
 KEY_EXTRACT_CDS="extract_cds"
 KEY_SEQ_QC = "seq_qc"
 KEY_ASSEMBLY_REFERENCES = "assembly_references"
+KEY_CACHE_DIR = "cache_dir"
+KEY_PARQUET = "parquet"
+KEY_QC_OUT_OF_CORE = "qc_out_of_core"
+KEY_QC_MAX_MEMORY = "qc_max_memory"
+KEY_MAX_N_CONTENT = "max_n_content"
+KEY_MAX_GAP_CONTENT = "max_gap_content"
+KEY_MAX_AMBIGUITIES = "max_ambiguities"
+KEY_MAX_N_RUN = "max_n_run"
+KEY_MIN_LENGTH = "min_length"
+KEY_AUTO_EXCLUDE = "auto_exclude"
 
 KEY_CLADE = "clade"
 KEY_RUN_PHYLO="run_phylo"
 KEY_RUN_APOBEC3_PHYLO = "run_apobec3_phylo"
+KEY_ASR_ENGINE = "asr_engine"
+KEY_COMPRESS_SITE_PATTERNS = "compress_site_patterns"
 KEY_OUTGROUPS="outgroups"
+KEY_ROOT_TO_TIP = "root_to_tip"
+KEY_DATE_METADATA = "date_metadata"
+KEY_METADATA_ID_COLUMN = "metadata_id_column"
+KEY_METADATA_DATE_COLUMN = "metadata_date_column"
 KEY_PHYLOGENY="phylogeny"
 KEY_PHYLOGENY_SVG="phylogeny_svg"
 KEY_INCLUDE_BACKGROUND = "include_background"
@@ -0,0 +1,323 @@
+#!/usr/bin/env python3
+import csv
+import itertools
+import numpy as np
+import pandas as pd
+import warnings
+from Bio import BiopythonWarning
+from Bio import SeqIO
+from Bio.Seq import Seq
+warnings.simplefilter('ignore', BiopythonWarning)
+
+from squirrel.utils.apobec_context import target_codes,snp_contexts
+
+# ACGT -> 0-3 (anything else -1), so a codon indexes the 64-entry translation table
+BASE_INDEX = np.full(256,-1,dtype=np.int64)
+BASE_INDEX[np.frombuffer(b"ACGT",dtype=np.uint8)] = np.arange(4)
+CODON_AA = np.frombuffer("".join(str(Seq("".join(codon)).translate()) for codon in itertools.product("ACGT",repeat=3)).encode(),dtype=np.uint8)
+
+COMPLEMENT = np.arange(256,dtype=np.uint8)
+for base in "ACGTRYSWKMBDHVNacgtryswkmbdhvn":
+    COMPLEMENT[ord(base)] = ord(str(Seq(base).complement()))
+
+GRANTHAM_PREDICTIONS = ["conservative","moderately conservative","moderately radical","radical"]
+MUTATION_CATEGORIES = ["synonymous","nonsynonymous","nonsense","intergenic"]
+
+
+def get_gene_boundaries(gene_boundaries_file):
+    genes = {}
+    gene_id = 0
+    with open(gene_boundaries_file,"r") as f:
+        reader = csv.DictReader(f)
+        for row in reader:
+            gene_id +=1
+            name = f"{row['Name'].replace(' ','_')}_{gene_id}"
+            start = int(row["Minimum"])
+            end = int(row["Maximum"])+1
+            length = int(row["Length"])
+            direction = row["Direction"]
+            genes[(start,end)]=(name,length,direction)
+    return genes
+
+def get_grantham_scores(grantham_scores_file):
+    grantham_scores = {}
+
+    with open(grantham_scores_file,"r") as f:
+        reader = csv.DictReader(f, delimiter="\t")
+        for row in reader:
+            for col in row:
+                if col!="FIRST":
+                    mutation = f"{row['FIRST']}{col}"
+
+                    if row[col] != "0":
+                        grantham_scores[mutation] = int(row[col])
+                        grantham_scores[mutation[::-1]] = int(row[col])
+    return grantham_scores
+
+
+def categorise_amino_acid_mutation(aa1,aa2,grantham_scores):
+
+    mutation_category = ""
+    if aa1 == aa2:
+        mutation_category = "synonymous"
+    else:
+        if aa2 == '*':
+            mutation_category = "nonsense"
+        else:
+            mutation_category = "nonsynonymous"
+
+    if f"{aa1}{aa2}" in grantham_scores:
+        score = grantham_scores[f"{aa1}{aa2}"]
+        if score < 51:
+            prediction = "conservative"
+        elif score <101:
+            prediction = "moderately conservative"
+        elif score <151:
+            prediction = "moderately radical"
+        else:
+            prediction = "radical"
+    else:
+        score = "NA"
+        prediction = "NA"
+
+    return mutation_category,score,prediction
+
+
+class LookupTable(dict):
+    """
+    dict that fills itself from a function the first time a key is looked up
+    """
+    def __init__(self,function):
+        super().__init__()
+        self.function = function
+
+    def __missing__(self,key):
+        value = self.function(key)
+        self[key] = value
+        return value
+
+
+class GeneModel:
+    """
+    Gene boundaries indexed by genome position, so the genes (and codon frame
+    and strand) covering any number of sites are found with array lookups.
+    Overlapping genes are supported, each position keeps its genes in file order.
+
+    Translation, reverse complement and grantham categorisation go through
+    lookup tables filled the first time each codon or amino acid pair is seen,
+    so Biopython is called once per distinct value rather than once per snp.
+    """
+
+    def __init__(self,genes,grantham_scores,reference=None):
+        self.genes = list(genes.items())
+        self.names = [name for (start,end),(name,length,direction) in self.genes]
+        self.directions = [direction for (start,end),(name,length,direction) in self.genes]
+        self.starts = np.array([start for (start,end),info in self.genes],dtype=np.int64)
+        self.ends = np.array([end for (start,end),info in self.genes],dtype=np.int64)
+        self.forward = np.array([direction == "forward" for direction in self.directions],dtype=bool)
+
+        # positions -> genes as a compressed index: gene_at[offsets[p]:offsets[p+1]]
+        lengths = self.ends - self.starts
+        positions = np.concatenate([np.arange(start,end) for start,end in zip(self.starts,self.ends)]) if self.genes else np.zeros(0,dtype=np.int64)
+        gene_idx = np.repeat(np.arange(len(self.genes)),np.maximum(lengths,0))
+        order = np.lexsort((gene_idx,positions))
+        self.gene_at = gene_idx[order]
+        self.offsets = np.searchsorted(positions[order],np.arange(int(self.ends.max(initial=0))+2))
+
+        self.grantham_scores = grantham_scores
+        self.translations = LookupTable(lambda codon: str(Seq(codon).translate()))
+        self.reverse_complements = LookupTable(lambda codon: str(Seq(codon).reverse_complement()))
+        self.categories = LookupTable(lambda aas: categorise_amino_acid_mutation(aas[0],aas[1],self.grantham_scores))
+
+        # grantham score for every pair of amino acid codes, -1 where there is none
+        self.grantham_matrix = np.full((256,256),-1,dtype=np.int64)
+        for mutation,score in grantham_scores.items():
+            if len(mutation) == 2:
+                self.grantham_matrix[ord(mutation[0]),ord(mutation[1])] = score
+
+        # reference genome as uint8, needed to annotate snps without a reconstruction
+        self.reference = reference
+
+    def __reduce__(self):
+        # rebuilt from its inputs when sent to a worker, as the lookup tables hold lambdas
+        return (GeneModel,(dict(self.genes),self.grantham_scores,self.reference))
+
+    @classmethod
+    def from_files(cls,gene_boundaries_file,grantham_scores_file,reference_fasta=None):
+        reference = None
+        if reference_fasta:
+            record = next(SeqIO.parse(reference_fasta,"fasta"))
+            reference = np.frombuffer(str(record.seq).upper().encode(),dtype=np.uint8)
+        return cls(get_gene_boundaries(gene_boundaries_file),get_grantham_scores(grantham_scores_file),reference)
+
+    def genes_at(self,sites):
+        """
+        every (site index, gene index) pair where the gene covers the site,
+        in site order and then gene order
+        """
+        sites = np.asarray(sites,dtype=np.int64)
+        inside = (sites >= 0) & (sites < len(self.offsets)-1)
+        clipped = np.where(inside,sites,0)
+        first = self.offsets[clipped]
+        counts = np.where(inside,self.offsets[clipped+1] - first,0)
+        site_idx = np.repeat(np.arange(len(sites)),counts)
+        # position of each pair within its site's run of genes
+        within = np.arange(len(site_idx)) - np.repeat(np.cumsum(counts) - counts,counts)
+        return site_idx,self.gene_at[first[site_idx] + within]
+
+    def codon_positions(self,sites,gene_idx):
+        """
+        position of each site in its codon (1-3, in the gene's direction) and the
+        three genome positions of the codon (in genome order)
+        """
+        sites = np.asarray(sites,dtype=np.int64)
+        forward = self.forward[gene_idx]
+        forward_position = (sites - self.starts[gene_idx]) % 3 + 1
+        reverse_position = (self.ends[gene_idx] - 1 - sites) % 3 + 1
+        aa_position = np.where(forward,forward_position,reverse_position)
+        codon_start = np.where(forward,sites - (forward_position - 1),sites - (3 - reverse_position))
+        return aa_position,codon_start[:,None] + np.arange(3)
+
+    def translate(self,codon,forward):
+        """
+        returns the codon (reverse complemented for reverse strand genes) and its amino acid
+        """
+        if not forward:
+            codon = self.reverse_complements[codon]
+        return codon,self.translations[codon]
+
+    def categorise(self,aa1,aa2):
+        return self.categories[(aa1,aa2)]
+
+    def translate_codes(self,codons):
+        """
+        translates an n x 3 array of codon ascii codes through the codon table,
+        codons that are not all ACGT fall back to Biopython (through the lookup table),
+        codons running off the reference (0 codes) are left untranslated
+        """
+        index = BASE_INDEX[codons]
+        valid = (index >= 0).all(axis=1)
+        aas = np.zeros(len(codons),dtype=np.uint8)
+        aas[valid] = CODON_AA[index[valid] @ np.array([16,4,1])]
+        for i in np.flatnonzero(~valid & (codons != 0).all(axis=1)):
+            aa = self.translations[codons[i].tobytes().decode()]
+            aas[i] = ord(aa) if aa else 0
+        return aas
+
+    def annotate(self,sites,refs,alts):
+        """
+        annotates snps given as 1-based reference sites with ref and alt bases
+        against the reference genome, in one vectorised pass
+        returns a dataframe with a row per (snp, gene covering it), or one
+        intergenic row, in input order. `variant` is the index of the input snp,
+        string columns are categorical and missing values are NA
+        """
+        if self.reference is None:
+            raise ValueError("GeneModel needs a reference sequence to annotate snps")
+
+        sites = np.asarray(sites,dtype=np.int64)
+        refs = base_codes(refs,len(sites))
+        alts = base_codes(alts,len(sites))
+        padded = np.concatenate([[0],self.reference,[0]]).astype(np.uint8)
+        on_reference = (sites >= 1) & (sites <= len(self.reference))
+
+        # genic rows, then one row for each snp with no gene, back in input order
+        site_idx,gene_idx = self.genes_at(sites)
+        intergenic = np.flatnonzero(np.bincount(site_idx,minlength=len(sites)) == 0)
+        variant = np.concatenate([site_idx,intergenic])
+        order = np.argsort(variant,kind="stable")
+        variant = variant[order]
+        genic = order < len(site_idx)
+        genic_order = order[genic]
+
+        aa_position,codon_sites = self.codon_positions(sites[site_idx],gene_idx)
+        forward = self.forward[gene_idx]
+        ref_codons = padded[np.clip(codon_sites,0,len(self.reference)+1)]
+        alt_codons = ref_codons.copy()
+        alt_codons[np.arange(len(site_idx)),sites[site_idx] - codon_sites[:,0]] = alts[site_idx]
+        for codons in [ref_codons,alt_codons]:
+            codons[~forward] = COMPLEMENT[codons[~forward][:,::-1]]
+
+        ref_aa = self.translate_codes(ref_codons)
+        alt_aa = self.translate_codes(alt_codons)
+        score = self.grantham_matrix[ref_aa,alt_aa]
+        category = np.where(ref_aa == alt_aa,0,np.where(alt_aa == ord("*"),2,1))
+        prediction = np.where(score >= 0,np.searchsorted([51,101,151],score,side="right"),-1)
+        aa_number = np.where(forward,(sites[site_idx] - self.starts[gene_idx])//3,(self.ends[gene_idx] - 1 - sites[site_idx])//3) + 1
+
+        # dimer context from the reference, as for the reconstruction
+        previous_base = padded[np.clip(sites-1,0,len(padded)-1)].astype(np.int64)
+        next_base = padded[np.clip(sites+1,0,len(padded)-1)].astype(np.int64)
+        c_to_t = (refs == ord("C")) & (alts == ord("T"))
+        g_to_a = (refs == ord("G")) & (alts == ord("A"))
+        dimer = np.where(c_to_t,previous_base*256 + ord("C"),np.where(g_to_a,ord("G")*256 + next_base,0))
+        apobec = snp_contexts(refs,alts,target_codes(refs,next_base,previous_base)) > 0
+
+        def per_row(genic_values,intergenic_value):
+            values = np.full(len(variant),intergenic_value,dtype=np.asarray(genic_values).dtype)
+            values[genic] = genic_values[genic_order]
+            return values
+
+        annotation = pd.DataFrame({
+            "variant": variant,
+            "site": sites[variant],
+            "ref": byte_strings(refs[variant]),
+            "alt": byte_strings(alts[variant]),
+            "ref_match": on_reference[variant] & (padded[np.where(on_reference,sites,0)][variant] == refs[variant]),
+            "gene": pd.Categorical.from_codes(per_row(gene_idx,-1),categories=self.names),
+            "direction": pd.Categorical.from_codes(per_row(forward.astype(np.int64),-1),categories=["reverse","forward"]),
+            "aa_position": nullable_ints(per_row(aa_position,-1)),
+            "aa_number": nullable_ints(per_row(aa_number,-1)),
+            "ref_codon": code_strings(per_row(codon_keys(ref_codons),-1),3),
+            "ref_aa": byte_strings(per_row(ref_aa,0)),
+            "alt_codon": code_strings(per_row(codon_keys(alt_codons),-1),3),
+            "alt_aa": byte_strings(per_row(alt_aa,0)),
+            "mutation_category": pd.Categorical.from_codes(per_row(category,3),categories=MUTATION_CATEGORIES),
+            "score": nullable_ints(per_row(score,-1)),
+            "prediction": pd.Categorical.from_codes(per_row(prediction,-1),categories=GRANTHAM_PREDICTIONS),
+            "dimer": code_strings(dimer[variant],2),
+            "apobec": apobec[variant],
+            })
+        return annotation
+
+
+def base_codes(bases,n):
+    """
+    ascii codes of a sequence of single (upper cased) bases
+    """
+    codes = np.frombuffer("".join(bases).upper().encode(),dtype=np.uint8)
+    if len(codes) != n:
+        raise ValueError("every ref and alt has to be a single base")
+    return codes
+
+def codon_keys(codons):
+    """
+    packs an n x 3 array of ascii codes into one integer per codon
+    """
+    return (codons[:,0].astype(np.int64) << 16) | (codons[:,1].astype(np.int64) << 8) | codons[:,2]
+
+def code_strings(keys,width):
+    """
+    categorical of strings packed as integers (`width` ascii codes each), so
+    each distinct value is only decoded once. -1 is NA
+    """
+    values,codes = np.unique(keys,return_inverse=True)
+    codes = codes.reshape(-1)
+    if len(values) and values[0] < 0:
+        values = values[1:]
+        codes = codes - 1
+    categories = ["".join(chr((int(key) >> (8*i)) & 255) for i in reversed(range(width))).lstrip("\x00") for key in values]
+    return pd.Categorical.from_codes(codes,categories=categories)
+
+def byte_strings(codes):
+    """
+    categorical of single characters from ascii codes, 0 is NA
+    """
+    codes = np.asarray(codes,dtype=np.int64)
+    return pd.Categorical.from_codes(np.where(codes > 0,codes,-1),categories=[chr(i) for i in range(256)]).remove_unused_categories()
+
+def nullable_ints(values):
+    """
+    nullable integer array, -1 is NA
+    """
+    return pd.arrays.IntegerArray(np.asarray(values,dtype=np.int64),np.asarray(values) < 0)
@@ -24,6 +24,7 @@ def setup_config_dict(cwd):
             KEY_NO_TEMP:False,
 
             KEY_ASSEMBLY_REFERENCES:[],
+            KEY_CACHE_DIR:os.path.join(os.environ.get("XDG_CACHE_HOME",os.path.join(os.path.expanduser("~"),".cache")),"squirrel"),
             
             KEY_TREE:None,
             KEY_BRANCH_RECONSTRUCTION:None,
@@ -38,10 +39,26 @@ def setup_config_dict(cwd):
             KEY_ADDITIONAL_MASK:None,
             KEY_SEQUENCE_MASK:None,
             KEY_SEQ_QC:False,
+            KEY_QC_OUT_OF_CORE:False,
+            KEY_QC_MAX_MEMORY:4,
+            KEY_MAX_N_CONTENT:0.2,
+            KEY_MAX_GAP_CONTENT:None,
+            KEY_MAX_AMBIGUITIES:None,
+            KEY_MAX_N_RUN:None,
+            KEY_MIN_LENGTH:None,
+            KEY_AUTO_EXCLUDE:False,
             KEY_RUN_PHYLO:False,
             KEY_RUN_APOBEC3_PHYLO:False,
+            KEY_ASR_ENGINE:"iqtree",
+            KEY_COMPRESS_SITE_PATTERNS:False,
+            KEY_ROOT_TO_TIP:False,
+            KEY_DATE_METADATA:None,
+            KEY_METADATA_ID_COLUMN:"name",
+            KEY_METADATA_DATE_COLUMN:"date",
 
 
+            KEY_PARQUET:False,
+
             KEY_VERBOSE: False,
             KEY_THREADS: 1,
             KEY_PHYLO_THREADS: "AUTO",
@@ -33,6 +33,10 @@ def set_up_outdir(outdir_arg,cwd,outdir):
                 sys.exit(-1)
     return outdir
 
+def set_up_cache_dir(cache_dir_arg,cwd,config):
+    if cache_dir_arg:
+        config[KEY_CACHE_DIR] = os.path.join(cwd, cache_dir_arg)
+
 def set_up_outfile(outfile_arg,cwd,query_arg, outfile, outdir):
     outfile_stem = ""
     outfile_name = ""
@@ -272,6 +276,55 @@ def pipeline_options(no_mask, no_itr_mask, additional_mask,sequence_mask,extract
     config[KEY_CONCATENATE] = concatenate
 
 
+def qc_out_of_core_options(qc_out_of_core,qc_max_memory,seq_qc,config):
+    if (qc_out_of_core or qc_max_memory is not None) and not seq_qc:
+        sys.stderr.write(cyan(f'Error: `--qc-out-of-core` and `--qc-max-memory` can only be used with QC mode (`-qc`).\n'))
+        sys.exit(-1)
+    if qc_max_memory is not None and not qc_out_of_core:
+        print(cyan('Note: `--qc-max-memory` is only used with `--qc-out-of-core`.'))
+
+    config[KEY_QC_OUT_OF_CORE] = qc_out_of_core
+    if qc_max_memory is not None:
+        if qc_max_memory <= 0:
+            sys.stderr.write(cyan(f'Error: `--qc-max-memory` must be a positive number of GB.\n'))
+            sys.exit(-1)
+        config[KEY_QC_MAX_MEMORY] = qc_max_memory
+
+def qc_options(max_n_content,max_gap_content,max_ambiguities,max_n_run,min_length,config):
+    for arg,value,key in [("--max-n-content",max_n_content,KEY_MAX_N_CONTENT),
+                          ("--max-gap-content",max_gap_content,KEY_MAX_GAP_CONTENT)]:
+        if value is not None:
+            if not 0 <= value <= 1:
+                sys.stderr.write(cyan(f'Error: `{arg}` must be a proportion between 0 and 1.\n'))
+                sys.exit(-1)
+            config[key] = value
+
+    for arg,value,key in [("--max-ambiguities",max_ambiguities,KEY_MAX_AMBIGUITIES),
+                          ("--max-n-run",max_n_run,KEY_MAX_N_RUN),
+                          ("--min-length",min_length,KEY_MIN_LENGTH)]:
+        if value is not None:
+            if value < 0:
+                sys.stderr.write(cyan(f'Error: `{arg}` must not be negative.\n'))
+                sys.exit(-1)
+            config[key] = value
+
+def auto_exclude_options(auto_exclude,seq_qc,config):
+    if auto_exclude and not seq_qc:
+        sys.stderr.write(cyan(f'Error: `--auto-exclude` can only be used with QC mode (`-qc`).\n'))
+        sys.exit(-1)
+    config[KEY_AUTO_EXCLUDE] = auto_exclude
+
+
+def parquet_options(parquet,config):
+    if parquet:
+        try:
+            import pyarrow
+        except ImportError:
+            sys.stderr.write(cyan(f'Error: `--parquet` needs pyarrow installed. Install it with `pip install pyarrow`.\n'))
+            sys.exit(-1)
+    config[KEY_PARQUET] = parquet
+
+
 def find_background_file(cwd,input_fasta,background_file,config):
     seqs = set()
     path_to_try = os.path.join(cwd,background_file)
@@ -386,6 +439,55 @@ def parse_tf_options(tree_figure_only,tree_file,branch_reconstruction_file,width
         config[KEY_BRANCH_RECONSTRUCTION] = branch_reconstruction
 
 
+def root_to_tip_options(root_to_tip,metadata,id_column,date_column,run_apobec3_phylo,cwd,config):
+    if not root_to_tip:
+        if metadata:
+            print(cyan('Note: `--metadata` is only used for dates with `--root-to-tip`.'))
+        return
+
+    if not run_apobec3_phylo:
+        sys.stderr.write(cyan(f'Error: root-to-tip counts can only be calculated if APOBEC3 reconstruction mode (`-a`) is on.\n'))
+        sys.exit(-1)
+    config[KEY_ROOT_TO_TIP] = True
+
+    if id_column:
+        config[KEY_METADATA_ID_COLUMN] = id_column
+    if date_column:
+        config[KEY_METADATA_DATE_COLUMN] = date_column
+
+    if metadata:
+        path_to_try = os.path.join(cwd,metadata)
+        if not os.path.exists(path_to_try):
+            sys.stderr.write(cyan(f'Error: cannot find metadata file at: ') + f'{path_to_try}\n' + cyan('Please check file path and try again.\n'))
+            sys.exit(-1)
+        with open(path_to_try,"r") as f:
+            reader = csv.DictReader(f)
+            header = reader.fieldnames or []
+        for column in [config[KEY_METADATA_ID_COLUMN],config[KEY_METADATA_DATE_COLUMN]]:
+            if column not in header:
+                sys.stderr.write(cyan(f'Error: metadata file must contain column `{column}`.\n'))
+                sys.exit(-1)
+        config[KEY_DATE_METADATA] = path_to_try
+
+def asr_engine_options(asr_engine,run_apobec3_phylo,config):
+    if not asr_engine:
+        return
+
+    if asr_engine not in ["iqtree","parsimony"]:
+        sys.stderr.write(cyan(f'Error: not a valid ASR engine, please specify one of `iqtree` or `parsimony`.\n'))
+        sys.exit(-1)
+    if not run_apobec3_phylo:
+        print(cyan('Note: `--asr-engine` is only used for APOBEC3 reconstruction (`-a`).'))
+    config[KEY_ASR_ENGINE] = asr_engine
+
+def compress_site_patterns_options(compress_site_patterns,config):
+    if not compress_site_patterns:
+        return
+
+    if not config[KEY_RUN_PHYLO]:
+        print(cyan('Note: `--compress-site-patterns` is only used for the phylogenetics pipeline (`-p` or `-a`).'))
+    config[KEY_COMPRESS_SITE_PATTERNS] = True
+
 def phylo_options(run_phylo,run_apobec3_phylo,outgroups,include_background,binary_partition_mask,input_fasta,config):
     config[KEY_RUN_PHYLO] = run_phylo
 
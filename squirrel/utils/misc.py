@@ -3,6 +3,7 @@ import os
 import csv
 import sys
 import datetime as dt
+import hashlib
 
 import snakemake
 from squirrel.utils.config import *
@@ -24,4 +25,18 @@ def run_snakemake(snake_config,snakefile,verbose,config):
                                     workdir=config[KEY_TEMPDIR], config=snake_config, cores=config[KEY_THREADS],lock=False,
                                     quiet=True,log_handler=logger.log_handler
                                     )
-    return status
\ No newline at end of file
+    return status
+
+def hash_files(paths,*extra):
+    """
+    sha256 of the contents of each file plus any extra values,
+    used to key cached outputs to the exact inputs they came from
+    """
+    h = hashlib.sha256()
+    for path in paths:
+        with open(path,"rb") as f:
+            for chunk in iter(lambda: f.read(1<<20), b""):
+                h.update(chunk)
+    for value in extra:
+        h.update(f"|{value}".encode())
+    return h.hexdigest()
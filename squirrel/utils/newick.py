@@ -0,0 +1,280 @@
+#!/usr/bin/env python3
+import re
+import sys
+
+from squirrel.utils.log_colours import green,cyan
+
+
+def read_tree_string(treefile):
+    """
+    the newick string of a newick or nexus tree file (the first tree in it)
+    """
+    with open(treefile,"r") as f:
+        for line in f:
+            if "(" in line:
+                return line[line.index("("):].strip()
+    sys.stderr.write(cyan(f'Error: no tree found in: ') + f'{treefile}\n')
+    sys.exit(-1)
+
+def label_internal_nodes(tree_string,prefix="Node"):
+    """
+    names every internal node of a newick string NodeN, numbered in the order
+    the nodes open (so the root is Node1), as IQ-TREE does with -asr. existing
+    internal labels (e.g. support values) are replaced
+    """
+    labelled = []
+    open_nodes = []
+    n_nodes = 0
+    i = 0
+    while i < len(tree_string):
+        char = tree_string[i]
+        if char == "'":
+            end = tree_string.index("'",i+1)
+            labelled.append(tree_string[i:end+1])
+            i = end + 1
+            continue
+        if char == "(":
+            n_nodes += 1
+            open_nodes.append(n_nodes)
+        elif char == ")":
+            labelled.append(char)
+            # skip the old label up to the branch length or the next node
+            i += 1
+            while i < len(tree_string) and tree_string[i] not in ":,);[":
+                i += 1
+            labelled.append(f"{prefix}{open_nodes.pop()}")
+            continue
+        labelled.append(char)
+        i += 1
+    return "".join(labelled)
+
+def newick_name(name):
+    """
+    the name quoted if it has characters newick uses
+    """
+    if any(char in name for char in " ()[]',:;"):
+        return "'" + name.replace("'","''") + "'"
+    return name
+
+def label_end(tree_string,i):
+    """
+    the index just past the label starting at i, quoted or not
+    """
+    if tree_string[i] == "'":
+        end = i + 1
+        while True:
+            end = tree_string.index("'",end) + 1
+            if tree_string[end:end+1] != "'":
+                return end
+            end += 1
+    end = i
+    while end < len(tree_string) and tree_string[end] not in ":,);[":
+        end += 1
+    return end
+
+def expand_tips(tree_string,siblings,prefix="Node"):
+    """
+    replaces each tip named in siblings with a new internal node, on the tip's
+    branch, holding the tip and its siblings at zero length: (tip:0,sibling:0)NodeN.
+    new nodes are numbered on from the highest NodeN already in the tree
+    returns the tree string and the new node for each expanded tip
+    """
+    numbers = [int(n) for n in re.findall(rf"\){prefix}(\d+)",tree_string)]
+    next_node = max(numbers,default=0) + 1
+    expanded = []
+    new_nodes = {}
+    i = 0
+    leaf_next = False
+    while i < len(tree_string):
+        char = tree_string[i]
+        if leaf_next and char != "(":
+            end = label_end(tree_string,i)
+            label = tree_string[i:end]
+            name = label[1:-1].replace("''","'") if label.startswith("'") else label
+            if name in siblings:
+                new_nodes[name] = f"{prefix}{next_node}"
+                next_node += 1
+                tips = ",".join(f"{tip}:0" for tip in [label] + [newick_name(sibling) for sibling in siblings[name]])
+                expanded.append(f"({tips}){new_nodes[name]}")
+            else:
+                expanded.append(label)
+            i = end
+            leaf_next = False
+            continue
+        leaf_next = char in "(,"
+        expanded.append(char)
+        i += 1
+    return "".join(expanded),new_nodes
+
+class NewickNode:
+    """
+    A node of a tree read with parse_newick. The label, branch length and any
+    [comment] are kept as the text they were read from, so writing the tree
+    back only changes what was edited.
+    """
+
+    def __init__(self,parent=None):
+        self.parent = parent
+        self.children = []
+        self.label = ""
+        self.length = None
+        self.comment = ""
+
+    def name(self):
+        # the label without newick quoting
+        if self.label.startswith("'"):
+            return self.label[1:-1].replace("''","'")
+        return self.label
+
+    def text(self):
+        if self.length is None:
+            return f"{self.label}{self.comment}"
+        return f"{self.label}{self.comment}:{self.length}"
+
+
+def parse_newick(tree_string):
+    """
+    reads a newick string into NewickNodes without recursion, so deep trees
+    are fine. returns the root
+    """
+    root = NewickNode()
+    node = root
+    i = 0
+    while i < len(tree_string):
+        char = tree_string[i]
+        if char == "(":
+            child = NewickNode(node)
+            node.children.append(child)
+            node = child
+            i += 1
+        elif char == ",":
+            child = NewickNode(node.parent)
+            node.parent.children.append(child)
+            node = child
+            i += 1
+        elif char == ")":
+            node = node.parent
+            i += 1
+        elif char == ":":
+            end = i + 1
+            while end < len(tree_string) and tree_string[end] not in ",);[":
+                end += 1
+            node.length = tree_string[i+1:end].strip()
+            i = end
+        elif char == "[":
+            end = tree_string.index("]",i) + 1
+            node.comment += tree_string[i:end]
+            i = end
+        elif char == ";":
+            break
+        elif char.isspace():
+            i += 1
+        else:
+            end = label_end(tree_string,i)
+            node.label = tree_string[i:end]
+            i = end
+    return root
+
+def write_newick(root):
+    pieces = []
+    stack = [root]
+    while stack:
+        node = stack.pop()
+        if isinstance(node,str):
+            pieces.append(node)
+        elif node.children:
+            pieces.append("(")
+            stack.append(f"){node.text()}")
+            for j,child in enumerate(reversed(node.children)):
+                if j:
+                    stack.append(",")
+                stack.append(child)
+        else:
+            pieces.append(node.text())
+    return "".join(pieces) + ";"
+
+def add_lengths(first,second):
+    if first is None or second is None:
+        return first if second is None else second
+    return f"{float(first)+float(second):.10g}"
+
+def prune_tips(root,tips):
+    """
+    removes the named tips from the tree. internal nodes left with no children
+    are removed too, and nodes left with one child are joined into that child's
+    branch (the child keeps its label). if the root is left with one child, the
+    root keeps its label and takes that child's children, as jclusterfunk
+    prunes. returns the root
+    """
+    tips = set(tips)
+    leaves = []
+    stack = [root]
+    while stack:
+        node = stack.pop()
+        if node.children:
+            stack.extend(node.children)
+        elif node.name() in tips:
+            leaves.append(node)
+
+    missing = tips - set(leaf.name() for leaf in leaves)
+    if missing:
+        sys.stderr.write(cyan(f'Error: tips to prune not found in tree: ') + f'{", ".join(sorted(missing))}\n')
+        sys.exit(-1)
+
+    for leaf in leaves:
+        node = leaf
+        while node.parent is not None and not node.children:
+            parent = node.parent
+            parent.children.remove(node)
+            node = parent
+
+        if len(node.children) != 1:
+            continue
+        child = node.children[0]
+        if node.parent is None:
+            if not child.children:
+                sys.stderr.write(cyan(f'Error: only one tip left in the tree after pruning: ') + f'{child.name()}\n')
+                sys.exit(-1)
+            for grandchild in child.children:
+                grandchild.parent = node
+            node.children = child.children
+        else:
+            child.length = add_lengths(child.length,node.length)
+            child.parent = node.parent
+            node.parent.children[node.parent.children.index(node)] = child
+    return root
+
+def write_nexus(root):
+    """
+    the tree in a nexus file as jclusterfunk writes it, a taxa block with the
+    tip labels and then the newick string of the tree
+    """
+    tips = []
+    stack = [root]
+    while stack:
+        node = stack.pop()
+        if node.children:
+            stack.extend(reversed(node.children))
+        else:
+            tips.append(node.label)
+
+    lines = ["#NEXUS","begin taxa;",f"\tdimensions ntax={len(tips)};","\ttaxlabels"]
+    lines.extend(f"\t{tip}" for tip in tips)
+    lines.extend([";","end;","","begin trees;",f"\ttree tree_1 = [&R] {write_newick(root)}","end;"])
+    return "\n".join(lines) + "\n"
+
+def write_pruned_tree(treefile,outfile,tips):
+    """
+    writes the tree without the given tips (the outgroups) as nexus, keeping
+    the internal node labels the reconstruction looks nodes up by
+    """
+    root = prune_tips(parse_newick(read_tree_string(treefile)),tips)
+    with open(outfile,"w") as fw:
+        fw.write(write_nexus(root))
+    print(green("Pruned tree written to: ") + f"{outfile}")
+
+def write_labelled_tree(treefile,outfile):
+    tree_string = label_internal_nodes(read_tree_string(treefile))
+    with open(outfile,"w") as fw:
+        fw.write(f"{tree_string}\n")
+    print(green("Internal nodes labelled in tree written to: ") + f"{outfile}")
@@ -0,0 +1,361 @@
+#!/usr/bin/env python3
+import os
+import sys
+import contextlib
+import numpy as np
+from multiprocessing import shared_memory
+import pandas as pd
+from Bio import SeqIO
+
+from squirrel.utils.log_colours import green,cyan
+from squirrel.utils.alignment_matrix import BASES,GAP_BYTE
+
+# decodes a state byte back to the string the csv outputs use, 0 is an empty state
+STATE_STRINGS = np.array([""] + [chr(i) for i in range(1,256)],dtype=object)
+EMPTY_STATES = np.frombuffer(b"N-",dtype=np.uint8)
+
+STATE_FILE_DTYPES = {"Node":str,"Site":np.int64,"State":str,
+                     "p_A":np.float32,"p_C":np.float32,"p_G":np.float32,"p_T":np.float32}
+
+
+def parse_state_file(state_file,sites=None,chunk_size=1000000):
+    """
+    reads an iqtree .state file (gzipped or not) in chunks of rows into arrays
+    iqtree writes every node's rows as one block with the sites in the same
+    order, so the states are returned as a node x site uint8 matrix of ascii
+    codes and the probabilities (p_A,p_C,p_G,p_T) as node x site x 4 float16
+    if sites are given, each chunk is cut down to the rows for those sites
+    before it is kept, so only the needed columns are ever held
+    returns node names, sites, states and probabilities
+    """
+    runs = []
+    site_order = None
+    pending = []
+    states = []
+    probs = []
+    n_rows = 0
+
+    reader = pd.read_csv(state_file,sep="\t",comment="#",dtype=STATE_FILE_DTYPES,
+                         na_filter=False,chunksize=chunk_size,compression="infer")
+    for chunk in reader:
+        names = chunk["Node"].to_numpy()
+        chunk_sites = chunk["Site"].to_numpy()
+
+        # runs of consecutive rows from the same node
+        starts = np.flatnonzero(np.r_[True,names[1:] != names[:-1]])
+        counts = np.diff(np.r_[starts,len(names)])
+        for start,count in zip(starts,counts):
+            if runs and runs[-1][0] == names[start]:
+                runs[-1][1] += count
+            else:
+                runs.append([names[start],count])
+
+        # every node's block has the sites in the same order as the first node's
+        pending.append((n_rows,chunk_sites))
+        if site_order is None and len(runs) > 1:
+            site_order = np.concatenate([sites for start,sites in pending])[:runs[0][1]]
+        if site_order is not None:
+            for start,pending_sites in pending:
+                if not np.array_equal(pending_sites,site_order[(start + np.arange(len(pending_sites))) % len(site_order)]):
+                    sys.stderr.write(cyan(f'Error: state file does not have the same sites in the same order for every node: ') + f'{state_file}\n')
+                    sys.exit(-1)
+            pending = []
+        n_rows += len(chunk)
+
+        if sites is not None:
+            chunk = chunk[np.isin(chunk_sites,sites)]
+        states.append(chunk["State"].to_numpy().astype("S1").view(np.uint8))
+        probs.append(chunk[["p_A","p_C","p_G","p_T"]].to_numpy(dtype=np.float16))
+
+    if site_order is None:
+        site_order = np.concatenate([sites for start,sites in pending]) if pending else np.zeros(0,dtype=np.int64)
+
+    nodes = [name for name,count in runs]
+    if len(set(nodes)) != len(nodes) or any(count != len(site_order) for name,count in runs):
+        sys.stderr.write(cyan(f'Error: state file rows are not grouped into one block per node: ') + f'{state_file}\n')
+        sys.exit(-1)
+
+    if sites is not None:
+        site_order = site_order[np.isin(site_order,sites)]
+    n_sites = len(site_order)
+    states = np.concatenate(states).reshape(len(nodes),n_sites) if states else np.zeros((0,0),dtype=np.uint8)
+    probs = np.concatenate(probs).reshape(len(nodes),n_sites,4) if probs else np.zeros((0,0,4),dtype=np.float16)
+    return nodes,site_order.astype(np.int64),states,probs
+
+def get_state_cache_dir(state_file):
+    return f"{state_file}.arrays"
+
+def read_state_cache(cache_dir,source,sites=None):
+    """
+    the cached arrays, memory-mapped, if they are from the same state file (same
+    size and modification time) and hold every site asked for, otherwise None
+    """
+    try:
+        if not np.array_equal(np.load(os.path.join(cache_dir,"source.npy")),source):
+            return None
+        parsed_sites = np.load(os.path.join(cache_dir,"parsed_sites.npy"))
+    except (OSError,ValueError):
+        return None
+    # parsed_sites is empty when every site of the state file was parsed
+    if len(parsed_sites) and (sites is None or not np.isin(sites,parsed_sites).all()):
+        return None
+    return {name:np.load(os.path.join(cache_dir,f"{name}.npy"),mmap_mode="r") for name in ["nodes","sites","states","probs"]}
+
+def write_state_cache(cache_dir,source,sites,nodes,state_sites,states,probs):
+    # source is written last, so a partly written cache is never read
+    os.makedirs(cache_dir,exist_ok=True)
+    source_file = os.path.join(cache_dir,"source.npy")
+    if os.path.exists(source_file):
+        os.remove(source_file)
+    parsed_sites = np.zeros(0,dtype=np.int64) if sites is None else np.asarray(sites,dtype=np.int64)
+    for name,array in [("nodes",np.array(nodes)),("sites",state_sites),("states",states),
+                       ("probs",probs),("parsed_sites",parsed_sites),("source",source)]:
+        outfile = os.path.join(cache_dir,f"{name}.npy")
+        with open(f"{outfile}.tmp","wb") as fw:
+            np.save(fw,array)
+        os.replace(f"{outfile}.tmp",outfile)
+
+def load_state_file(state_file,sites=None,with_probs=False):
+    """
+    loads an iqtree .state file through a <state_file>.arrays sidecar of .npy
+    arrays, written the first time the file is parsed and reused while the
+    state file is unchanged (same size and modification time) and holds the
+    sites asked for. the states and probabilities are memory-mapped, so only
+    the parts a caller reads are loaded. if sites are given only those are
+    parsed (and cached), and the arrays returned may hold other sites too
+    """
+    cache_dir = get_state_cache_dir(state_file)
+    stat = os.stat(state_file)
+    source = np.array([stat.st_size,stat.st_mtime_ns],dtype=np.int64)
+
+    cached = read_state_cache(cache_dir,source,sites)
+    if cached is not None:
+        nodes = [str(i) for i in cached["nodes"]]
+        loaded = [nodes,np.array(cached["sites"]),cached["states"]]
+        if with_probs:
+            loaded.append(cached["probs"])
+        return loaded
+
+    nodes,state_sites,states,probs = parse_state_file(state_file,sites)
+    try:
+        write_state_cache(cache_dir,source,sites,nodes,state_sites,states,probs)
+    except OSError:
+        print(cyan(f"Note: could not write state file cache to {cache_dir}."))
+
+    if with_probs:
+        return [nodes,state_sites,states,probs]
+    return [nodes,state_sites,states]
+
+
+def find_needed_sites(alignment,context=2):
+    """
+    1-based sites the reconstruction needs: where the tips carry more than one
+    unambiguous base (or none at all), plus context sites either side so the
+    dimer and codon around every snp can still be looked up
+    """
+    lowest = None
+    highest = None
+    for record in SeqIO.parse(alignment,"fasta"):
+        seq = np.frombuffer(str(record.seq).encode(),dtype=np.uint8)
+        is_base = np.isin(seq,BASES)
+        if lowest is None:
+            lowest = np.full(len(seq),255,dtype=np.uint8)
+            highest = np.zeros(len(seq),dtype=np.uint8)
+        elif len(seq) != len(lowest):
+            sys.stderr.write(cyan(f'Error: sequences in alignment are not all the same length: ') + f'{alignment}\n')
+            sys.exit(-1)
+        np.minimum(lowest,np.where(is_base,seq,255),out=lowest)
+        np.maximum(highest,np.where(is_base,seq,0),out=highest)
+
+    if lowest is None:
+        sys.stderr.write(cyan(f'Error: no sequences found in alignment: ') + f'{alignment}\n')
+        sys.exit(-1)
+
+    variable = (highest > lowest) | (highest == 0)
+    needed = variable.copy()
+    for offset in range(1,context+1):
+        needed[offset:] |= variable[:-offset]
+        needed[:-offset] |= variable[offset:]
+    return np.flatnonzero(needed) + 1
+
+def gap_cells(states,first_row=0):
+    """
+    flat indexes into a node x site matrix of the gap states in states, rows of
+    the matrix from first_row on
+    """
+    return np.flatnonzero(states == GAP_BYTE) + first_row*states.shape[1]
+
+
+class NodeStates:
+    """
+    Reconstructed states for every internal node and tip at every site of the
+    IQ-TREE state file, held as a node x site uint8 matrix of ascii codes.
+
+    Rows are the internal nodes (in state file order) followed by the tips (in
+    alignment order), columns are the sites in the order they appear in the state
+    file. Missing, N, gap and (for tips) ambiguous states are stored as 0, and
+    which of them were gaps is kept apart as flat indexes into the matrix
+    (gap_cells), so sequences can still be written with - where there was one.
+
+    The state file is read through load_state_file, so re-runs load the
+    cached arrays. If only some sites are needed, just those rows of the state
+    file are kept while it is parsed.
+    """
+
+    def __init__(self,names,sites,matrix,gaps=None):
+        self.names = list(names)
+        self.node_index = {name:i for i,name in enumerate(self.names)}
+        self.sites = np.asarray(sites,dtype=np.int64)
+        self.matrix = matrix
+        self.gaps = np.zeros(0,dtype=np.int64) if gaps is None else np.sort(np.asarray(gaps,dtype=np.int64))
+
+        # 1-based site -> column, -1 where the site is not in the state file
+        self.site_cols = np.full(int(self.sites.max(initial=0))+2,-1,dtype=np.int64)
+        self.site_cols[self.sites] = np.arange(len(self.sites))
+
+    @classmethod
+    def from_files(cls,state_file,alignment,sites=None):
+        ## first the reconstructed nodes
+        node_names,state_sites,states = load_state_file(state_file,sites)
+        if sites is not None:
+            cols = np.flatnonzero(np.isin(state_sites,sites))
+            state_sites = state_sites[cols]
+            states = np.array(states[:,cols])
+        else:
+            states = np.array(states)
+        gaps = [gap_cells(states)]
+        states[np.isin(states,EMPTY_STATES)] = 0
+        sites = state_sites
+
+        tip_ids = []
+        tip_rows = []
+
+        ## now the tips
+        for record in SeqIO.parse(alignment,"fasta"):
+            seq = np.frombuffer(str(record.seq).encode(),dtype=np.uint8)
+            if len(sites) and sites.max() > len(seq):
+                sys.stderr.write(cyan(f'Error: state file has sites beyond the end of the alignment: ') + f'{alignment}\n')
+                sys.exit(-1)
+            tip_ids.append(record.id)
+            tip_rows.append(seq[sites-1])
+
+        matrix = np.zeros((len(node_names)+len(tip_ids),len(sites)),dtype=np.uint8)
+        matrix[:len(node_names)] = states
+        if tip_rows:
+            tips = np.vstack(tip_rows)
+            gaps.append(gap_cells(tips,len(node_names)))
+            matrix[len(node_names):] = np.where(np.isin(tips,BASES),tips,0)
+
+        return cls(list(node_names)+tip_ids,sites,matrix,np.concatenate(gaps))
+
+    @classmethod
+    def from_shared_memory(cls,names,sites,shm_name,shape,gaps=None):
+        """
+        attaches to a matrix another process holds in shared memory (see shared),
+        without copying it
+        """
+        shm = shared_memory.SharedMemory(name=shm_name)
+        node_states = cls(names,sites,np.ndarray(shape,dtype=np.uint8,buffer=shm.buf),gaps)
+        node_states.shm = shm
+        return node_states
+
+    @contextlib.contextmanager
+    def shared(self):
+        """
+        moves the matrix into a shared memory block for the duration of the
+        with block, so worker processes can attach to it (from_shared_memory)
+        rather than each getting a copy. yields the arguments to attach with
+        """
+        shm = shared_memory.SharedMemory(create=True,size=max(self.matrix.nbytes,1))
+        shape = self.matrix.shape
+        shared_matrix = np.ndarray(shape,dtype=np.uint8,buffer=shm.buf)
+        shared_matrix[:] = self.matrix
+        self.matrix = shared_matrix
+        try:
+            yield (self.names,self.sites,shm.name,shape,self.gaps)
+        finally:
+            self.matrix = np.array(shared_matrix)
+            del shared_matrix
+            shm.close()
+            shm.unlink()
+
+    def __contains__(self,node):
+        return node in self.node_index
+
+    def col(self,site):
+        site = int(site)
+        if site < 0 or site >= len(self.site_cols):
+            return -1
+        return int(self.site_cols[site])
+
+    def cols(self,sites):
+        """
+        columns for an array of 1-based sites, -1 where a site is not in the state file
+        """
+        sites = np.asarray(sites,dtype=np.int64)
+        inside = (sites >= 0) & (sites < len(self.site_cols))
+        return np.where(inside,self.site_cols[np.where(inside,sites,0)],-1)
+
+    def gather(self,rows,sites):
+        """
+        states of each row at each of its sites (rows of the sites array), 0 where
+        a site is not in the state file
+        """
+        cols = self.cols(sites)
+        states = self.matrix[np.asarray(rows,dtype=np.int64)[:,None],np.maximum(cols,0)]
+        states[cols == -1] = 0
+        return states
+
+    def base(self,node,site):
+        """
+        the state of a node at a 1-based site, "" if empty or the site is not in the state file
+        """
+        col = self.col(site)
+        if col == -1:
+            return ""
+        return STATE_STRINGS[self.matrix[self.node_index[node],col]]
+
+    def bases(self,node,sites):
+        """
+        the non-empty states of a node at the given sites joined into one string,
+        used to build codons
+        """
+        return "".join(self.base(node,site) for site in sites)
+
+    def sequence(self,node,length=None):
+        """
+        the node's states as a sequence string (position i is site i+1), - where
+        the state was a gap and N at sites not in the state file or with any
+        other empty state
+        """
+        if length is None:
+            length = int(self.sites.max(initial=0))
+        row = self.node_index[node]
+        n_cols = len(self.sites)
+        states = np.where(self.matrix[row] != 0,self.matrix[row],ord("N"))
+        start,end = np.searchsorted(self.gaps,[row*n_cols,(row+1)*n_cols])
+        states[self.gaps[start:end]-row*n_cols] = GAP_BYTE
+
+        seq = np.full(length,ord("N"),dtype=np.uint8)
+        held = self.sites <= length
+        seq[self.sites[held]-1] = states[held]
+        return seq.tobytes().decode()
+
+    def sorted_rows(self):
+        """
+        row indexes ordered by node name, the column order of the state differences csv
+        """
+        return sorted(range(len(self.names)),key=lambda i: self.names[i])
+
+    def varying_cols(self,block_width=4096):
+        """
+        columns where more than one distinct non-empty state is seen across all nodes and tips
+        """
+        varying = []
+        for start in range(0,self.matrix.shape[1],block_width):
+            block = self.matrix[:,start:start+block_width]
+            lowest = np.where(block != 0,block,255).min(axis=0)
+            varying.append(block.max(axis=0) > lowest)
+        if not varying:
+            return np.zeros(0,dtype=np.int64)
+        return np.flatnonzero(np.concatenate(varying))
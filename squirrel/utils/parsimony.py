@@ -0,0 +1,118 @@
+#!/usr/bin/env python3
+import sys
+import numpy as np
+from Bio import SeqIO
+
+from squirrel.utils.log_colours import green,cyan
+from squirrel.utils.node_states import NodeStates,find_needed_sites,gap_cells
+from squirrel.utils.alignment_matrix import BASES
+from squirrel.utils.tree_arrays import load_tree
+
+# bases as 4-bit sets (A=1, C=2, G=4, T=8), ambiguity codes as the bases they
+# allow and anything else (N, gaps) as every base
+BASE_BITS = np.full(256,15,dtype=np.uint8)
+for codes,bits in [("A",1),("C",2),("G",4),("T",8),("R",5),("Y",10),("S",6),("W",9),
+                   ("K",12),("M",3),("B",14),("D",13),("H",11),("V",7)]:
+    BASE_BITS[ord(codes)] = bits
+    BASE_BITS[ord(codes.lower())] = bits
+BIT_BASES = np.frombuffer(b"ACGT",dtype=np.uint8)
+
+
+def fitch_sets(tree,tip_sets):
+    """
+    bottom-up fitch pass over the tree for every column at once. a node's set is
+    the bases shared by the most children (the intersection of two children
+    when it is not empty, their union otherwise)
+    returns a node x column array of 4-bit sets
+    """
+    sets = np.zeros((len(tree),tip_sets.shape[1]),dtype=np.uint8)
+    sets[tree.tips] = tip_sets
+    bits = np.array([1,2,4,8],dtype=np.uint8)
+    for node in tree.postorder:
+        if tree.is_leaf[node]:
+            continue
+        children = tree.node_children(node)
+        if len(children) == 2:
+            shared = sets[children[0]] & sets[children[1]]
+            sets[node] = np.where(shared > 0,shared,sets[children[0]] | sets[children[1]])
+            continue
+        counts = ((sets[children][:,:,None] & bits) > 0).sum(axis=0)
+        best = counts == counts.max(axis=1,keepdims=True)
+        sets[node] = (best*bits).sum(axis=1)
+    return sets
+
+def fitch_states(tree,sets,preference):
+    """
+    top-down pass choosing one base per node and column: the parent's base where
+    the node's set allows it, otherwise the allowed base ranked first in
+    preference (a column x 4 rank of A, C, G and T, lower is preferred)
+    returns a node x column uint8 matrix of ascii codes
+    """
+    states = np.zeros((len(tree),sets.shape[1]),dtype=np.uint8)
+    bits = np.array([1,2,4,8],dtype=np.uint8)
+
+    def preferred(node_sets,ranks):
+        ranked = np.where((node_sets[:,None] & bits) > 0,ranks,len(bits))
+        return BIT_BASES[ranked.argmin(axis=1)]
+
+    states[tree.root] = preferred(sets[tree.root],preference)
+    for node in tree.preorder[1:]:
+        parent_states = states[tree.parent[node]]
+        change = np.flatnonzero((sets[node] & BASE_BITS[parent_states]) == 0)
+        states[node] = parent_states
+        if len(change):
+            states[node,change] = preferred(sets[node,change],preference[change])
+    return states
+
+def reconstruct_node_states(treefile,alignment,sites=None,block_width=4096):
+    """
+    maximum parsimony ancestral states for the internal nodes of the tree,
+    from the tips in the alignment, as NodeStates (the internal nodes followed by
+    every sequence in the alignment, as for an IQ-TREE state file)
+    only the columns the reconstruction needs are reconstructed (see
+    find_needed_sites), in blocks of columns. ties are broken towards the base
+    seen most often at the column, then A, C, G, T
+    """
+    tree = load_tree(treefile)
+    if sites is None:
+        sites = find_needed_sites(alignment)
+    sites = np.asarray(sites,dtype=np.int64)
+
+    tip_ids = []
+    tip_rows = []
+    for record in SeqIO.parse(alignment,"fasta"):
+        seq = np.frombuffer(str(record.seq).encode(),dtype=np.uint8)
+        if len(sites) and sites.max() > len(seq):
+            sys.stderr.write(cyan(f'Error: sites beyond the end of the alignment: ') + f'{alignment}\n')
+            sys.exit(-1)
+        tip_ids.append(record.id)
+        tip_rows.append(seq[sites-1])
+    tip_bases = np.vstack(tip_rows) if tip_rows else np.zeros((0,len(sites)),dtype=np.uint8)
+
+    tip_index = {name:i for i,name in enumerate(tip_ids)}
+    missing = [tree.names[tip] for tip in tree.tips if tree.names[tip] not in tip_index]
+    if missing:
+        sys.stderr.write(cyan(f'Error: tips in the tree are missing from the alignment: ') + f'{", ".join(missing)}\n')
+        sys.exit(-1)
+    tree_tip_bases = tip_bases[[tip_index[tree.names[tip]] for tip in tree.tips]]
+
+    internal = np.flatnonzero(~tree.is_leaf)
+    node_names = [tree.names[node] for node in internal]
+    matrix = np.zeros((len(internal)+len(tip_ids),len(sites)),dtype=np.uint8)
+
+    for start in range(0,len(sites),block_width):
+        block = tree_tip_bases[:,start:start+block_width]
+        # bases ranked by how often they are seen at each column in the tips of
+        # the tree, to break ties. columns with no base at all are left empty (0)
+        counts = np.stack([(BASE_BITS[block] == bit).sum(axis=0) for bit in [1,2,4,8]],axis=1)
+        preference = np.argsort(np.argsort(-counts,axis=1,kind="stable"),axis=1)
+
+        states = fitch_states(tree,fitch_sets(tree,BASE_BITS[block]),preference)
+        states[:,counts.sum(axis=1) == 0] = 0
+        matrix[:len(internal),start:start+block_width] = states[internal]
+
+    if len(tip_ids):
+        matrix[len(internal):] = np.where(np.isin(tip_bases,BASES),tip_bases,0)
+
+    print(green("Parsimony reconstruction: ") + f"{len(internal)} internal nodes at {len(sites)} sites")
+    return NodeStates(node_names+tip_ids,sites,matrix,gap_cells(tip_bases,len(internal)))
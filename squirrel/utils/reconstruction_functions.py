@@ -1,6 +1,15 @@
 import os
 from squirrel.utils.config import *
 from squirrel.utils.log_colours import green,cyan
+from squirrel.utils.branch_snp_index import BranchSNPIndex,first_appearance_codes
+from squirrel.utils.reconstruction_result import ReconstructionResult,get_reconstruction_result_file,read_state_differences
+from squirrel.utils.node_states import NodeStates,STATE_STRINGS,find_needed_sites
+from squirrel.utils.alignment_matrix import BASES
+from squirrel.utils.tree_arrays import load_tree
+from squirrel.utils.parsimony import reconstruct_node_states
+from squirrel.utils.apobec_context import GA_TARGET,TC_TARGET,node_context,reference_targets,snp_contexts
+import squirrel.utils.columnar as columnar
+from squirrel.utils.gene_model import GeneModel,get_gene_boundaries,get_grantham_scores,categorise_amino_acid_mutation
 import warnings
 from Bio import BiopythonWarning
 warnings.simplefilter('ignore', BiopythonWarning)
@@ -8,8 +17,6 @@ warnings.simplefilter('ignore', BiopythonWarning)
 from Bio import AlignIO
 from Bio import SeqIO
 from Bio.Seq import Seq
-from datetime import date
-import datetime as dt
 
 import csv
 
@@ -23,6 +30,8 @@ import pandas as pd
 import matplotlib.patches as patches
 
 import math
+import contextlib
+import multiprocessing as mp
 plt.switch_backend('Agg') 
 
 
@@ -37,162 +46,126 @@ plt.rcParams['font.family'] = 'Helvetica'
     
 def get_node_states_all_sites(state_file,alignment):
     
-    #returns a dict keys off 1-based positions in the genome
-    #and the value is a list of tuples (id, base) at a given node
-    # allows you to look up for a given site what the base is for a
-    #given internal node or tip
-    
-    node_states = collections.defaultdict(list)
-    c = 0
-    
-    ## first the reconstructed nodes
-    with open(state_file,"r") as f:
-        for l in f:
-
-            if not l.startswith("#"):
-                c+=1
-                try:
-                    node,site,state,probA,probC,probG,probT = l.rstrip("\n").split("\t")
-                except:
-                    print(l)
-                    break
-                if node != "Node":
-                    if state not in ["N","-"]:
-                        node_states[site].append((node,state))
-                    else:
-                        node_states[site].append((node,""))
-    ## now the tips
-    for record in SeqIO.parse(alignment,"fasta"):
-        for site in node_states:
-            index = int(site)-1
-            base = record.seq[index]
-            if base in ["T","C","A","G"]:
-                node_states[site].append((record.id,base))
-            else:
-                node_states[site].append((record.id,""))
-                
-    return node_states
-
-def get_header_str(dict_values):
-    header_str = ""
-    for i in sorted(dict_values, key = lambda i : i[0]):
-        header_str += f"{i[0]},"
-    header_str = header_str.rstrip(",")
-    return header_str
-    
-    
-def find_what_sites_vary_unambiguously(node_states,state_differences):
-    header_str = get_header_str(node_states["1"])
-    
-    with open(state_differences,"w") as fw:
-        fw.write(f"site,{header_str}\n")
-
-        for site in node_states:
-            info = node_states[site]
-            
-            # get the set of unique bases at a given site
-            count = set([i[1] for i in info if i[1]])
-            
-            #if there's more than one
-            if len(count)>1:
-                
-                #needs to be kep consistent with header str
-                info = sorted(info, key = lambda i : i[0])
-                base_str = ""
-                for i in info:
-                    base_str += f"{i[1]},"
-                    
-                base_str = base_str.rstrip(",")
-                fw.write(f"{site},{base_str}\n")
-    
-def load_unambiguous_varying_sites(infile):
-    node_states_diff = collections.defaultdict(dict)
-    with open(infile,"r") as f:
-        reader = csv.DictReader(f)
-        for row in reader:
-            site = row["site"]
-            for col in row:
-                if col != "site":
-                    node_states_diff[row["site"]][col] = row[col]
-    return node_states_diff
-
-def map_site_changes_to_branches(treefile, outfile,node_states,node_states_diff): 
-    my_tree=bt.loadNewick(treefile,absoluteTime=False)
-    last_node = ""
-    current_node = ""
-
-    with open(outfile,"w") as fw:
-        fw.write("parent,child,site,snp,dimer\n")
-
-        for k in my_tree.Objects:
-            if k.branchType == 'leaf':
-                current_node = k
-                current_node.traits["label"]=k.name
-            else:
-                current_node = k
-
-            if last_node:
-                node_name = current_node.traits["label"]
-                parent_name = current_node.parent.traits["label"]
-                snps = []
-                for site in node_states_diff:
-                    node_base = node_states_diff[site][node_name]
-                    parent_base = node_states_diff[site][parent_name]
-
-                    if node_base != parent_base:
-                        if node_base in ["A","C","G","T"] and parent_base in ["A","C","G","T"]:
-                            snp = f"{parent_base}->{node_base}"
-                            snps.append(snp)
-                            if snp == "G->A":
-                                dimer_site = f"{int(site)+1}"
-                                dimer_base = ""
-
-                                for i in node_states[dimer_site]:
-                                    if i[0] == parent_name:
-                                        dimer_base = i[1]
-                                dimer = f"{parent_base}{dimer_base}"
-                            elif snp == "C->T":
-                                dimer_site = f"{int(site)-1}"
-                                dimer_base = ""
-
-                                for i in node_states[dimer_site]:
-                                    if i[0] == parent_name:
-                                        dimer_base = i[1]
-                                dimer = f"{dimer_base}{parent_base}"
-                            else:
-                                dimer = ""
-                            fw.write(f"{parent_name},{node_name},{site},{snp},{dimer}\n")
-
-            last_node = current_node
-
-def read_in_branch_snps(branch_snps):
-    branch_snps_dict = collections.defaultdict(list)
-    with open(branch_snps,"r") as f:
-        reader = csv.DictReader(f)
-        for row in reader:
-            branch = f"{row['parent']}_{row['child']}"
-            branch_snps_dict[branch].append((row['site'],row['snp'],row['dimer'])) 
-    return branch_snps_dict
-
-def get_branch_snps_sites(branch_snps):
-    all_snps = collections.Counter()
-    branch_snps_dict = collections.defaultdict(list)
-    with open(branch_snps,"r") as f:
-        reader = csv.DictReader(f)
-        for row in reader:
-            all_snps[int(row["site"])]+=1
-
-            branch_snps_dict[int(row['site'])].append([row['parent'],row['child'],row['snp'],row['dimer']])
-    
-    homoplasies = {}
-    for k in all_snps:
-        if all_snps[k]>1:
-            homoplasies[k] = all_snps[k]
-            
-    # print(len(homoplasies))
-    # print(homoplasies)
-    return branch_snps_dict,homoplasies
-    
+    #returns a node x site matrix of the reconstructed states for every
+    #internal node and tip, so for a given site you can look up what the
+    #base is for a given internal node or tip (see NodeStates)
+    #only sites that vary in the alignment (and their dimer/codon neighbours)
+    #are parsed from the state file
+    
+    sites = find_needed_sites(alignment)
+    return NodeStates.from_files(state_file,alignment,sites)
+
+def get_branches(treefile):
+    # (parent, child) for every branch, in the order of the tree objects
+    return load_tree(treefile).branches()
+
+def init_reconstruction_worker(node_states_spec):
+    # worker processes attach to the node states the main process holds in shared memory
+    global WORKER_NODE_STATES
+    WORKER_NODE_STATES = NodeStates.from_shared_memory(*node_states_spec)
+
+def use_node_states(node_states):
+    # the same, for work run in the main process
+    global WORKER_NODE_STATES
+    WORKER_NODE_STATES = node_states
+
+@contextlib.contextmanager
+def reconstruction_pool(node_states,threads=1):
+    """
+    a process pool of threads workers sharing the node x site states through
+    shared memory, for the branch snp and amino acid work of the reconstruction.
+    with one thread there is no pool (None) and the work runs in this process
+    """
+    use_node_states(node_states)
+    if threads <= 1:
+        yield None
+        return
+    with node_states.shared() as spec:
+        with mp.Pool(threads,initializer=init_reconstruction_worker,initargs=(spec,)) as pool:
+            yield pool
+
+def run_chunks(pool,function,chunks):
+    """
+    yields function(chunk) for each chunk in order. with a pool at most two
+    chunks per worker are submitted and not yet taken, so chunks are only
+    made and results only held as fast as the caller uses them
+    """
+    if pool is None:
+        yield from map(function,chunks)
+        return
+    in_flight = collections.deque()
+    for chunk in chunks:
+        in_flight.append(pool.apply_async(function,(chunk,)))
+        if len(in_flight) >= pool._processes*2:
+            yield in_flight.popleft().get()
+    while in_flight:
+        yield in_flight.popleft().get()
+
+def call_branch_snps(chunk):
+    """
+    compares parent and child states over every varying site for a chunk of
+    branches at once, returns the branch, site index, snp, dimer and apobec3
+    context of every change as arrays. snps and dimers are packed as two ascii
+    codes (first*256 + second)
+    """
+    start,parents,children,varying_cols,sites = chunk
+    node_states = WORKER_NODE_STATES
+
+    parent_states = node_states.matrix[parents[:,None],varying_cols]
+    child_states = node_states.matrix[children[:,None],varying_cols]
+    changed = (parent_states != child_states) & np.isin(parent_states,BASES) & np.isin(child_states,BASES)
+
+    # row-major, so by branch and then by site as in the state differences
+    branch_idx,site_idx = np.nonzero(changed)
+    parent_bases = parent_states[branch_idx,site_idx]
+    child_bases = child_states[branch_idx,site_idx]
+
+    # parent states either side of each site and the parent's apobec3 target
+    # code there, for the G->A and C->T dimers
+    next_states,prev_states,targets = node_context(node_states,sites,parents)
+    g_to_a = (parent_bases == ord("G")) & (child_bases == ord("A"))
+    c_to_t = (parent_bases == ord("C")) & (child_bases == ord("T"))
+    dimer_bases = np.where(g_to_a,next_states[branch_idx,site_idx],
+                           np.where(c_to_t,prev_states[branch_idx,site_idx],0)).astype(np.int64)
+
+    parent_bases = parent_bases.astype(np.int64)
+    snps = parent_bases*256 + child_bases
+    dimers = np.where(g_to_a,parent_bases*256 + dimer_bases,np.where(c_to_t,dimer_bases*256 + parent_bases,0))
+    contexts = snp_contexts(parent_bases,child_bases,targets[branch_idx,site_idx])
+    return branch_idx+start,site_idx,snps,dimers,contexts
+
+def map_site_changes_to_branches(treefile,node_states,threads=1,chunk_size=256,pool=None):
+    """
+    finds every snp on every branch of the tree, returned as a BranchSNPIndex
+    with the rows in branch order and then site order. chunks of branches are
+    split across the pool (see reconstruction_pool) if one is given, or else
+    one is made for threads
+    """
+    if pool is None and threads > 1:
+        with reconstruction_pool(node_states,threads) as pool:
+            return map_site_changes_to_branches(treefile,node_states,threads,chunk_size,pool)
+    use_node_states(node_states)
+
+    branches = get_branches(treefile)
+    parent_rows = np.array([node_states.node_index[parent] for parent,child in branches],dtype=np.int64)
+    child_rows = np.array([node_states.node_index[child] for parent,child in branches],dtype=np.int64)
+
+    varying_cols = node_states.varying_cols()
+    sites = node_states.sites[varying_cols]
+
+    chunks = ((start,parent_rows[start:start+chunk_size],child_rows[start:start+chunk_size],varying_cols,sites)
+              for start in range(0,len(branches),chunk_size))
+    changes = list(run_chunks(pool,call_branch_snps,chunks))
+
+    empty = np.zeros(0,dtype=np.int64)
+    branch_idx,site_idx,snps,dimers,contexts = [np.concatenate([change[i] for change in changes]) if changes else empty for i in range(5)]
+
+    snp_idx,snp_keys = first_appearance_codes(snps)
+    dimer_idx,dimer_keys = first_appearance_codes(dimers)
+    return BranchSNPIndex(node_states.names,parent_rows[branch_idx],child_rows[branch_idx],sites[site_idx],
+                          [f"{chr(key >> 8)}->{chr(key & 255)}" for key in snp_keys],snp_idx,
+                          [f"{STATE_STRINGS[key >> 8]}{STATE_STRINGS[key & 255]}" for key in dimer_keys],dimer_idx,
+                          contexts)
 
 def get_acc_to_metadata_map(metadata):
     acc_dict = {}
@@ -219,8 +192,7 @@ def get_fig_height(alignment):
         return 15
 
 
-def make_reconstruction_tree_figure_w_labels(outfile,branch_snps,treefile,point_style,justification,w=None,h=None):
-    branch_snps_dict = read_in_branch_snps(branch_snps)
+def make_reconstruction_tree_figure_w_labels(outfile,branch_snp_index,treefile,point_style,justification,w=None,h=None):
     
     my_tree=bt.loadNewick(treefile,absoluteTime=False)
     plt.switch_backend('Agg') 
@@ -272,21 +244,16 @@ def make_reconstruction_tree_figure_w_labels(outfile,branch_snps,treefile,point_
     my_tree.addText(ax,x_attr=text_x_attr,target=target_func,text=text_func) #
 
     
-    for k in my_tree.Objects:
+    # the tree arrays number nodes in the order of my_tree.Objects
+    tree = load_tree(treefile)
+    for k,branch_name in zip(my_tree.Objects,tree.branch_names):
         current_node = k
-        if k.branchType == 'leaf':
-            current_node.traits["label"]=k.name
-
-        node_name = current_node.traits["label"]
-        try:
-            parent_name = current_node.parent.traits["label"]
-        except:
+        if branch_name is None:
             continue
-        branch_name= f"{parent_name}_{node_name}"
 
-        if branch_name in branch_snps_dict:
+        if branch_name in branch_snp_index:
             snps = []
-#                 print(branch_name, len(branch_snps_dict[branch_name]))
+#                 print(branch_name, len(branch_snp_index[branch_name]))
             right_settings = {
                 "apobec":(1,"#995E62"),
                 "non_apobec":(2,"#D9B660")
@@ -302,18 +269,9 @@ def make_reconstruction_tree_figure_w_labels(outfile,branch_snps,treefile,point_
                 setting_dict = left_settings
                 snp_placement = current_node.parent.height + increment/2
 
-            for s in branch_snps_dict[branch_name]:
-                site,snp,dimer = s
-                if snp == "G->A":
-                    if dimer in ["GA"]:
-                        snps.append(setting_dict["apobec"])
-                    else:
-                        snps.append(setting_dict["non_apobec"])
-                elif snp == "C->T":
-                    if dimer in ["TC"]:
-                        snps.append(setting_dict["apobec"])
-                    else:
-                        snps.append(setting_dict["non_apobec"])
+            for is_apobec in branch_snp_index.branch_apobec(branch_name):
+                if is_apobec:
+                    snps.append(setting_dict["apobec"])
                 else:
                     snps.append(setting_dict["non_apobec"])
 
@@ -341,464 +299,403 @@ def make_reconstruction_tree_figure_w_labels(outfile,branch_snps,treefile,point_
     plt.savefig(f"{outfile}.png",bbox_inches='tight'
                    );
     
-def generate_reconstruction_files(alignment, state_out, state_differences):
-    
-    node_states = get_node_states_all_sites(state_out,alignment)
-        
-    find_what_sites_vary_unambiguously(node_states,state_differences)
-
-    return node_states
-    
-def load_info(directory, alignment, treefile, state_out, state_differences, branch_snps_out, treefigureout,point_style,point_justify, node_states="",width=None,height=None):
-    
-    if not node_states:
-        node_states = get_node_states_all_sites(state_out, alignment)
-
-    node_states_diff = load_unambiguous_varying_sites(state_differences)
-
-    map_site_changes_to_branches(treefile,
-                                 branch_snps_out,
-                                 node_states,
-                                 node_states_diff)
-
-    make_reconstruction_tree_figure_w_labels(treefigureout,
-                                    branch_snps_out,
-                                    treefile,
-                                    point_style,
-                                    point_justify,
-                                    height,
-                                    width)
-    
-def get_gene_boundaries(gene_boundaries_file):
-    genes = {}
-    gene_id = 0
-    with open(gene_boundaries_file,"r") as f:
-        reader = csv.DictReader(f)
-        for row in reader:
-            gene_id +=1
-            name = f"{row['Name'].replace(' ','_')}_{gene_id}"
-            start = int(row["Minimum"])
-            end = int(row["Maximum"])+1
-            length = int(row["Length"])
-            direction = row["Direction"]
-            genes[(start,end)]=(name,length,direction)
-    return genes
-
-def get_grantham_scores(grantham_scores_file):
-    grantham_scores = {}
-
-    with open(grantham_scores_file,"r") as f:
-        reader = csv.DictReader(f, delimiter="\t")
-        for row in reader:
-            for col in row:
-                if col!="FIRST":
-                    mutation = f"{row['FIRST']}{col}"
-
-                    if row[col] != "0":
-                        grantham_scores[mutation] = int(row[col])                    
-                        grantham_scores[mutation[::-1]] = int(row[col])
-    return grantham_scores
- 
-    
-def categorise_amino_acid_mutation(aa1,aa2,grantham_scores):
-    
-    mutation_category = ""
-    if aa1 == aa2:
-        mutation_category = "synonymous"
-    else:
-        if aa2 == '*':
-            mutation_category = "nonsense"
-        else:
-            mutation_category = "nonsynonymous"
-
-    if f"{aa1}{aa2}" in grantham_scores:
-        score = grantham_scores[f"{aa1}{aa2}"]
-        if score < 51:
-            prediction = "conservative"
-        elif score <101:
-            prediction = "moderately conservative"
-        elif score <151:
-            prediction = "moderately radical"
-        else:
-            prediction = "radical"
-    else:
-        score = "NA"
-        prediction = "NA"
-    
-    return mutation_category,score,prediction
+def get_reconstruction_node_states(alignment, treefile, state_out, asr_tree=None):
+    """
+    the node states from the state file or, without one, reconstructed by
+    parsimony on asr_tree (the tree before the outgroup is pruned) or else the
+    tree itself
+    """
+    if state_out:
+        return get_node_states_all_sites(state_out,alignment)
+    return reconstruct_node_states(asr_tree or treefile,alignment)
+
+def generate_reconstruction_files(alignment, treefile, state_out, threads=1, asr_tree=None, node_states=None, pool=None):
+    """
+    runs the reconstruction in memory and persists it as the reconstruction
+    result npz next to the tree, for the stages that run after this process
+    """
+    if node_states is None:
+        node_states = get_reconstruction_node_states(alignment,treefile,state_out,asr_tree)
+    branch_snp_index = map_site_changes_to_branches(treefile,node_states,threads,pool=pool)
+
+    result = ReconstructionResult(node_states,branch_snp_index)
+    result.save(get_reconstruction_result_file(treefile))
+    return result
+    
+def load_info(result, treefile, state_differences, branch_snps_out, treefigureout,point_style,point_justify,width=None,height=None,pool=None):
+    """
+    writes the state difference and branch snp exports and the tree figure.
+    with a pool the figure is rendered by a worker while the exports are
+    written, and the pending figure is returned to wait on
+    """
+    figure_args = (treefigureout,result.branch_snp_index,treefile,point_style,point_justify,height,width)
+    figure = None
+    if pool is not None:
+        figure = pool.apply_async(make_reconstruction_tree_figure_w_labels,figure_args)
+
+    result.write_state_differences(state_differences)
+    result.write_branch_snps(branch_snps_out)
+
+    if figure is None:
+        make_reconstruction_tree_figure_w_labels(*figure_args)
+    return figure
+
+def format_amino_acid_rows(chunk):
+    """
+    the amino acid reconstruction csv lines for a chunk of (site, gene pair,
+    parent, child, snp, dimer, apobec) rows, with a pair of -1 for intergenic rows,
+    and the values they were written from (None for NA) if with_values
+    """
+    rows,gene_model,pair_gene,aa_positions,codon_sites,homoplasies,with_values = chunk
+    node_states = WORKER_NODE_STATES
+
+    # parent and child codons for all genic rows in one gather
+    genic = [row for row in rows if row[1] != -1]
+    genic_pairs = np.array([row[1] for row in genic],dtype=np.int64)
+    parent_codons = node_states.gather([node_states.node_index[row[2]] for row in genic],codon_sites[genic_pairs].reshape(-1,3))
+    child_codons = node_states.gather([node_states.node_index[row[3]] for row in genic],codon_sites[genic_pairs].reshape(-1,3))
+
+    values = []
+    genic_row = 0
+    for site,pair,parent,child,snp,dimer,is_apobec in rows:
+        homoplasy = False
+        occurrence = 1
+        if site in homoplasies:
+            homoplasy = True
+            occurrence = homoplasies[site]
 
-  
-def get_aa_position(index,based=0):
-    if based != 0:
-        index -= based 
+        apobec = bool(is_apobec)
 
-    remainder = index%3
-    position_dict = {1:2,2:3,0:1}
-    
-    return position_dict[remainder]
-
-def reverse_aa_position(start,end,site):
-    index_dict = {}
-    index = 0
-    rev_position_dict = {1:2,2:3,0:1}
-    for i in reversed(range(start,end)):
-        remainder = index%3
-        index_dict[i] = rev_position_dict[remainder]
-        index +=1 
-
-    position = index_dict[site]
-    
-    return position
+        if pair == -1:
+            values.append((site,None,None,snp,dimer,apobec,None,parent,None,None,child,None,None,"intergenic",None,None,homoplasy,occurrence))
+            continue
 
+        gene = pair_gene[pair]
+        name = gene_model.names[gene]
+        direction = gene_model.directions[gene]
+        forward = gene_model.forward[gene]
+        parent_codon,parent_aa = gene_model.translate("".join(STATE_STRINGS[parent_codons[genic_row]]),forward)
+        child_codon,child_aa = gene_model.translate("".join(STATE_STRINGS[child_codons[genic_row]]),forward)
+        genic_row += 1
+
+        mutation_category,score,prediction = gene_model.categorise(parent_aa,child_aa)
+        if score == "NA":
+            score,prediction = None,None
+
+        values.append((site,name,direction,snp,dimer,apobec,aa_positions[pair],parent,parent_codon,parent_aa,
+                       child,child_codon,child_aa,mutation_category,score,prediction,homoplasy,occurrence))
+    lines = "".join(columnar.format_csv_row(row) for row in values)
+    return lines,(values if with_values else None)
+
+def reconstruct_amino_acid_mutations(grantham_scores_file,gene_boundaries_file,branch_snp_index,node_states,outfile,pool=None,as_frame=False):
+    """
+    writes the amino acid reconstruction csv, and returns the same rows as a
+    typed table (for the parquet export) if as_frame
+    """
+    homoplasies = branch_snp_index.homoplasies()
+    gene_model = GeneModel.from_files(gene_boundaries_file,grantham_scores_file)
+
+    # every gene covering every snp site, with the codon each site sits in
+    site_values = np.array(branch_snp_index.site_list(),dtype=np.int64)
+    pair_site,pair_gene = gene_model.genes_at(site_values)
+    aa_positions,codon_sites = gene_model.codon_positions(site_values[pair_site],pair_gene)
+    pair_offsets = np.searchsorted(pair_site,np.arange(len(site_values)+1))
+
+    # one row per (gene, snp), in site order then gene order as in the output
+    rows = []
+    for i,site in enumerate(site_values):
+        site_snps = list(zip(branch_snp_index.site_snps(site),branch_snp_index.site_apobec(site)))
+        pairs = range(pair_offsets[i],pair_offsets[i+1])
+        if pairs:
+            for pair in pairs:
+                for site_snp,is_apobec in site_snps:
+                    rows.append((site,pair,*site_snp,is_apobec))
+        else:
+            for site_snp,is_apobec in site_snps:
+                rows.append((site,-1,*site_snp,is_apobec))
 
-def get_codon_indexes(aa_position,index):
-    codon = []
-    if aa_position == 1:
-        codon = [index,index+1,index+2]
-    elif aa_position == 2:
-        codon = [index-1,index,index+1]
-    elif aa_position == 3:
-        codon =  [index-2,index-1,index]
-    else:
-        print("incorrect aa position")
-        
-    return codon
-
-def get_codon_indexes_rev_strand(position,index):
-    codon = []
-    if position == 3:
-        codon = [index,index+1,index+2]
-    elif position == 2:
-        codon = [index-1,index,index+1]
-    elif position == 1:
-        codon =  [index-2,index-1,index]
-    return codon
-
-def reconstruct_amino_acid_mutations(grantham_scores_file,gene_boundaries_file,branch_snps,node_states,outfile):
-    branch_snps_dict,homoplasies = get_branch_snps_sites(branch_snps)
-    genes = get_gene_boundaries(gene_boundaries_file)
-    grantham_scores = get_grantham_scores(grantham_scores_file)
-    
-    fw = open(outfile,"w")
-    fw.write("site,gene,direction,snp,dimer,apobec,aa_position,parent,parent_codon,parent_aa,")
-    fw.write("child,child_codon,child_aa,mutation_category,score,prediction,homoplasy,occurrence\n")
-    
-    for site in branch_snps_dict:
-        
-        homoplasy = "False"
-        occurrence = "1"
-        if site in homoplasies:
-            homoplasy = "True"
-            occurrence = f"{homoplasies[site]}"
-        site_found = False
-        for gene in genes:
-            start,end=gene
+    # rows are formatted in chunks, split across the pool if there is one
+    use_node_states(node_states)
+    n_chunks = pool._processes*4 if pool is not None else 1
+    chunk_size = max(1,-(-len(rows)//n_chunks))
+    chunks = ((rows[start:start+chunk_size],gene_model,pair_gene,aa_positions,codon_sites,homoplasies,as_frame)
+              for start in range(0,len(rows),chunk_size))
 
-            if site in range(start,end):
-                
-                site_found = True
-                name,length,direction = genes[gene]
-                for site_snp in branch_snps_dict[site]:
-                    parent,child,snp,dimer = site_snp
-
-                    if direction == "forward":
-                        aa_position = get_aa_position(site,gene[0])
-                        codon_indexes = get_codon_indexes(aa_position,site)
-                    else:
-                        aa_position = reverse_aa_position(start,end,site)
-                        codon_indexes = get_codon_indexes_rev_strand(aa_position,site)
-
-                    parent_codon = []
-                    child_codon = []
-
-                    for base in codon_indexes:
-                        reconstruction = node_states[f"{base}"]
-                        for node in reconstruction:
-                            if node[0] == parent:
-                                parent_codon.append(node[1])
-
-                            elif node[0] == child:
-                                child_codon.append(node[1])
-
-                    parent_codon = "".join(parent_codon)
-                    child_codon = "".join(child_codon)
-
-                    parent_codon = Seq(parent_codon)
-                    child_codon = Seq(child_codon)
-
-                    if direction == "reverse":
-                        parent_codon= parent_codon.reverse_complement()
-                        child_codon= child_codon.reverse_complement()
-
-                    parent_aa = parent_codon.translate()
-                    child_aa = child_codon.translate()
-
-                    mutation_category,score,prediction = categorise_amino_acid_mutation(parent_aa,child_aa,grantham_scores)
-                    apobec = "False"
-                    if snp in ["C->T","G->A"] and dimer in ["GA","TC"]:
-                        apobec = "True"
-
-                    fw.write(f"{site},{name},{direction},{snp},{dimer},{apobec},{aa_position},{parent},{parent_codon},{parent_aa},{child},{child_codon},{child_aa},{mutation_category},{score},{prediction},{homoplasy},{occurrence}\n")                                    
-        
-        if not site_found:
-            for snp_site in branch_snps_dict[site]:
-                parent,child,snp,dimer = snp_site
-                apobec = "False"
-                if snp in ["C->T","G->A"] and dimer in ["GA","TC"]:
-                    apobec = "True"
-                fw.write(f"{site},NA,NA,{snp},{dimer},{apobec},NA,{parent},NA,NA,{child},NA,NA,intergenic,NA,NA,{homoplasy},{occurrence}\n")                                    
-            
-    fw.close()
+    values = []
+    with open(outfile,"w") as fw:
+        fw.write(f"{','.join(columnar.AMINO_ACID_DTYPES)}\n")
+        for lines,chunk_values in run_chunks(pool,format_amino_acid_rows,chunks):
+            fw.write(lines)
+            if as_frame:
+                values.extend(chunk_values)
+
+    if as_frame:
+        return columnar.rows_to_frame(values,columnar.AMINO_ACID_DTYPES)
             
-def get_reconstruction_amino_acids(alignment,grantham_scores_file,gene_boundaries_file,branch_snps_out,state_out,amino_acids_out,node_states=""):
-    if not node_states:
+def get_reconstruction_amino_acids(alignment,grantham_scores_file,gene_boundaries_file,branch_snp_index,state_out,amino_acids_out,node_states=None,pool=None,as_frame=False):
+    if node_states is None:
         node_states = get_node_states_all_sites(state_out,alignment)
 
-    reconstruct_amino_acid_mutations(grantham_scores_file,gene_boundaries_file,branch_snps_out,
-                                    node_states, amino_acids_out)
-    
-    
-def year_fraction(date):
-    start = dt.date(date.year, 1, 1).toordinal()
-    year_length = dt.date(date.year+1, 1, 1).toordinal() - start
-    return date.year + float(date.toordinal() - start) / year_length
-
-def get_root_to_tip_counts(aa_reconstruction,state_diffs,root_to_tip_counts):
-
-    site_info = {}
-    with open(aa_reconstruction,"r") as f:
-        reader = csv.DictReader(f)
-        for row in reader:
-            site_info[row["site"]] = row
+    return reconstruct_amino_acid_mutations(grantham_scores_file,gene_boundaries_file,branch_snp_index,
+                                            node_states, amino_acids_out, pool, as_frame)
+    
+    
+def parse_decimal_dates(datestrings):
+    """
+    dates (yyyy-mm-dd, yyyy-mm or yyyy) to decimal years in one pass
+    month dates are put mid-month and year dates mid-year. dates that
+    cannot be parsed are NA
+    returns the dates as used, the decimal years and the precision of each
+    """
+    datestrings = pd.Series(datestrings,dtype=object).fillna("").astype(str).str.strip()
+    is_day = datestrings.str.fullmatch(r"\d{4}-\d{1,2}-\d{1,2}")
+    is_month = datestrings.str.fullmatch(r"\d{4}-\d{1,2}")
+    is_year = datestrings.str.fullmatch(r"\d{4}(\.\d+)?")
+
+    dates = datestrings.where(~is_month,datestrings + np.where(datestrings.str.fullmatch(r"\d{4}-0?2"),"-15","-16"))
+    parsed = pd.to_datetime(dates.where(is_day | is_month),format="%Y-%m-%d",errors="coerce")
+    days_in_year = np.where(parsed.dt.is_leap_year,366,365)
+    decimal_year = parsed.dt.year + (parsed.dt.dayofyear - 1)/days_in_year
+    decimal_year = decimal_year.where(~is_year,pd.to_numeric(datestrings.where(is_year),errors="coerce") + 0.5)
+
+    precision = pd.Series(np.select([is_day & parsed.notna(),is_month & parsed.notna(),is_year],["day","month","year"],""),index=datestrings.index)
+    return pd.DataFrame({"date":dates,"decimal_year":decimal_year,"precision":precision})
+
+def get_tip_snp_counts(aa_reconstruction,state_diffs):
+    """
+    counts the snps each tip carries relative to the root, straight from the
+    sparse state differences (only the tips differing from the root at a site
+    are stored). sites count as apobec from the amino acid reconstruction and
+    sites missing from it, or empty at the tip or root, are not counted
+    returns all_snps, apobec_snps and non_apobec_snps per tip, in the order
+    tips are first seen and then the tips with no snps
+    """
+    site_info = pd.read_csv(aa_reconstruction,usecols=["site","apobec"],dtype={"site":np.int64,"apobec":str})
+    apobec = site_info.drop_duplicates("site",keep="last").set_index("site")["apobec"] == "True"
+
+    nodes,differences = read_state_differences(state_diffs)
+    is_root = ~differences["site"].duplicated()
+    root_state = differences["state"].where(is_root).ffill()
+    tip_snps = differences[~is_root & ~differences["node"].str.startswith("Node") &
+                           (differences["state"] != "") & (root_state != "") &
+                           differences["site"].isin(apobec.index)]
+
+    is_apobec = tip_snps["site"].map(apobec).to_numpy(dtype=bool)
+    counts = pd.DataFrame({"all_snps":1,"apobec_snps":is_apobec.astype(int),"non_apobec_snps":(~is_apobec).astype(int)},
+                          index=tip_snps["node"].to_numpy())
+    counts = counts.groupby(level=0,sort=False).sum()
+    tips = [node for node in nodes if not node.startswith("Node") and node not in counts.index]
+    return pd.concat([counts,pd.DataFrame(0,index=tips,columns=counts.columns)])
+
+def get_root_to_tip_counts(aa_reconstruction,state_diffs,root_to_tip_counts,date_dict=None):
+    """
+    total, apobec3 and non-apobec3 snps from the root to every tip, with each tip's
+    date as a decimal year. dates come from date_dict (tip name -> date) if given,
+    otherwise from the last | field of the tip name
+    """
+    counts = get_tip_snp_counts(aa_reconstruction,state_diffs)
+    names = counts.index.to_series()
+    if date_dict is not None:
+        datestrings = names.map(date_dict)
+    else:
+        datestrings = names.str.split("|").str[-1]
 
-    # for i in site_info:
-    #     print(i, site_info[i])
-
-    seq_snps = collections.defaultdict(list)
-    apobec_snps = collections.defaultdict(list)
-    non_apo = collections.defaultdict(list)
-    with open(state_diffs,"r") as f:
-        reader = csv.DictReader(f)
-
-        for row in reader:
-            root_variant = row["Node1"]
-
-            for seq in reader.fieldnames:
-                if seq != "site" and not seq.startswith("Node"):
-                    if row[seq] != root_variant:
-                        if "" not in [row[seq],root_variant]:
-                            try:
-                                snp_info = site_info[row["site"]]
-                                if snp_info["apobec"] == "True":
-                                    apobec_snps[seq].append(row["site"])
-                                else:
-                                    non_apo[seq].append(row["site"])
-                                seq_snps[seq].append(row["site"])
-                            except:
-                                pass
-    s = []
-    date_apo = {}
-    with open(root_to_tip_counts,"w") as fw:
-        fw.write("name,all_snps,apobec_snps,non_apobec_snps,date,decimal_year,precision\n")
-        for i in seq_snps:
-            datestring = i.split("|")[-1]
-            
-            precision = ""
-            
-            if len(datestring.split("-")) == 3:
-                ddate = date.fromisoformat(datestring)
-                odate = year_fraction(ddate)
-                
-                precision = "day"
-                print(datestring,odate,precision)
-            elif len(datestring.split("-")) == 2:
-                if datestring.endswith("-2"):
-                    datestring+="-15"
-                else:
-                    datestring+="-16"
-                ddate = date.fromisoformat(datestring)
-                odate = year_fraction(ddate)
-                
-                precision = "month"
-                print(datestring,odate,precision)
-            else:
-                
-                odate = float(datestring)+0.5
-                precision="year"
-                print(datestring,odate,precision)
-            if i in apobec_snps:
-                if i in non_apo:
-                    fw.write(f"{i},{len(seq_snps[i])},{len(apobec_snps[i])},{len(non_apo[i])},{datestring},{odate},{precision}\n")
-                else:
-                    fw.write(f"{i},{len(seq_snps[i])},{len(apobec_snps[i])},0,{datestring},{odate},{precision}\n")
-                date_apo[i] = [apobec_snps[i],datestring]
-            else:
-                if i in non_apo:
-                    fw.write(f"{i},{len(seq_snps[i])},0,{len(non_apo[i])},{datestring},{odate},{precision}\n")
-                else:
-                    fw.write(f"{i},{len(seq_snps[i])},0,0,{datestring},{odate},{precision}\n")
+    dates = parse_decimal_dates(datestrings.to_numpy())
+    table = pd.concat([pd.DataFrame({"name":names.to_numpy()}),counts.reset_index(drop=True),dates],axis=1)
+    undated = int(table["decimal_year"].isna().sum())
+    if undated:
+        print(cyan(f"Note: no usable date for {undated} tips, these are left out of the root-to-tip regression."))
 
+    table.to_csv(root_to_tip_counts,index=False,na_rep="NA")
+    return table
 
 def get_root_to_tip_counts_date_in(aa_reconstruction,state_diffs,root_to_tip_counts,date_dict):
-
-    site_info = {}
-    with open(aa_reconstruction,"r") as f:
-        reader = csv.DictReader(f)
-        for row in reader:
-            site_info[row["site"]] = row
-
-    # for i in site_info:
-    #     print(i, site_info[i])
-
-    seq_snps = collections.defaultdict(list)
-    apobec_snps = collections.defaultdict(list)
-    non_apo = collections.defaultdict(list)
-    with open(state_diffs,"r") as f:
-        reader = csv.DictReader(f)
-
-        for row in reader:
-            root_variant = row["Node1"]
-
-            for seq in reader.fieldnames:
-                if seq != "site" and not seq.startswith("Node"):
-                    if row[seq] != root_variant:
-                        if "" not in [row[seq],root_variant]:
-                            try:
-                                snp_info = site_info[row["site"]]
-                                if snp_info["apobec"] == "True":
-                                    apobec_snps[seq].append(row["site"])
-                                else:
-                                    non_apo[seq].append(row["site"])
-                                seq_snps[seq].append(row["site"])
-                            except:
-                                pass
-    s = []
-    date_apo = {}
-    fw2 = open(APO_out,"w")
-    fw2.write("name,date\n")
-    with open(root_to_tip_counts,"w") as fw:
-        fw.write("name,all_snps,apobec_snps,non_apobec_snps,date,decimal_year,precision\n")
-        for i in seq_snps:
-            datestring = date_dict[i]
-            
-            precision = ""
-            
-            if len(datestring.split("-")) == 3:
-                ddate = date.fromisoformat(datestring)
-                odate = year_fraction(ddate)
-                
-                precision = "day"
-                print(datestring,odate,precision)
-            elif len(datestring.split("-")) == 2:
-                if datestring.endswith("-2"):
-                    datestring+="-15"
-                else:
-                    datestring+="-16"
-                ddate = date.fromisoformat(datestring)
-                odate = year_fraction(ddate)
-                
-                precision = "month"
-                print(datestring,odate,precision)
-            else:
-                
-                odate = float(datestring)+0.5
-                precision="year"
-                print(datestring,odate,precision)
-            if i in apobec_snps:
-                if i in non_apo:
-                    fw.write(f"{i},{len(seq_snps[i])},{len(apobec_snps[i])},{len(non_apo[i])},{datestring},{odate},{precision}\n")
-                else:
-                    fw.write(f"{i},{len(seq_snps[i])},{len(apobec_snps[i])},0,{datestring},{odate},{precision}\n")
-                date_apo[i] = [apobec_snps[i],datestring]
-            else:
-                if i in non_apo:
-                    fw.write(f"{i},{len(seq_snps[i])},0,{len(non_apo[i])},{datestring},{odate},{precision}\n")
-                else:
-                    fw.write(f"{i},{len(seq_snps[i])},0,0,{datestring},{odate},{precision}\n")
-
-
-def run_full_analysis(directory, alignment, treefile,state_file,config,point_style,point_justify,width,height):
+    return get_root_to_tip_counts(aa_reconstruction,state_diffs,root_to_tip_counts,date_dict)
+
+def fit_root_to_tip_regression(table,outfile):
+    """
+    least squares fit of snps against decimal year over the dated tips, for all,
+    apobec3 and non-apobec3 snps. the slope is the substitution rate (snps per year)
+    and the x intercept the date of the root
+    """
+    dated = table[table["decimal_year"].notna()]
+    x = dated["decimal_year"].to_numpy(dtype=float)
+    fits = []
+    for snps in ["all_snps","apobec_snps","non_apobec_snps"]:
+        y = dated[snps].to_numpy(dtype=float)
+        fit = {"snps":snps,"n_tips":len(x),"slope":np.nan,"intercept":np.nan,"r_squared":np.nan,"root_date":np.nan}
+        if len(x) > 1 and np.ptp(x) > 0:
+            slope,intercept = np.polyfit(x,y,1)
+            fit["slope"] = slope
+            fit["intercept"] = intercept
+            if np.ptp(y) > 0:
+                fit["r_squared"] = np.corrcoef(x,y)[0,1]**2
+            if slope != 0:
+                fit["root_date"] = -intercept/slope
+        fits.append(fit)
+
+    fits = pd.DataFrame(fits)
+    fits.to_csv(outfile,index=False,na_rep="NA")
+    return fits
+
+def get_dates_from_metadata(metadata,id_column,date_column):
+    dates = pd.read_csv(metadata,usecols=[id_column,date_column],dtype=str,keep_default_na=False)
+    return dict(zip(dates[id_column],dates[date_column]))
+
+def run_root_to_tip(treefile,config):
+    aa_reconstruction = f"{treefile}.amino_acid.reconstruction.csv"
+    state_diffs = f"{treefile}.state_differences.csv"
+    root_to_tip_counts = f"{treefile}.root_to_tip.csv"
+    regression_out = f"{treefile}.root_to_tip_regression.csv"
+
+    date_dict = None
+    if config[KEY_DATE_METADATA]:
+        date_dict = get_dates_from_metadata(config[KEY_DATE_METADATA],config[KEY_METADATA_ID_COLUMN],config[KEY_METADATA_DATE_COLUMN])
+
+    table = get_root_to_tip_counts(aa_reconstruction,state_diffs,root_to_tip_counts,date_dict)
+    fits = fit_root_to_tip_regression(table,regression_out)
+    apobec_fit = fits[fits["snps"] == "apobec_snps"].iloc[0]
+    print(green("Root-to-tip APOBEC3 snps per year: ") + f"{apobec_fit['slope']:.3f} (R^2 {apobec_fit['r_squared']:.3f}, root date {apobec_fit['root_date']:.2f})")
+    return root_to_tip_counts,regression_out
+
+def run_full_analysis(directory, alignment, treefile,state_file,config,point_style,point_justify,width,height,asr_tree=None,threads=None):
+    """
+    the reconstruction stage. with more than one thread the node states are
+    put in shared memory for a pool of workers, which map the branch snps and
+    the amino acids in chunks and render the tree figure alongside the exports
+    """
+    if threads is None:
+        threads = config[KEY_THREADS]
 
     state_out = state_file
     state_differences = f"{treefile}.state_differences.csv"
     branch_snps_out = f"{treefile}.branch_snps.reconstruction.csv"
     amino_acids_out= f"{treefile}.amino_acid.reconstruction.csv"
 
-    node_states= generate_reconstruction_files(alignment,
-                                  state_out,
-                                  state_differences)
+    node_states = get_reconstruction_node_states(alignment,treefile,state_out,asr_tree)
+    with reconstruction_pool(node_states,threads) as pool:
+        result = generate_reconstruction_files(alignment,
+                                      treefile,
+                                      state_out,
+                                      threads,
+                                      asr_tree,
+                                      node_states,
+                                      pool)
+
+        tree_fig = f"{treefile}"
+        figure = load_info(result,treefile,state_differences,branch_snps_out,tree_fig,point_style,point_justify,width,height,pool)
+
+
+        grantham_scores_file = config[KEY_GRANTHAM_SCORES]
+        gene_boundaries_file = config[KEY_GENE_BOUNDARIES]
+        amino_acids = get_reconstruction_amino_acids(alignment,grantham_scores_file,gene_boundaries_file,result.branch_snp_index,
+                                                     state_out,amino_acids_out,result.node_states,pool,config[KEY_PARQUET])
+
+        # the parquet copies are built from the same rows and arrays as the csvs
+        if config[KEY_PARQUET]:
+            columnar.write_parquet(columnar.branch_snps_frame(result.branch_snp_index),columnar.get_parquet_file(branch_snps_out))
+            columnar.write_parquet(amino_acids,columnar.get_parquet_file(amino_acids_out))
+            columnar.write_parquet(columnar.state_differences_frame(result),columnar.get_parquet_file(state_differences))
+
+        if figure is not None:
+            figure.get()
+
+def get_partition_targets(reference_targets,apobec_ga_sites,apobec_tc_sites,non_apobec_sites):
+    """
+    apobec3 target code for every reference position, from the reference's
+    target codes (see apobec_context): GA_TARGET for GA targets (the G),
+    TC_TARGET for TC targets (the C) and 0 otherwise, GA first where a position
+    is both. reference targets are dropped where a non-apobec snp was
+    reconstructed, and sites of reconstructed GA/TC apobec snps are always targets
+    sites are 1-based index arrays
+    """
+    ref_len = len(reference_targets)
+    non_apobec = np.zeros(ref_len,dtype=bool)
+    non_apobec_sites = np.asarray(non_apobec_sites,dtype=np.int64)
+    non_apobec[non_apobec_sites[(non_apobec_sites >= 1) & (non_apobec_sites <= ref_len)] - 1] = True
+
+    ga = (reference_targets == GA_TARGET) & ~non_apobec
+    tc = (reference_targets == TC_TARGET) & ~non_apobec
+
+    for keep,sites in [(ga,apobec_ga_sites),(tc,apobec_tc_sites)]:
+        sites = np.asarray(sites,dtype=np.int64) - 1
+        keep[sites[(sites >= 0) & (sites < ref_len)]] = True
+
+    return np.where(ga,GA_TARGET,np.where(tc,TC_TARGET,0)).astype(np.uint8)
+
+def get_mask_runs(mask):
+    """
+    runs of the same code as 0-based half open (start, end) and the code of each run
+    """
+    if not len(mask):
+        return np.zeros(0,dtype=np.int64),np.zeros(0,dtype=np.int64),mask
+    starts = np.flatnonzero(np.r_[True,mask[1:] != mask[:-1]])
+    ends = np.r_[starts[1:],len(mask)]
+    return starts,ends,mask[starts]
+
+def write_binary_partition_mask(mask,outfile,reference_id,sep_status=False):
+    """
+    writes the mask as
+    - a string with one code per position (outfile)
+    - bit-packed arrays (.packed.npz): one bit per position for apobec3 targets,
+      and with sep_status a second bit array marking the TC targets
+    - runs (.rle.csv): 1-based start and end of every run of the same code
+    - bed (.bed): the apobec3 target regions, 0-based half open, named GA/TC with
+      sep_status and APOBEC3 otherwise
+    returns the paths written
+    """
+    stem = outfile[:-4] if outfile.endswith(".csv") else outfile
+    packed_out = f"{stem}.packed.npz"
+    rle_out = f"{stem}.rle.csv"
+    bed_out = f"{stem}.bed"
 
-    tree_fig = f"{treefile}"
-    load_info(directory,alignment,treefile,state_out,state_differences,branch_snps_out,tree_fig,point_style,point_justify,node_states,width,height)
-
-
-    grantham_scores_file = config[KEY_GRANTHAM_SCORES]
-    gene_boundaries_file = config[KEY_GENE_BOUNDARIES]
-    get_reconstruction_amino_acids(alignment,grantham_scores_file,gene_boundaries_file,branch_snps_out,state_out,amino_acids_out,node_states)
-
-def find_binary_partition_mask(branch_reconstruction,sep_status,reference,outfile):
-
-    apobec_variable_ga = set()
-    apobec_variable_tc = set()
-    non_apobec_variable =  set()
+    with open(outfile,"w") as fw:
+        fw.write((mask + ord("0")).tobytes().decode() + "\n")
 
+    packed = {"length":np.array(len(mask)),"apobec":np.packbits(mask > 0)}
     if sep_status:
-        tc_mask = "2"
-    else:
-        tc_mask = "1"
-
-    with open(branch_reconstruction,"r") as f:
-        reader = csv.DictReader(f)
-        for row in reader:
-            if row["dimer"] == "GA":
-                apobec_variable_ga.add(int(row['site']))
-            elif row["dimer"] == "TC":
-                apobec_variable_tc.add(int(row['site']))
-            else:
-                non_apobec_variable.add(int(row['site']))
-
-    ref = str(SeqIO.read(reference, 'fasta').seq)
-    pos = np.arange(len(ref))
-    
-    apo_ga_keep_0index = set()
-    apo_tc_keep_0index = set()
-    for i in pos:
-        if ref[i:i+2]=="GA":
-            if i+1 not in non_apobec_variable:
-                apo_ga_keep_0index.add(i)
-        elif ref[i:i+2]=="TC":
-            if i+2 not in non_apobec_variable:
-                apo_tc_keep_0index.add(i+1)
-
-    for i in apobec_variable_ga:
-        apo_ga_keep_0index.add(i-1)
-
-    for i in apobec_variable_tc:
-        apo_tc_keep_0index.add(i-1)
-
-    apo_masked = 0
-    non_apo_masked = 0
-    tc_masked = 0
-    ga_masked = 0
-    mask_string = ""
-    
-    for i in range(len(ref)):
-        if i not in apo_ga_keep_0index and i not in apo_tc_keep_0index:
-            mask_string+="0"
-            non_apo_masked +=1
-        elif i in apo_ga_keep_0index:
-            mask_string+="1"
-            apo_masked +=1
-            ga_masked +=1
-        elif i in apo_tc_keep_0index:
-            mask_string+=tc_mask
-            apo_masked +=1
-            tc_masked +=1
+        packed["tc"] = np.packbits(mask == 2)
+    np.savez(packed_out,**packed)
+
+    starts,ends,codes = get_mask_runs(mask)
+    with open(rle_out,"w") as fw:
+        fw.write("start,end,value\n")
+        fw.writelines(f"{start+1},{end},{code}\n" for start,end,code in zip(starts.tolist(),ends.tolist(),codes.tolist()))
+
+    names = {1:"GA",2:"TC"} if sep_status else {1:"APOBEC3"}
+    with open(bed_out,"w") as fw:
+        fw.writelines(f"{reference_id}\t{start}\t{end}\t{names[code]}\n" for start,end,code in zip(starts.tolist(),ends.tolist(),codes.tolist()) if code)
+
+    return [outfile,packed_out,rle_out,bed_out]
+
+def load_packed_partition_mask(packed_file):
+    with np.load(packed_file) as packed:
+        length = int(packed["length"])
+        mask = np.unpackbits(packed["apobec"],count=length).astype(np.uint8)
+        if "tc" in packed:
+            mask[np.unpackbits(packed["tc"],count=length).astype(bool)] = 2
+    return mask
+
+def find_binary_partition_mask(branch_snp_index,sep_status,reference,outfile):
+    """
+    builds the binary partition mask from the reconstructed branch snps (held in
+    a BranchSNPIndex, e.g. from the reconstruction result) and the reference fasta
+    """
+    sites = branch_snp_index.sites.astype(np.int64)
+    is_ga = branch_snp_index.apobec == GA_TARGET
+    is_tc = branch_snp_index.apobec == TC_TARGET
+
+    record = SeqIO.read(reference,"fasta")
+    reference_seq = np.frombuffer(str(record.seq).encode(),dtype=np.uint8)
+    targets = get_partition_targets(reference_targets(reference_seq),sites[is_ga],sites[is_tc],sites[~is_ga & ~is_tc])
+
+    ga_masked = int((targets == GA_TARGET).sum())
+    tc_masked = int((targets == TC_TARGET).sum())
     print("TC sites",tc_masked)
     print("GA sites",ga_masked)
-    print("All APOBEC3 sites",apo_masked)
-    print("Non APOBEC3 sites",non_apo_masked)
+    print("All APOBEC3 sites",ga_masked + tc_masked)
+    print("Non APOBEC3 sites",len(targets) - ga_masked - tc_masked)
 
-    with open(outfile,"w") as fw:
-        fw.write(mask_string + "\n")
-    
\ No newline at end of file
+    mask = targets if sep_status else (targets > 0).astype(np.uint8)
+    write_binary_partition_mask(mask,outfile,record.id,sep_status)
+    return mask
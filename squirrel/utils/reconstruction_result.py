@@ -0,0 +1,139 @@
+#!/usr/bin/env python3
+import os
+import sys
+import numpy as np
+import pandas as pd
+
+from squirrel.utils.log_colours import green,cyan
+from squirrel.utils.branch_snp_index import BranchSNPIndex
+from squirrel.utils.node_states import NodeStates,STATE_STRINGS
+
+
+ROOT_NODE = "Node1"
+
+
+def get_reconstruction_result_file(treefile):
+    return f"{treefile}.reconstruction.npz"
+
+def read_state_differences(infile):
+    """
+    reads the sparse state differences csv
+    returns the node and tip names (in the order of the wide view) and a
+    site,node,state table where the first row for each site is the root state
+    and the other rows are the nodes and tips whose state differs from it
+    """
+    with open(infile,"r") as f:
+        header = f.readline().rstrip("\n").split(",")
+        if header[0] != "#nodes":
+            sys.stderr.write(cyan(f'Error: not a sparse state differences file: ') + f'{infile}\n')
+            sys.exit(-1)
+        differences = pd.read_csv(f,dtype={"site":np.int64,"node":str,"state":str},keep_default_na=False)
+    return header[1:],differences
+
+def load_state_differences(infile):
+    """
+    the state differences as the full site x node table (one column per node and
+    tip), with every cell not stored in the sparse file filled with the root state
+    """
+    nodes,differences = read_state_differences(infile)
+    is_root = ~differences["site"].duplicated()
+    sites = differences["site"][is_root].to_numpy()
+
+    table = np.repeat(differences["state"][is_root].to_numpy(dtype=object)[:,None],len(nodes),axis=1)
+    node_index = pd.Index(nodes)
+    site_rows = np.cumsum(is_root.to_numpy()) - 1
+    changed = differences[~is_root]
+    table[site_rows[~is_root.to_numpy()],node_index.get_indexer(changed["node"])] = changed["state"].to_numpy(dtype=object)
+    return pd.DataFrame(table,index=pd.Index(sites,name="site"),columns=nodes)
+
+
+class ReconstructionResult:
+    """
+    Everything the reconstruction stage hands on to later stages: the node x site
+    states (NodeStates) and the branch snps (BranchSNPIndex).
+
+    Within a process it is passed around in memory. Across the Snakemake/CLI
+    boundary it is persisted as one npz of the underlying arrays, so later
+    stages (phylo QC, partition masks) load arrays rather than parsing csvs.
+    The state differences and branch snp csvs are only exports written from it,
+    the state differences as sparse differences from the root.
+    """
+
+    def __init__(self,node_states,branch_snp_index):
+        self.node_states = node_states
+        self.branch_snp_index = branch_snp_index
+
+    def save(self,outfile):
+        index = self.branch_snp_index
+        with open(f"{outfile}.tmp","wb") as fw:
+            np.savez(fw,
+                     node_names=np.array(self.node_states.names),
+                     node_sites=self.node_states.sites,
+                     node_matrix=self.node_states.matrix,
+                     node_gaps=self.node_states.gaps,
+                     snp_node_names=np.array(index.node_names),
+                     parent_idx=index.parent_idx,
+                     child_idx=index.child_idx,
+                     sites=index.sites,
+                     snp_names=np.array(index.snp_names),
+                     snp_idx=index.snp_idx,
+                     dimer_names=np.array(index.dimer_names),
+                     dimer_idx=index.dimer_idx,
+                     apobec=index.apobec)
+        os.replace(f"{outfile}.tmp",outfile)
+
+    @classmethod
+    def load(cls,infile,treefile=None):
+        with np.load(infile) as result:
+            node_states = NodeStates([str(i) for i in result["node_names"]],result["node_sites"],result["node_matrix"],
+                                     result["node_gaps"] if "node_gaps" in result else None)
+            index = BranchSNPIndex([str(i) for i in result["snp_node_names"]],
+                                   result["parent_idx"],result["child_idx"],result["sites"],
+                                   [str(i) for i in result["snp_names"]],result["snp_idx"],
+                                   [str(i) for i in result["dimer_names"]],result["dimer_idx"],
+                                   result["apobec"] if "apobec" in result else None)
+        if treefile:
+            index.add_tree(treefile)
+        return cls(node_states,index)
+
+    def iter_state_differences(self,block_width=4096):
+        """
+        the sparse state differences in blocks of sites, each as arrays of the
+        site, node row and state code of every row in csv order: for each site
+        the root and then each node or tip (in name order) whose state differs
+        from the root, at every site with more than one unambiguous base
+        """
+        node_states = self.node_states
+        rows = np.array(node_states.sorted_rows(),dtype=np.int64)
+        root = node_states.node_index.get(ROOT_NODE,0)
+        varying_cols = node_states.varying_cols()
+
+        for start in range(0,len(varying_cols),block_width):
+            cols = varying_cols[start:start+block_width]
+            block = node_states.matrix[:,cols]
+            # by site and then node, as in the columns of the full table
+            site_idx,node_idx = np.nonzero((block[rows] != block[root]).T)
+            # the root row goes first at each site, the sort is stable
+            site_idx = np.r_[np.arange(len(cols)),site_idx]
+            node_rows = np.r_[np.full(len(cols),root),rows[node_idx]]
+            order = np.argsort(site_idx,kind="stable")
+            site_idx,node_rows = site_idx[order],node_rows[order]
+            yield node_states.sites[cols][site_idx],node_rows,block[node_rows,site_idx]
+
+    def write_state_differences(self,outfile,block_width=4096):
+        """
+        sparse csv of the states at every site with more than one unambiguous
+        base (see iter_state_differences). the first line lists every node and
+        tip so read_state_differences can rebuild the full table
+        """
+        node_states = self.node_states
+        names = np.array(node_states.names,dtype=object)
+        with open(outfile,"w") as fw:
+            fw.write(f"#nodes,{','.join(names[node_states.sorted_rows()])}\n")
+            fw.write("site,node,state\n")
+            for sites,node_rows,states in self.iter_state_differences(block_width):
+                fw.writelines(f"{site},{name},{state}\n" for site,name,state in
+                              zip(sites.tolist(),names[node_rows],STATE_STRINGS[states]))
+
+    def write_branch_snps(self,outfile):
+        self.branch_snp_index.write_csv(outfile)
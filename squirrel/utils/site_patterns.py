@@ -0,0 +1,174 @@
+#!/usr/bin/env python3
+import sys
+import numpy as np
+import pandas as pd
+
+from squirrel.utils.log_colours import green,cyan
+from squirrel.utils.alignment_matrix import BASES,load_alignment_matrix
+from squirrel.utils.node_states import parse_state_file
+from squirrel.utils.tree_arrays import load_tree
+import squirrel.utils.newick as newick
+
+# base order of the iqtree -fconst counts and of the state file probabilities
+FCONST_BASES = np.frombuffer(b"ACGT",dtype=np.uint8)
+
+
+class SitePatterns:
+    """
+    The reduced problem given to IQ-TREE for an alignment: each distinct
+    sequence once and only the columns that are not constant.
+
+    Identical sequences are collapsed to a representative (the first in the
+    alignment, or an outgroup, which are never collapsed so they can still be
+    given to -o) and the others are kept as its siblings. Columns where every
+    sequence has the same unambiguous base are removed and counted by base for
+    iqtree -fconst, the remaining columns keep their 1-based genome sites.
+    """
+
+    def __init__(self,ids,aln,keep_ids=()):
+        self.ids = list(ids)
+        keep_ids = set(keep_ids)
+
+        # identical sequences, grouped in alignment order
+        groups = {}
+        for i,seq in enumerate(aln):
+            groups.setdefault(seq.tobytes(),[]).append(i)
+
+        self.representatives = []
+        self.siblings = {}
+        for members in groups.values():
+            kept = [i for i in members if self.ids[i] in keep_ids] or members[:1]
+            self.representatives.extend(kept)
+            others = [self.ids[i] for i in members if i not in kept]
+            if others:
+                self.siblings[self.ids[kept[0]]] = others
+        self.representatives.sort()
+
+        first = aln[0]
+        constant = np.all(aln == first,axis=0) & np.isin(first,BASES)
+        self.sites = np.flatnonzero(~constant) + 1
+        self.constant_sites = np.flatnonzero(constant) + 1
+        self.constant_bases = first[constant]
+        self.length = aln.shape[1]
+
+    @classmethod
+    def from_alignment(cls,alignment,keep_ids=()):
+        ids,aln = load_alignment_matrix(alignment)
+        return cls(ids,aln,keep_ids)
+
+    def fconst(self):
+        """
+        counts of the removed columns by base, as iqtree -fconst takes them (A,C,G,T)
+        """
+        return ",".join(str(int((self.constant_bases == base).sum())) for base in FCONST_BASES)
+
+
+def compress_alignment(alignment,outfile,fconst_file,outgroups=()):
+    """
+    writes the representatives at the variable columns as the alignment for
+    iqtree, and the -fconst counts of the constant columns to fconst_file
+    """
+    ids,aln = load_alignment_matrix(alignment)
+    patterns = SitePatterns(ids,aln,outgroups)
+    if not len(patterns.sites):
+        sys.stderr.write(cyan(f'Error: no variable sites in alignment to build a tree from: ') + f'{alignment}\n')
+        sys.exit(-1)
+
+    cols = patterns.sites - 1
+    with open(outfile,"w") as fw:
+        for i in patterns.representatives:
+            fw.write(f">{ids[i]}\n{aln[i,cols].tobytes().decode()}\n")
+    with open(fconst_file,"w") as fw:
+        fw.write(f"{patterns.fconst()}\n")
+
+    print(green("Site patterns: ") + f"{len(patterns.representatives)} of {len(ids)} sequences, {len(patterns.sites)} of {patterns.length} sites")
+
+def expand_tree(treefile,alignment,outfile,outgroups=()):
+    """
+    puts the sequences collapsed into each representative back into the tree,
+    as zero-length siblings of the representative
+    """
+    patterns = SitePatterns.from_alignment(alignment,outgroups)
+    tree_string = newick.read_tree_string(treefile)
+    tree_string,new_nodes = newick.expand_tips(tree_string,patterns.siblings)
+
+    missing = [tip for tip in patterns.siblings if tip not in new_nodes]
+    if missing:
+        sys.stderr.write(cyan(f'Error: sequences missing from the tree: ') + f'{", ".join(missing)}\n')
+        sys.exit(-1)
+
+    with open(outfile,"w") as fw:
+        fw.write(f"{tree_string}\n")
+    print(green("Identical sequences added back to tree written to: ") + f"{outfile}")
+
+def expand_state_file(state_file,treefile,alignment,outfile,outgroups=(),context=2):
+    """
+    maps an iqtree .state file of the compressed alignment back to genome
+    sites, for the tree from expand_tree. the variable columns keep their
+    reconstructed states, constant columns within context sites of them
+    (for the dimers and codons around snps) get the constant base at every
+    node, and any sites -fconst added after the alignment are dropped. the
+    nodes joining identical sequences take the representative's base where it
+    has one and otherwise their parent's state
+    """
+    patterns = SitePatterns.from_alignment(alignment,outgroups)
+    nodes,sites,states,probs = parse_state_file(state_file)
+
+    in_alignment = (sites >= 1) & (sites <= len(patterns.sites))
+    sites = patterns.sites[sites[in_alignment]-1]
+    states = states[:,in_alignment]
+    probs = probs[:,in_alignment].astype(np.float32)
+
+    # constant columns near a variable one
+    near = np.zeros(patterns.length+context*2,dtype=bool)
+    for offset in range(-context,context+1):
+        near[patterns.sites-1+offset+context] = True
+    near_constant = near[patterns.constant_sites-1+context]
+    constant_sites = patterns.constant_sites[near_constant]
+    constant_bases = patterns.constant_bases[near_constant]
+
+    sites = np.r_[sites,constant_sites]
+    states = np.hstack([states,np.broadcast_to(constant_bases,(len(nodes),len(constant_bases)))])
+    constant_probs = (constant_bases[:,None] == FCONST_BASES).astype(np.float32)
+    probs = np.concatenate([probs,np.broadcast_to(constant_probs,(len(nodes),*constant_probs.shape))],axis=1)
+    order = np.argsort(sites,kind="stable")
+    sites,states,probs = sites[order],states[:,order],probs[:,order]
+
+    # the nodes expand_tree added, one for each representative with siblings
+    tree = load_tree(treefile)
+    node_rows = {name:i for i,name in enumerate(nodes)}
+    ids,aln = load_alignment_matrix(alignment)
+    id_rows = {seq_id:i for i,seq_id in enumerate(ids)}
+    new_names = []
+    new_states = []
+    new_probs = []
+    for tip in patterns.siblings:
+        if tip not in tree:
+            sys.stderr.write(cyan(f'Error: sequence missing from the tree: ') + f'{tip}\n')
+            sys.exit(-1)
+        node = tree.parent[tree.node_index[tip]]
+        parent = tree.names[tree.parent[node]]
+        if parent not in node_rows:
+            sys.stderr.write(cyan(f'Error: node missing from the state file: ') + f'{parent}\n')
+            sys.exit(-1)
+        bases = aln[id_rows[tip],sites-1]
+        is_base = np.isin(bases,BASES)
+        new_names.append(tree.names[node])
+        new_states.append(np.where(is_base,bases,states[node_rows[parent]]))
+        new_probs.append(np.where(is_base[:,None],bases[:,None] == FCONST_BASES,probs[node_rows[parent]]))
+
+    nodes = list(nodes) + new_names
+    if new_names:
+        states = np.vstack([states,np.array(new_states,dtype=np.uint8)])
+        probs = np.concatenate([probs,np.array(new_probs,dtype=np.float32)])
+
+    table = pd.DataFrame({"Node":np.repeat(nodes,len(sites)),
+                          "Site":np.tile(sites,len(nodes)),
+                          "State":states.reshape(-1).view("S1").astype(str)})
+    for i,base in enumerate("ACGT"):
+        table[f"p_{base}"] = probs[:,:,i].reshape(-1)
+
+    with open(outfile,"w") as fw:
+        fw.write(f"# Ancestral states of {state_file} mapped back to the sites of {alignment}\n")
+        table.to_csv(fw,sep="\t",index=False,float_format="%.5f")
+    print(green("State file mapped to genome sites written to: ") + f"{outfile}")
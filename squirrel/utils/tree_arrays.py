@@ -0,0 +1,153 @@
+#!/usr/bin/env python3
+import os
+import numpy as np
+import baltic as bt
+
+from squirrel.utils.log_colours import cyan
+
+# trees already loaded in this process, by path and (size, modification time)
+LOADED_TREES = {}
+
+
+def get_tree_cache_file(treefile):
+    return f"{treefile}.arrays.npz"
+
+def node_label(k):
+    if k.branchType == 'leaf':
+        return k.name
+    return k.traits.get("label","")
+
+
+class TreeArrays:
+    """
+    Compact, read-only form of a tree as arrays indexed by node.
+
+    Nodes are numbered in the order of baltic's tree.Objects (so index i is
+    tree.Objects[i] of the same tree loaded with baltic), with the root first.
+    Each node has its label (the IQ-TREE NodeN label, or the name for tips), its
+    parent index (-1 for the root), its branch length and whether it is a tip.
+    Children are stored in the order baltic sorts them, as slices of one array,
+    and preorder/postorder walk the tree in that order.
+
+    Trees are read with load_tree, which parses the file with baltic once and
+    keeps the arrays in a <treefile>.arrays.npz sidecar for later stages.
+    """
+
+    def __init__(self,names,parent,branch_lengths,is_leaf,child_offsets,children):
+        self.names = list(names)
+        self.node_index = {name:i for i,name in enumerate(self.names)}
+        self.parent = np.asarray(parent,dtype=np.int32)
+        self.branch_lengths = np.asarray(branch_lengths,dtype=np.float64)
+        self.is_leaf = np.asarray(is_leaf,dtype=bool)
+        self.child_offsets = np.asarray(child_offsets,dtype=np.int64)
+        self.children = np.asarray(children,dtype=np.int32)
+
+        roots = np.flatnonzero(self.parent == -1)
+        self.root = int(roots[0]) if len(roots) else 0
+        self.tips = np.flatnonzero(self.is_leaf)
+
+        # parent_child for every node, None for the root
+        self.branch_names = [None if p == -1 else f"{self.names[p]}_{self.names[i]}" for i,p in enumerate(self.parent.tolist())]
+
+        # depth first, children in order: nodes as they are entered and as they are left
+        preorder = []
+        postorder = []
+        stack = [(self.root,False)] if len(self.names) else []
+        while stack:
+            node,visited = stack.pop()
+            if visited:
+                postorder.append(node)
+                continue
+            preorder.append(node)
+            stack.append((node,True))
+            stack.extend((child,False) for child in reversed(self.node_children(node).tolist()))
+        self.preorder = np.array(preorder,dtype=np.int32)
+        self.postorder = np.array(postorder,dtype=np.int32)
+
+        self.heights = np.zeros(len(self.names),dtype=np.float64)
+        for node in self.preorder[1:]:
+            self.heights[node] = self.heights[self.parent[node]] + self.branch_lengths[node]
+
+    @classmethod
+    def from_baltic(cls,my_tree):
+        objects = my_tree.Objects
+        position = {id(k):i for i,k in enumerate(objects)}
+        names = [node_label(k) for k in objects]
+        parent = [position.get(id(k.parent),-1) if k.parent is not None else -1 for k in objects]
+        branch_lengths = [k.length if k.length is not None else 0.0 for k in objects]
+        is_leaf = [k.branchType == 'leaf' for k in objects]
+
+        children = []
+        child_offsets = [0]
+        for k in objects:
+            if k.branchType != 'leaf':
+                children.extend(position[id(child)] for child in k.children)
+            child_offsets.append(len(children))
+        return cls(names,parent,branch_lengths,is_leaf,child_offsets,children)
+
+    def save(self,outfile,source=None):
+        with open(f"{outfile}.tmp","wb") as fw:
+            np.savez(fw,
+                     source=source if source is not None else np.zeros(2,dtype=np.int64),
+                     names=np.array(self.names),
+                     parent=self.parent,
+                     branch_lengths=self.branch_lengths,
+                     is_leaf=self.is_leaf,
+                     child_offsets=self.child_offsets,
+                     children=self.children)
+        os.replace(f"{outfile}.tmp",outfile)
+
+    def __contains__(self,node):
+        return node in self.node_index
+
+    def __len__(self):
+        return len(self.names)
+
+    def node_children(self,node):
+        return self.children[self.child_offsets[node]:self.child_offsets[node+1]]
+
+    def branches(self):
+        """
+        (parent, child) labels for every branch, in node order
+        """
+        return [(self.names[p],self.names[i]) for i,p in enumerate(self.parent.tolist()) if p != -1]
+
+    def path_to_root(self,node):
+        """
+        node indexes from the node up to the root (the node first)
+        """
+        path = [node]
+        while self.parent[path[-1]] != -1:
+            path.append(int(self.parent[path[-1]]))
+        return path
+
+
+def load_tree(treefile):
+    """
+    the tree as TreeArrays, parsed with baltic the first time and then read
+    from the <treefile>.arrays.npz sidecar while the tree file is unchanged
+    (same size and modification time)
+    """
+    stat = os.stat(treefile)
+    source = np.array([stat.st_size,stat.st_mtime_ns],dtype=np.int64)
+    key = (os.path.abspath(treefile),stat.st_size,stat.st_mtime_ns)
+    if key in LOADED_TREES:
+        return LOADED_TREES[key]
+
+    sidecar = get_tree_cache_file(treefile)
+    tree = None
+    if os.path.exists(sidecar):
+        with np.load(sidecar) as cached:
+            if np.array_equal(cached["source"],source):
+                tree = TreeArrays([str(i) for i in cached["names"]],cached["parent"],cached["branch_lengths"],
+                                  cached["is_leaf"],cached["child_offsets"],cached["children"])
+
+    if tree is None:
+        tree = TreeArrays.from_baltic(bt.loadNewick(treefile,absoluteTime=False))
+        try:
+            tree.save(sidecar,source)
+        except OSError:
+            print(cyan(f"Note: could not write tree cache to {sidecar}."))
+
+    LOADED_TREES[key] = tree
+    return tree
@@ -0,0 +1,84 @@
+import io
+import os
+import contextlib
+import pandas as pd
+
+from squirrel.utils.config import *
+from squirrel.utils.gene_model import GeneModel
+from squirrel.utils.annotate import read_variants,annotate_variants,run_annotate
+
+GRANTHAM_SCORES = os.path.join(os.path.dirname(os.path.dirname(__file__)),"squirrel","data","grantham_score.txt")
+
+# a forward gene at 4-12 (ATG GCA TGG) and a reverse gene at 16-21 (ATG TAA
+# read from 21 back to 16)
+REFERENCE = "AAAATGGCATGGCCCTTACATGAG"
+GENES = ("Reference,Name,Minimum,Maximum,Length,Direction\n"
+         "ref,geneF CDS,4,12,9,forward\n"
+         "ref,geneR CDS,16,21,6,reverse\n")
+
+
+def write_inputs(tmp_path):
+    reference = tmp_path / "ref.fasta"
+    reference.write_text(f">ref\n{REFERENCE}\n")
+    genes = tmp_path / "genes.csv"
+    genes.write_text(GENES)
+    return {KEY_GENE_BOUNDARIES:str(genes),KEY_GRANTHAM_SCORES:GRANTHAM_SCORES,KEY_REFERENCE_FASTA:str(reference)}
+
+def gene_model(config):
+    return GeneModel.from_files(config[KEY_GENE_BOUNDARIES],config[KEY_GRANTHAM_SCORES],config[KEY_REFERENCE_FASTA])
+
+def test_annotate(tmp_path):
+    annotation = gene_model(write_inputs(tmp_path)).annotate([5,9,12,22,20,1],list("TAGGAC"),list("CGAAGT"))
+    rows = annotation.astype(object).where(annotation.notna(),None)
+    assert rows[["site","gene","aa_position","aa_number","ref_codon","alt_codon","ref_aa","alt_aa"]].values.tolist() == [
+        [5,"geneF_CDS_1",2,1,"ATG","ACG","M","T"],
+        [9,"geneF_CDS_1",3,2,"GCA","GCG","A","A"],
+        [12,"geneF_CDS_1",3,3,"TGG","TGA","W","*"],
+        [22,None,None,None,None,None,None,None],
+        [20,"geneR_CDS_2",2,1,"ATG","ACG","M","T"],
+        [1,None,None,None,None,None,None,None]]
+    assert rows[["mutation_category","score","prediction","dimer","apobec","ref_match"]].values.tolist() == [
+        ["nonsynonymous",81,"moderately conservative","",False,True],
+        ["synonymous",None,None,"",False,True],
+        ["nonsense",None,None,"GC",False,True],
+        ["intergenic",None,None,"GA",True,True],
+        ["nonsynonymous",81,"moderately conservative","",False,True],
+        ["intergenic",None,None,"C",False,False]]
+
+def test_annotate_a_site_in_two_genes(tmp_path):
+    config = write_inputs(tmp_path)
+    (tmp_path / "genes.csv").write_text(GENES + "ref,geneO CDS,10,18,9,forward\n")
+    annotation = gene_model(config).annotate([11,5],["G","T"],["A","C"])
+    assert annotation["variant"].tolist() == [0,0,1]
+    assert annotation["gene"].astype(str).tolist() == ["geneF_CDS_1","geneO_CDS_3","geneF_CDS_1"]
+    assert annotation["aa_position"].tolist() == [2,2,2]
+
+def test_variant_formats(tmp_path):
+    vcf = tmp_path / "variants.vcf"
+    vcf.write_text("##fileformat=VCFv4.2\n#CHROM\tPOS\tID\tREF\tALT\tQUAL\tFILTER\tINFO\n"
+                   "ref\t5\t.\tT\tC,A\t.\t.\t.\nref\t9\t.\tA\tG\t.\t.\t.\nref\t12\t.\tGT\tG\t.\t.\t.\n")
+    nextclade = tmp_path / "nextclade.tsv"
+    nextclade.write_text("seqName\tsubstitutions\nseq1\tT5C,T5A\nseq2\tA9G\nseq3\t\n")
+    table = tmp_path / "variants.csv"
+    table.write_text("name,site,ref,alt\nx,5,T,C\ny,5,T,A\nz,9,A,G\n")
+
+    with contextlib.redirect_stdout(io.StringIO()):
+        found = [read_variants(str(path)) for path in [vcf,nextclade,table]]
+    for variants in found:
+        assert variants[["site","ref","alt"]].values.tolist() == [[5,"T","C"],[5,"T","A"],[9,"A","G"]]
+    assert found[1]["seqName"].tolist() == ["seq1","seq1","seq2"]
+
+    annotated = annotate_variants(found[2],gene_model(write_inputs(tmp_path)))
+    assert annotated["name"].tolist() == ["x","y","z"]
+    assert annotated["alt_aa"].tolist() == ["T","K","A"]
+
+def test_run_annotate(tmp_path):
+    config = write_inputs(tmp_path)
+    table = tmp_path / "variants.csv"
+    table.write_text("site,ref,alt\n22,G,A\n")
+    outfile = tmp_path / "annotated.csv"
+    with contextlib.redirect_stdout(io.StringIO()):
+        run_annotate(str(table),str(outfile),config)
+    annotated = pd.read_csv(outfile,dtype=str,keep_default_na=False)
+    assert annotated.loc[0,"mutation_category"] == "intergenic"
+    assert annotated.loc[0,"gene"] == "NA" and annotated.loc[0,"apobec"] == "True"
@@ -0,0 +1,51 @@
+import pytest
+
+from squirrel.utils.branch_snp_index import BranchSNPIndex
+
+TREE = "((t1:0.1,t2:0.1)Node2:0.1,(t3:0.1,t4:0.1)Node3:0.1)Node1;"
+BRANCH_SNPS = ("parent,child,site,snp,dimer\n"
+               "Node1,Node2,10,G->A,GA\n"
+               "Node2,t1,10,A->G,\n"
+               "Node1,Node3,20,C->T,TC\n"
+               "Node1,Node3,25,A->C,\n"
+               "Node3,t3,20,C->T,TC\n"
+               "Node2,t2,30,A->C,\n")
+
+
+def load_index(tmp_path,with_tree=True):
+    branch_snps = tmp_path / "branch_snps.csv"
+    branch_snps.write_text(BRANCH_SNPS)
+    treefile = tmp_path / "tree.treefile"
+    treefile.write_text(TREE + "\n")
+    return BranchSNPIndex.from_csv(str(branch_snps),str(treefile) if with_tree else None)
+
+
+def test_csv_round_trip(tmp_path):
+    index = load_index(tmp_path)
+    index.write_csv(str(tmp_path / "out.csv"))
+    assert (tmp_path / "out.csv").read_text() == BRANCH_SNPS
+    assert len(index) == 6
+
+def test_branch_and_site_lookups(tmp_path):
+    index = load_index(tmp_path)
+    assert index.branches() == ["Node1_Node2","Node2_t1","Node1_Node3","Node3_t3","Node2_t2"]
+    assert index["Node1_Node3"] == [("20","C->T","TC"),("25","A->C","")]
+    assert index["Node3_t4"] == []
+    assert "Node3_t4" not in index
+
+    assert index.site_list() == [10,20,25,30]
+    assert index.site_snps(20) == [["Node1","Node3","C->T","TC"],["Node3","t3","C->T","TC"]]
+    assert index.site_branches(10) == ["Node1_Node2","Node2_t1"]
+    assert index.site_snps(11) == []
+
+def test_apobec_homoplasies_and_convergence(tmp_path):
+    index = load_index(tmp_path)
+    assert index.site_apobec(10) == [True,False]
+    assert index.branch_apobec("Node1_Node3") == [True,False]
+    assert index.homoplasies() == {10:2,20:2}
+    assert index.convergent_snps() == [(("20","C->T","TC"),["Node1_Node3","Node3_t3"])]
+
+def test_paths_need_the_tree(tmp_path):
+    assert load_index(tmp_path).path_to_root("t4") == ["Node1_Node3","Node3_t4"]
+    with pytest.raises(ValueError):
+        load_index(tmp_path,with_tree=False).path_to_root("t4")
@@ -0,0 +1,100 @@
+import io
+import contextlib
+import numpy as np
+import pytest
+
+from squirrel.utils.node_states import NodeStates
+from squirrel.utils.tree_arrays import load_tree
+from squirrel.utils.reconstruction_functions import map_site_changes_to_branches
+from squirrel.utils.cns_qc import flag_reversions
+
+TREE = ("(((t1:0.1,t2:0.1)Node3:0.1,(t3:0.1,t4:0.1)Node4:0.1)Node2:0.1,"
+        "((t5:0.1,t6:0.1)Node6:0.1,(t7:0.1,t8:0.1)Node7:0.1)Node5:0.1)Node1;")
+N_SITES = 40
+
+
+def make_node_states(tmp_path,seed=1):
+    """
+    random states for every node and tip at sites 1-40, with some empty states
+    """
+    treefile = tmp_path / "tree.treefile"
+    treefile.write_text(TREE + "\n")
+    tree = load_tree(str(treefile))
+    names = [name for name,leaf in zip(tree.names,tree.is_leaf) if not leaf] + [f"t{i}" for i in range(1,9)]
+
+    rng = np.random.default_rng(seed)
+    matrix = rng.choice(np.frombuffer(b"ACGT",dtype=np.uint8),size=(len(names),N_SITES))
+    matrix[rng.random(matrix.shape) < 0.05] = 0
+    return str(treefile),NodeStates(names,np.arange(1,N_SITES+1),matrix)
+
+def expected_branch_snps(treefile,node_states):
+    """
+    the branch snps worked out one branch and site at a time
+    """
+    found = []
+    for parent,child in load_tree(treefile).branches():
+        for site in range(1,N_SITES+1):
+            parent_base = node_states.base(parent,site)
+            child_base = node_states.base(child,site)
+            if not parent_base or not child_base or parent_base == child_base:
+                continue
+            dimer = ""
+            if parent_base == "G" and child_base == "A":
+                dimer = "G" + node_states.base(parent,site+1)
+            elif parent_base == "C" and child_base == "T":
+                dimer = node_states.base(parent,site-1) + "C"
+            found.append((parent,child,site,f"{parent_base}->{child_base}",dimer))
+    return found
+
+def index_rows(index):
+    return list(zip([index.node_names[i] for i in index.parent_idx],[index.node_names[i] for i in index.child_idx],
+                    index.sites.tolist(),[index.snp_names[i] for i in index.snp_idx],[index.dimer_names[i] for i in index.dimer_idx]))
+
+
+@pytest.mark.parametrize("threads,chunk_size",[(1,256),(1,1),(1,3),(2,1),(2,4)])
+def test_chunked_branch_snps(tmp_path,threads,chunk_size):
+    treefile,node_states = make_node_states(tmp_path)
+    index = map_site_changes_to_branches(treefile,node_states,threads,chunk_size)
+    assert index_rows(index) == expected_branch_snps(treefile,node_states)
+
+def expected_reversions(treefile,index,refs,root):
+    """
+    the reversions found by walking each tip's path from the root in turn
+    """
+    tree = load_tree(treefile)
+    found = []
+    for tip in tree.tips:
+        name = tree.names[tip]
+        site_paths = {}
+        for branch in index.path_to_root(name):
+            for site,snp,dimer in index.branch_snps(branch):
+                path = site_paths.setdefault(site,[])
+                if path:
+                    allele = snp[-1]
+                    reversion_to = [ref for ref in refs if chr(refs[ref][int(site)-1]) == allele]
+                    if root[int(site)-1] == allele:
+                        reversion_to.append("Root")
+                    found.append((name,site,path[0][1],path[-1][0],branch,snp,";".join(reversion_to)))
+                path.append((branch,snp))
+    return found
+
+def test_reversions_match_walking_each_path(tmp_path):
+    treefile,node_states = make_node_states(tmp_path)
+    index = map_site_changes_to_branches(treefile,node_states)
+    index.add_tree(treefile)
+    refs = {"ref":np.frombuffer(b"ACGT"*10,dtype=np.uint8)}
+
+    with contextlib.redirect_stdout(io.StringIO()):
+        possible_reversions,branch_reversions,will_be_reverted = flag_reversions(treefile,index,None,refs,node_states)
+    found = [(row["taxon"],row["site"],row["original_snp"],row["original_branch"],row["reversion_branch"],
+              row["reversion_snp"],row["reversion_to"]) for row in possible_reversions]
+    expected = expected_reversions(treefile,index,refs,node_states.sequence("Node1"))
+    assert len(expected) > 10
+    assert found == expected
+
+    assert {branch:sites for branch,sites in branch_reversions.items()} == \
+           {branch:{f"{site}{snp[-1]}" for taxon,site,first,original,reverted,snp,to in expected if reverted == branch}
+            for branch in {row[4] for row in expected}}
+    assert {branch:sites for branch,sites in will_be_reverted.items()} == \
+           {branch:{f"{site}{snp[0]}" for taxon,site,first,original,reverted,snp,to in expected if original == branch}
+            for branch in {row[3] for row in expected}}
@@ -0,0 +1,128 @@
+import io
+import csv
+import contextlib
+import pytest
+
+from squirrel.utils.config import *
+from squirrel.utils.initialising import setup_config_dict
+from squirrel.utils.cns_qc import get_all_sequence_stats,get_chunk_sequence_stats,iter_fasta_chunks,auto_exclude_from_alignment,check_for_snp_anomalies,check_for_alignment_issues,check_for_alignment_issues_out_of_core,QC_BYTES_PER_CELL
+
+# 1-based sites 17-20 of the genome are AC GT
+GENOME = "ACGTACGTACGTACGTACGTACGTACGTAC"
+
+def mutate(seq,changes):
+    seq = list(seq)
+    for site,base in changes.items():
+        seq[site-1] = base
+    return "".join(seq)
+
+
+def make_config(tmp_path):
+    config = setup_config_dict(str(tmp_path))
+    tempdir = tmp_path / "tmp"
+    tempdir.mkdir()
+    config.update({KEY_OUTFILENAME:"seqs.aln.fasta",
+                   KEY_OUTFILE_STEM:"seqs",
+                   KEY_TEMPDIR:str(tempdir),
+                   KEY_OUTGROUPS:[],
+                   KEY_NO_MASK:False,
+                   KEY_TO_MASK:None,
+                   "version":"test"})
+    return config
+
+def write_alignment(path,sequences):
+    path.write_text("".join(f">{name}\n{seq}\n" for name,seq in sequences.items()))
+    return str(path)
+
+def flagged_sites(sites_to_mask):
+    return {site:(row["present_in"],sorted(row["note"])) for site,row in sites_to_mask.items()}
+
+# C has two unique snps next to each other, D a snp two sites from an N and E
+# a unique snp next to a gap. the snp D and E share at 20 is only flagged in D
+QC_SEQUENCES = {"A":GENOME,
+                "B":GENOME,
+                "C":mutate(GENOME,{17:"T",18:"G"}),
+                "D":mutate(GENOME,{20:"C",22:"N"}),
+                "E":mutate(GENOME,{20:"C",5:"G",6:"-"})}
+QC_FLAGGED = {5:(["E"],["gap_adjacent"]),
+              17:(["C"],["clustered_snps"]),
+              18:(["C"],["clustered_snps"]),
+              20:(["D"],["N_adjacent"])}
+
+def read_alignment(path):
+    with open(path) as f:
+        lines = f.read().split()
+    return dict(zip([l[1:] for l in lines[::2]],lines[1::2]))
+
+def test_auto_exclude_does_not_flag_snps_next_to_masked_sites(tmp_path):
+    # C has clustered unique snps at 17 and 18 that get masked, D and E share
+    # a real snp at 20. bad seq (written bad_seq by the alignment) has the same
+    # snp next to a run of Ns and is excluded
+    sequences = {"A":GENOME,
+                 "B":GENOME,
+                 "C":mutate(GENOME,{17:"T",18:"G"}),
+                 "D":mutate(GENOME,{20:"C"}),
+                 "E":mutate(GENOME,{20:"C"}),
+                 "bad_seq":mutate(GENOME,{20:"C",22:"N",23:"N",24:"N",25:"N"})}
+    config = make_config(tmp_path)
+    config[KEY_AUTO_EXCLUDE] = True
+    alignment = tmp_path / "seqs.aln.fasta"
+    alignment.write_text("".join(f">{name}\n{seq}\n" for name,seq in sequences.items()))
+    exclude_file = tmp_path / "seqs.suggested_to_exclude.csv"
+    exclude_file.write_text("name,note\nbad seq,N_content\nnot aligned,N_content\n")
+
+    out = io.StringIO()
+    with contextlib.redirect_stdout(out):
+        auto_exclude_from_alignment(str(exclude_file),config)
+        mask_file = check_for_snp_anomalies({},config,None)
+    assert "not found in the alignment:" in out.getvalue() and "not aligned" in out.getvalue()
+
+    masked = read_alignment(alignment)
+    assert list(masked) == ["A","B","C","D","E"]
+    assert all(seq[16:18] == "NN" for seq in masked.values())
+    assert masked["D"][19] == "C"
+
+    with open(mask_file) as f:
+        flagged = {int(row["Name"]):row["note"] for row in csv.DictReader(f)}
+    assert flagged == {17:"clustered_snps",18:"clustered_snps"}
+
+def test_alignment_issues(tmp_path):
+    alignment = write_alignment(tmp_path / "qc.aln.fasta",QC_SEQUENCES)
+    assert flagged_sites(check_for_alignment_issues(alignment)) == QC_FLAGGED
+
+def test_alignment_issues_ignore_shared_snps_and_ambiguous_bases(tmp_path):
+    # a snp in two sequences is not unique, and an ambiguous base or N is not a snp
+    sequences = dict(QC_SEQUENCES)
+    sequences["C"] = mutate(GENOME,{17:"T",18:"G",25:"R"})
+    sequences["F"] = mutate(GENOME,{17:"T",18:"G"})
+    sequences["D"] = mutate(GENOME,{22:"N"})
+    alignment = write_alignment(tmp_path / "qc.aln.fasta",sequences)
+    assert flagged_sites(check_for_alignment_issues(alignment)) == {5:(["E"],["gap_adjacent"])}
+
+@pytest.mark.parametrize("block_width,threads",[(1,2),(3,1),(4,2),(30,1)])
+def test_out_of_core_alignment_issues_match(tmp_path,block_width,threads):
+    alignment = write_alignment(tmp_path / "qc.aln.fasta",QC_SEQUENCES)
+    max_memory = (block_width+0.5)*threads*len(QC_SEQUENCES)*QC_BYTES_PER_CELL/1e9
+    out = io.StringIO()
+    with contextlib.redirect_stdout(out):
+        found = check_for_alignment_issues_out_of_core(alignment,str(tmp_path),threads,max_memory)
+    assert f"of up to {block_width} sites" in out.getvalue()
+    assert found == check_for_alignment_issues(alignment)
+    assert flagged_sites(found) == QC_FLAGGED
+
+def test_sequence_stats(tmp_path):
+    fasta = tmp_path / "seqs.fasta"
+    fasta.write_bytes(b">one\nACGTNNNNAC\nGT--RYac\n"
+                      b">two desc\r\nACGTACGTAC\r\n"
+                      b">three\nnnnnACGTnn\n")
+    stats = {row["name"]:row for row in get_all_sequence_stats(str(fasta),1)}
+    assert stats["one"] == {"name":"one","length":18,"n_content":0.222,"gap_content":0.111,
+                            "ambiguity_count":2,"longest_n_run":4}
+    assert stats["two desc"]["length"] == 10 and stats["two desc"]["n_content"] == 0
+    assert stats["three"]["n_content"] == 0.6 and stats["three"]["longest_n_run"] == 4
+
+    # split into chunks of a record or two, and across a pool
+    chunks = list(iter_fasta_chunks(str(fasta),chunk_size=10))
+    assert len(chunks) == 3
+    assert [row for chunk in chunks for row in get_chunk_sequence_stats(chunk)] == list(stats.values())
+    assert get_all_sequence_stats(str(fasta),2) == list(stats.values())
@@ -0,0 +1,91 @@
+import os
+import numpy as np
+import pandas as pd
+
+from squirrel.utils import columnar
+from squirrel.utils.node_states import NodeStates
+from squirrel.utils.reconstruction_result import ReconstructionResult,read_state_differences
+from squirrel.utils.reconstruction_functions import map_site_changes_to_branches,reconstruct_amino_acid_mutations
+from squirrel.utils.cns_qc import merge_flagged_sites
+
+GRANTHAM_SCORES = os.path.join(os.path.dirname(os.path.dirname(__file__)),"squirrel","data","grantham_score.txt")
+
+TREE = "(((t1:0.1,t2:0.1)Node3:0.1,t3:0.1)Node2:0.1,(t4:0.1,t5:0.1)Node4:0.1)Node1;"
+NAMES = ["Node1","Node2","Node3","Node4","t1","t2","t3","t4","t5"]
+GENES = ("Reference,Name,Minimum,Maximum,Length,Direction\n"
+         "ref,geneF CDS,4,24,21,forward\n"
+         "ref,geneR CDS,16,30,15,reverse\n")
+N_SITES = 36
+
+
+def make_result(tmp_path):
+    """
+    random states at sites 1-36 with some empty, and the branch snps between them
+    """
+    treefile = tmp_path / "tree.treefile"
+    treefile.write_text(TREE + "\n")
+    rng = np.random.default_rng(4)
+    matrix = rng.choice(np.frombuffer(b"ACGT",dtype=np.uint8),size=(len(NAMES),N_SITES))
+    matrix[rng.random(matrix.shape) < 0.05] = 0
+    node_states = NodeStates(NAMES,np.arange(1,N_SITES+1),matrix)
+    return str(treefile),ReconstructionResult(node_states,map_site_changes_to_branches(str(treefile),node_states))
+
+def as_strings(table):
+    """
+    every value as the csv writes it
+    """
+    return table.astype(object).where(table.notna(),"NA").astype(str).reset_index(drop=True)
+
+def read_csv_sorted(csv_file,sort_by="site"):
+    table = pd.read_csv(csv_file,dtype=str,keep_default_na=False)
+    return table.sort_values(sort_by,key=lambda column: column.astype(int),kind="stable").reset_index(drop=True)
+
+def write_and_read(table,tmp_path,sort_by="site"):
+    parquet = columnar.write_parquet(table,str(tmp_path / "table.parquet"),sort_by)
+    return pd.read_parquet(parquet)
+
+
+def test_branch_snps_parquet(tmp_path):
+    treefile,result = make_result(tmp_path)
+    result.write_branch_snps(str(tmp_path / "branch_snps.csv"))
+    table = write_and_read(columnar.branch_snps_frame(result.branch_snp_index),tmp_path)
+
+    assert len(table) > 10
+    assert table.dtypes.astype(str).to_dict() == columnar.BRANCH_SNPS_DTYPES
+    assert table["site"].is_monotonic_increasing
+    assert as_strings(table).equals(read_csv_sorted(tmp_path / "branch_snps.csv"))
+
+def test_state_differences_parquet(tmp_path):
+    treefile,result = make_result(tmp_path)
+    result.write_state_differences(str(tmp_path / "state_differences.csv"),block_width=5)
+    nodes,differences = read_state_differences(str(tmp_path / "state_differences.csv"))
+    table = write_and_read(columnar.state_differences_frame(result),tmp_path)
+
+    assert table["node"].cat.categories.tolist() == nodes
+    assert table[["site","node","state"]].astype({"node":str,"state":str}).values.tolist() == differences.values.tolist()
+    assert table["is_root"].tolist() == (~differences["site"].duplicated()).tolist()
+
+def test_amino_acid_parquet(tmp_path):
+    treefile,result = make_result(tmp_path)
+    genes = tmp_path / "genes.csv"
+    genes.write_text(GENES)
+    amino_acids_out = str(tmp_path / "amino_acids.csv")
+    frame = reconstruct_amino_acid_mutations(GRANTHAM_SCORES,str(genes),result.branch_snp_index,result.node_states,amino_acids_out,as_frame=True)
+    table = write_and_read(frame,tmp_path)
+
+    expected = read_csv_sorted(amino_acids_out)
+    assert set(expected["mutation_category"]) >= {"intergenic","synonymous","nonsynonymous"}
+    assert table.dtypes.astype(str).to_dict() == columnar.AMINO_ACID_DTYPES
+    assert as_strings(table).equals(expected)
+
+def test_suggested_mask_parquet(tmp_path):
+    sites_to_mask = {5:{"Name":5,"Minimum":5,"Maximum":5,"Length":1,"present_in":["seq1"],"note":{"N_adjacent"}}}
+    branch_reversions = {"Node1_t1":["12A","5C"]}
+    branch_convergence = {"Node2_t2":["G3A"],"Node3_t4":["G3A"]}
+    mask_file = str(tmp_path / "suggested_mask.csv")
+    rows = merge_flagged_sites(sites_to_mask,branch_reversions,branch_convergence,mask_file)
+    table = write_and_read(columnar.rows_to_frame(rows,columnar.SUGGESTED_MASK_DTYPES),tmp_path,sort_by="Minimum")
+
+    assert table.dtypes.astype(str).to_dict() == columnar.SUGGESTED_MASK_DTYPES
+    assert table["Minimum"].tolist() == [3,5,12]
+    assert as_strings(table).equals(read_csv_sorted(mask_file,"Minimum"))
@@ -0,0 +1,57 @@
+import io
+import os
+import contextlib
+import pytest
+
+from squirrel.utils.newick import parse_newick,read_tree_string,write_pruned_tree
+
+# input trees with iqtree's node labels and the trees jclusterfunk prune gives
+# for them with the same tips
+FIXTURES = os.path.join(os.path.dirname(__file__),"prune")
+
+
+def branches(treefile):
+    """
+    each node by label with its parent's label and its branch length
+    """
+    found = {}
+    stack = [parse_newick(read_tree_string(treefile))]
+    while stack:
+        node = stack.pop()
+        parent = node.parent.name() if node.parent is not None else None
+        length = round(float(node.length),6) if node.length is not None else None
+        found[node.name()] = (parent,length)
+        stack.extend(node.children)
+    return found
+
+def prune(tmp_path,case,tips):
+    outfile = str(tmp_path / f"{case}.tree")
+    with contextlib.redirect_stdout(io.StringIO()):
+        write_pruned_tree(os.path.join(FIXTURES,f"{case}.treefile"),outfile,tips)
+    return outfile
+
+@pytest.mark.parametrize("case,tips",[("bifurcating_root",["OG"]),
+                                      ("several_outgroups",["OG1","OG2"]),
+                                      ("nested_collapse",["OG1","OG2"])])
+def test_prune_matches_jclusterfunk(tmp_path,case,tips):
+    outfile = prune(tmp_path,case,tips)
+    assert branches(outfile) == branches(os.path.join(FIXTURES,f"{case}.jclusterfunk.tree"))
+    with open(outfile) as f:
+        assert f.readline() == "#NEXUS\n"
+
+def test_prune_keeps_root_label(tmp_path):
+    outfile = prune(tmp_path,"bifurcating_root",["OG"])
+    found = branches(outfile)
+    assert found["Node1"] == (None,None)
+    assert "Node2" not in found
+    assert found["Node3"] == ("Node1",0.05)
+
+def test_prune_sums_collapsed_branches(tmp_path):
+    found = branches(prune(tmp_path,"nested_collapse",["OG1","OG2"]))
+    assert found["B"] == ("Node2",0.4)
+    assert "Node3" not in found and "Node4" not in found
+
+def test_prune_to_one_tip_fails(tmp_path):
+    with pytest.raises(SystemExit):
+        with contextlib.redirect_stderr(io.StringIO()):
+            prune(tmp_path,"bifurcating_root",["OG","A","B","C"])
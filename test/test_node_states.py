@@ -0,0 +1,158 @@
+import io
+import os
+import contextlib
+import numpy as np
+import pytest
+
+import squirrel.utils.node_states as node_states_module
+from squirrel.utils.node_states import NodeStates,parse_state_file,find_needed_sites,load_state_file,get_state_cache_dir
+from squirrel.utils.reconstruction_functions import map_site_changes_to_branches
+from squirrel.utils.reconstruction_result import ReconstructionResult
+from squirrel.utils.cns_qc import flag_reversions
+
+# site 3 is a gap at the root, goes A->G on the branch to Node3 and back to A
+# on the branch to B
+TREE = "((A:0.1,(B:0.1,C:0.1)Node3:0.1)Node2:0.1,OG:0.1)Node1;"
+NODES = {"Node1":"AC-TAC","Node2":"ACATAC","Node3":"ACGTAC"}
+SEQUENCES = {"A":"ACATAC","B":"ACATAC","C":"ACGTAC","OG":"AC-TNC"}
+
+
+def write_state_file(path,nodes):
+    with open(path,"w") as fw:
+        fw.write("# ancestral states\nNode\tSite\tState\tp_A\tp_C\tp_G\tp_T\n")
+        for node,seq in nodes.items():
+            for site,base in enumerate(seq):
+                probs = "\t".join("1.00000" if base == b else "0.00000" for b in "ACGT")
+                fw.write(f"{node}\t{site+1}\t{base}\t{probs}\n")
+    return str(path)
+
+def write_alignment(path,sequences):
+    path.write_text("".join(f">{name}\n{seq}\n" for name,seq in sequences.items()))
+    return str(path)
+
+def write_inputs(tmp_path):
+    treefile = tmp_path / "tree.treefile"
+    treefile.write_text(TREE + "\n")
+    alignment = write_alignment(tmp_path / "aln.fasta",SEQUENCES)
+    state_file = write_state_file(tmp_path / "aln.fasta.state",NODES)
+    return str(treefile),alignment,state_file
+
+
+def test_gaps_are_empty_states_but_kept_in_sequences(tmp_path):
+    treefile,alignment,state_file = write_inputs(tmp_path)
+    node_states = NodeStates.from_files(state_file,alignment)
+
+    assert node_states.base("Node1",3) == ""
+    assert node_states.base("OG",3) == ""
+    assert node_states.varying_cols().tolist() == [2]
+    assert node_states.sequence("Node1") == "AC-TAC"
+    assert node_states.sequence("OG") == "AC-TNC"
+    assert node_states.sequence("Node1",8) == "AC-TACNN"
+
+def test_gaps_are_kept_in_the_reconstruction_result(tmp_path):
+    treefile,alignment,state_file = write_inputs(tmp_path)
+    node_states = NodeStates.from_files(state_file,alignment)
+    result_file = str(tmp_path / "result.npz")
+    ReconstructionResult(node_states,map_site_changes_to_branches(treefile,node_states)).save(result_file)
+
+    loaded = ReconstructionResult.load(result_file).node_states
+    assert loaded.sequence("Node1") == "AC-TAC"
+    with node_states.shared() as spec:
+        assert NodeStates.from_shared_memory(*spec).sequence("OG") == "AC-TNC"
+
+def test_reversion_root_allele_is_a_gap(tmp_path):
+    treefile,alignment,state_file = write_inputs(tmp_path)
+    node_states = NodeStates.from_files(state_file,alignment)
+    branch_snp_index = map_site_changes_to_branches(treefile,node_states)
+    refs = {"ref":np.frombuffer(b"ACATAC",dtype=np.uint8)}
+
+    # the same root allele from the state file and from the node states
+    for states in [None,node_states]:
+        with contextlib.redirect_stdout(io.StringIO()):
+            possible_reversions,branch_reversions,will_be_reverted = flag_reversions(treefile,branch_snp_index,state_file,refs,states)
+        assert [(int(row["site"]),row["taxon"],row["root_allele"],row["reversion_to"]) for row in possible_reversions] == [(3,"B","-","ref")]
+
+
+# 12 sites where the tips only have more than one base at 3 and 9, so with
+# the two sites either side the reconstruction needs 1-5 and 7-11
+TIPS = {"A":"ACGTACGTACGT","B":"ACTTACGTACGT","C":"ACGTACGTTCGT","D":"ACNTACGT-CGT"}
+TIP_NODES = {"Node1":"ACGTACGTACGT","Node2":"ACTTACGTACGT","Node3":"ACGTACGTTCGT"}
+NEEDED_SITES = [1,2,3,4,5,7,8,9,10,11]
+
+def test_needed_sites(tmp_path):
+    alignment = write_alignment(tmp_path / "aln.fasta",TIPS)
+    assert find_needed_sites(alignment).tolist() == NEEDED_SITES
+    assert find_needed_sites(alignment,context=0).tolist() == [3,9]
+
+def test_parse_only_needed_sites(tmp_path):
+    state_file = write_state_file(tmp_path / "aln.fasta.state",TIP_NODES)
+    nodes,sites,states,probs = parse_state_file(state_file)
+    cols = np.array(NEEDED_SITES) - 1
+
+    # in chunks of rows that do not line up with the nodes' blocks
+    for chunk_size in [5,12,1000]:
+        found = parse_state_file(state_file,NEEDED_SITES,chunk_size)
+        assert found[0] == nodes == ["Node1","Node2","Node3"]
+        assert found[1].tolist() == NEEDED_SITES
+        assert np.array_equal(found[2],states[:,cols])
+        assert np.array_equal(found[3],probs[:,cols])
+
+def test_node_states_at_needed_sites(tmp_path):
+    alignment = write_alignment(tmp_path / "aln.fasta",TIPS)
+    state_file = write_state_file(tmp_path / "aln.fasta.state",TIP_NODES)
+    everything = NodeStates.from_files(state_file,alignment)
+    needed = NodeStates.from_files(state_file,alignment,NEEDED_SITES)
+
+    assert needed.sites.tolist() == NEEDED_SITES
+    assert needed.names == everything.names == ["Node1","Node2","Node3","A","B","C","D"]
+    for name in needed.names:
+        assert needed.bases(name,NEEDED_SITES) == everything.bases(name,NEEDED_SITES)
+    assert needed.base("Node1",6) == ""
+    assert needed.base("D",3) == ""
+    assert needed.sequence("D") == "ACNTANGT-CG"
+
+def fail_to_parse(*args,**kwargs):
+    raise AssertionError("state file parsed, the cache was not used")
+
+def test_state_cache_is_reused(tmp_path,monkeypatch):
+    state_file = write_state_file(tmp_path / "aln.fasta.state",TIP_NODES)
+    nodes,sites,states,probs = load_state_file(state_file,with_probs=True)
+    assert sorted(os.listdir(get_state_cache_dir(state_file))) == ["nodes.npy","parsed_sites.npy","probs.npy",
+                                                                   "sites.npy","source.npy","states.npy"]
+
+    monkeypatch.setattr(node_states_module,"parse_state_file",fail_to_parse)
+    cached = load_state_file(state_file,with_probs=True)
+    assert cached[0] == nodes
+    assert np.array_equal(cached[1],sites)
+    assert isinstance(cached[2],np.memmap) and np.array_equal(cached[2],states)
+    assert np.array_equal(cached[3],probs)
+
+def test_state_cache_follows_the_state_file(tmp_path):
+    state_file = write_state_file(tmp_path / "aln.fasta.state",TIP_NODES)
+    load_state_file(state_file)
+
+    # same size, but a later modification time
+    changed = dict(TIP_NODES,Node1="TCGTACGTACGT")
+    write_state_file(state_file,changed)
+    stat = os.stat(state_file)
+    os.utime(state_file,ns=(stat.st_atime_ns,stat.st_mtime_ns + 10**9))
+    nodes,sites,states = load_state_file(state_file)
+    assert states[0].tobytes() == b"TCGTACGTACGT"
+
+    # a cache left half written is not read
+    os.remove(os.path.join(get_state_cache_dir(state_file),"source.npy"))
+    load_state_file(state_file)
+    assert os.path.exists(os.path.join(get_state_cache_dir(state_file),"source.npy"))
+
+def test_state_cache_of_some_sites(tmp_path,monkeypatch):
+    state_file = write_state_file(tmp_path / "aln.fasta.state",TIP_NODES)
+    nodes,sites,states = load_state_file(state_file,NEEDED_SITES)
+    assert sites.tolist() == NEEDED_SITES
+
+    # fewer sites come from the cache, more are parsed again
+    with monkeypatch.context() as patch:
+        patch.setattr(node_states_module,"parse_state_file",fail_to_parse)
+        assert load_state_file(state_file,[3,9])[1].tolist() == NEEDED_SITES
+        with pytest.raises(AssertionError):
+            load_state_file(state_file,[3,6])
+    assert load_state_file(state_file)[1].tolist() == list(range(1,13))
@@ -0,0 +1,62 @@
+import io
+import itertools
+import contextlib
+import numpy as np
+
+from squirrel.utils.parsimony import reconstruct_node_states
+from squirrel.utils.tree_arrays import load_tree
+
+TREE = "((A:0.1,B:0.1)Node2:0.1,(C:0.1,D:0.1)Node3:0.1)Node1;"
+
+
+def write_inputs(tmp_path,tree,sequences):
+    treefile = tmp_path / "tree.treefile"
+    treefile.write_text(tree + "\n")
+    alignment = tmp_path / "aln.fasta"
+    alignment.write_text("".join(f">{name}\n{seq}\n" for name,seq in sequences.items()))
+    return str(treefile),str(alignment)
+
+def reconstruct(treefile,alignment,sites):
+    with contextlib.redirect_stdout(io.StringIO()):
+        return reconstruct_node_states(treefile,alignment,sites)
+
+def test_fitch_states(tmp_path):
+    # 1 a tie at the root goes to the base seen first in ACGT, 2 one choice,
+    # 3 N is any base, 4 an ambiguity code allows its bases and ties go to the
+    # base seen most often, 5 no bases at all is left empty
+    treefile,alignment = write_inputs(tmp_path,TREE,{"A":"AANRN",
+                                                     "B":"ACGGN",
+                                                     "C":"GCGAN",
+                                                     "D":"GCGAN"})
+    node_states = reconstruct(treefile,alignment,[1,2,3,4,5])
+    assert node_states.names == ["Node1","Node2","Node3","A","B","C","D"]
+    assert node_states.bases("Node1",[1,2,3,4]) == "ACGA"
+    assert node_states.bases("Node2",[1,2,3,4]) == "ACGG"
+    assert node_states.bases("Node3",[1,2,3,4]) == "GCGA"
+    assert node_states.base("Node1",5) == ""
+    assert node_states.bases("A",[1,2,3,4,5]) == "AA"
+
+def test_multifurcating_root(tmp_path):
+    treefile,alignment = write_inputs(tmp_path,"((A:0.1,B:0.1)Node2:0.1,C:0.1,D:0.1)Node1;",
+                                      {"A":"T","B":"T","C":"G","D":"T"})
+    assert reconstruct(treefile,alignment,[1]).base("Node1",1) == "T"
+
+def count_changes(tree,states):
+    return sum(states[node] != states[tree.parent[node]] for node in range(len(tree)) if tree.parent[node] != -1)
+
+def test_fitch_is_most_parsimonious(tmp_path):
+    # every assignment of bases to the internal nodes of a 6 tip tree, for random columns
+    tree_string = "(((t1:0.1,t2:0.1)Node3:0.1,t3:0.1)Node2:0.1,((t4:0.1,t5:0.1)Node5:0.1,t6:0.1)Node4:0.1)Node1;"
+    rng = np.random.default_rng(2)
+    columns = ["".join(rng.choice(list("ACGT"),size=6)) for i in range(30)]
+    sequences = {f"t{i+1}":"".join(column[i] for column in columns) for i in range(6)}
+    treefile,alignment = write_inputs(tmp_path,tree_string,sequences)
+
+    tree = load_tree(treefile)
+    node_states = reconstruct(treefile,alignment,np.arange(1,len(columns)+1))
+    internal = [node for node in range(len(tree)) if not tree.is_leaf[node]]
+    for site,column in enumerate(columns,start=1):
+        states = {node:node_states.base(tree.names[node],site) for node in range(len(tree))}
+        fewest = min(count_changes(tree,{**states,**dict(zip(internal,bases))})
+                     for bases in itertools.product("ACGT",repeat=len(internal)))
+        assert count_changes(tree,states) == fewest
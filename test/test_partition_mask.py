@@ -0,0 +1,71 @@
+import io
+import contextlib
+import numpy as np
+import pytest
+
+from squirrel.utils.branch_snp_index import BranchSNPIndex
+from squirrel.utils.apobec_context import GA_TARGET,TC_TARGET,reference_targets
+from squirrel.utils.reconstruction_functions import get_partition_targets,get_mask_runs,load_packed_partition_mask,find_binary_partition_mask
+
+# GA targets at 2 and 8, TC targets at 5 and 13
+REFERENCE = "AGATCCGGAATTCAGGCATG"
+TREE = "((t1:0.1,t2:0.1)Node2:0.1,(t3:0.1,t4:0.1)Node3:0.1)Node1;"
+# a non-apobec snp drops the target at 8, apobec snps add 15 (GA) and 17 (TC),
+# site 13 is a GA snp at a TC target and site 2 has both kinds of snp
+BRANCH_SNPS = ("parent,child,site,snp,dimer\n"
+               "Node1,Node2,8,G->T,\n"
+               "Node1,Node2,15,G->A,GA\n"
+               "Node1,Node3,17,C->T,TC\n"
+               "Node1,Node3,13,G->A,GA\n"
+               "Node2,t1,2,G->C,\n"
+               "Node3,t3,2,G->A,GA\n")
+SEPARATE_MASK = "01002000000010102000"
+
+
+def write_inputs(tmp_path):
+    reference = tmp_path / "ref.fasta"
+    reference.write_text(f">ref\n{REFERENCE}\n")
+    branch_snps = tmp_path / "branch_snps.csv"
+    branch_snps.write_text(BRANCH_SNPS)
+    treefile = tmp_path / "tree.treefile"
+    treefile.write_text(TREE + "\n")
+    return str(reference),BranchSNPIndex.from_csv(str(branch_snps),str(treefile))
+
+def test_reference_targets():
+    targets = reference_targets(np.frombuffer(REFERENCE.encode(),dtype=np.uint8))
+    assert (np.flatnonzero(targets == GA_TARGET) + 1).tolist() == [2,8]
+    assert (np.flatnonzero(targets == TC_TARGET) + 1).tolist() == [5,13]
+
+def test_partition_targets():
+    targets = reference_targets(np.frombuffer(REFERENCE.encode(),dtype=np.uint8))
+    mask = get_partition_targets(targets,[15,13,2,0,99],[17],[8,2,40])
+    assert "".join(map(str,mask)) == SEPARATE_MASK
+
+def test_mask_runs():
+    starts,ends,codes = get_mask_runs(np.array([0,0,1,1,1,0,2],dtype=np.uint8))
+    assert starts.tolist() == [0,2,5,6]
+    assert ends.tolist() == [2,5,6,7]
+    assert codes.tolist() == [0,1,0,2]
+    assert [len(x) for x in get_mask_runs(np.zeros(0,dtype=np.uint8))] == [0,0,0]
+
+@pytest.mark.parametrize("sep_status",[True,False])
+def test_mask_formats(tmp_path,sep_status):
+    reference,index = write_inputs(tmp_path)
+    outfile = str(tmp_path / "mask.csv")
+    with contextlib.redirect_stdout(io.StringIO()):
+        mask = find_binary_partition_mask(index,sep_status,reference,outfile)
+
+    expected = SEPARATE_MASK if sep_status else SEPARATE_MASK.replace("2","1")
+    assert (tmp_path / "mask.csv").read_text() == expected + "\n"
+    assert "".join(map(str,mask)) == expected
+    assert load_packed_partition_mask(str(tmp_path / "mask.packed.npz")).tolist() == mask.tolist()
+
+    # runs are 1-based inclusive, the bed is 0-based half open and only has targets
+    rle = (tmp_path / "mask.rle.csv").read_text().splitlines()
+    assert rle[0] == "start,end,value"
+    assert rle[1:6] == ["1,1,0","2,2,1","3,4,0",f"5,5,{2 if sep_status else 1}","6,12,0"]
+    assert "".join(str(value)*(int(end)-int(start)+1) for start,end,value in (line.split(",") for line in rle[1:])) == expected
+
+    names = ["GA","TC","GA","GA","TC"] if sep_status else ["APOBEC3"]*5
+    bed = [line.split("\t") for line in (tmp_path / "mask.bed").read_text().splitlines()]
+    assert bed == [["ref",start,end,name] for (start,end),name in zip([("1","2"),("4","5"),("12","13"),("14","15"),("16","17")],names)]
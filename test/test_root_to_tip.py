@@ -0,0 +1,80 @@
+import io
+import contextlib
+import numpy as np
+import pandas as pd
+
+from squirrel.utils.config import *
+from squirrel.utils.reconstruction_functions import parse_decimal_dates,get_tip_snp_counts,fit_root_to_tip_regression,run_root_to_tip
+
+TIPS = ["A|2020-01-01","B|2021","C|2022-07","D"]
+
+# the first row of each site is the root state. site 20 is listed twice in the
+# amino acid reconstruction (a snp on two branches) and the last row is used,
+# site 40 is empty at A and site 50 is not in the amino acid reconstruction
+STATE_DIFFERENCES = (f"#nodes,Node1,Node2,{','.join(TIPS)}\n"
+                     "site,node,state\n"
+                     "10,Node1,G\n10,A|2020-01-01,A\n10,B|2021,A\n"
+                     "20,Node1,C\n20,B|2021,T\n"
+                     "30,Node1,A\n30,Node2,G\n30,C|2022-07,G\n"
+                     "40,Node1,A\n40,A|2020-01-01,\n"
+                     "50,Node1,T\n50,C|2022-07,A\n")
+AMINO_ACIDS = "site,apobec\n10,True\n20,False\n20,True\n30,False\n40,True\n"
+
+
+def write_inputs(tmp_path):
+    treefile = tmp_path / "tree.treefile"
+    (tmp_path / "tree.treefile.state_differences.csv").write_text(STATE_DIFFERENCES)
+    (tmp_path / "tree.treefile.amino_acid.reconstruction.csv").write_text(AMINO_ACIDS)
+    return str(treefile)
+
+def test_parse_decimal_dates():
+    dates = parse_decimal_dates(["2020-01-01","2021-02","2021-03","2019","2021-02-30","bad",None])
+    assert dates["date"].tolist()[:3] == ["2020-01-01","2021-02-15","2021-03-16"]
+    assert np.allclose(dates["decimal_year"][:4],[2020,2021+45/365,2021+74/365,2019.5])
+    assert dates["decimal_year"][4:].isna().all()
+    assert dates["precision"].tolist() == ["day","month","month","year","","",""]
+
+def test_tip_snp_counts(tmp_path):
+    treefile = write_inputs(tmp_path)
+    counts = get_tip_snp_counts(f"{treefile}.amino_acid.reconstruction.csv",f"{treefile}.state_differences.csv")
+    assert counts.index.tolist() == TIPS
+    assert counts.values.tolist() == [[1,1,0],[2,2,0],[1,0,1],[0,0,0]]
+
+def test_fit_root_to_tip_regression(tmp_path):
+    table = pd.DataFrame({"decimal_year":[2010.0,2015.0,2020.0,np.nan],
+                          "all_snps":[20,30,40,99],
+                          "apobec_snps":[20,30,40,99],
+                          "non_apobec_snps":[0,0,0,0]})
+    fits = fit_root_to_tip_regression(table,str(tmp_path / "fits.csv")).set_index("snps")
+    assert fits.loc["apobec_snps","n_tips"] == 3
+    assert np.allclose(fits.loc["apobec_snps",["slope","r_squared","root_date"]].astype(float),[2,1,2000])
+    assert fits.loc["non_apobec_snps","slope"] == 0
+    assert fits.loc["non_apobec_snps",["r_squared","root_date"]].isna().all()
+
+def test_run_root_to_tip(tmp_path):
+    treefile = write_inputs(tmp_path)
+    config = {KEY_DATE_METADATA:None}
+    with contextlib.redirect_stdout(io.StringIO()):
+        counts_file,regression_file = run_root_to_tip(treefile,config)
+    counts = pd.read_csv(counts_file,keep_default_na=False)
+    assert counts["name"].tolist() == TIPS
+    assert counts["precision"].tolist() == ["day","year","month",""]
+    assert counts["decimal_year"].tolist()[3] == "NA"
+
+    dated = counts.iloc[:3]
+    x = dated["decimal_year"].astype(float).to_numpy()
+    fits = pd.read_csv(regression_file).set_index("snps")
+    assert (fits["n_tips"] == 3).all()
+    for snps in ["all_snps","apobec_snps","non_apobec_snps"]:
+        assert np.allclose(fits.loc[snps,["slope","intercept"]].astype(float),np.polyfit(x,dated[snps].to_numpy(dtype=float),1))
+
+def test_run_root_to_tip_dates_from_metadata(tmp_path):
+    treefile = write_inputs(tmp_path)
+    metadata = tmp_path / "metadata.csv"
+    metadata.write_text("id,collection_date\n" + "".join(f"{tip},20{10+i}-06-01\n" for i,tip in enumerate(TIPS)))
+    config = {KEY_DATE_METADATA:str(metadata),KEY_METADATA_ID_COLUMN:"id",KEY_METADATA_DATE_COLUMN:"collection_date"}
+    with contextlib.redirect_stdout(io.StringIO()):
+        counts_file,regression_file = run_root_to_tip(treefile,config)
+    counts = pd.read_csv(counts_file)
+    assert counts["date"].tolist() == ["2010-06-01","2011-06-01","2012-06-01","2013-06-01"]
+    assert pd.read_csv(regression_file)["n_tips"].tolist() == [4,4,4]
@@ -0,0 +1,94 @@
+import io
+import contextlib
+import numpy as np
+
+from squirrel.utils.site_patterns import SitePatterns,compress_alignment,expand_tree,expand_state_file
+from squirrel.utils.node_states import NodeStates
+from squirrel.utils.reconstruction_functions import get_node_states_all_sites,map_site_changes_to_branches
+from squirrel.utils.cns_qc import flag_reversions
+
+# a 40 site genome that only varies at sites 5, 10, 30 and 36. site 30 goes
+# G->A on the branch to Node2 and back to G on the branch to A, B is carried
+# twice (Bdup collapses into it)
+ROOT = "ACGTACGTACGTACGTACGTACGTACGTAGGTACGTACGT"
+
+def mutate(seq,changes):
+    seq = list(seq)
+    for site,base in changes.items():
+        seq[site-1] = base
+    return "".join(seq)
+
+NODE2 = mutate(ROOT,{30:"A"})
+NODE3 = mutate(ROOT,{5:"T"})
+SEQUENCES = {"A":ROOT,
+             "B":NODE2,
+             "Bdup":NODE2,
+             "C":NODE3,
+             "D":mutate(NODE3,{10:"G"}),
+             "OG":mutate(ROOT,{36:"A"})}
+NODES = {"Node1":ROOT,"Node2":NODE2,"Node3":NODE3}
+TREE = "((A:0.1,B:0.1)Node2:0.1,(C:0.1,D:0.1)Node3:0.1,OG:0.1)Node1;"
+
+
+def write_inputs(tmp_path):
+    alignment = tmp_path / "aln.fasta"
+    alignment.write_text("".join(f">{name}\n{seq}\n" for name,seq in SEQUENCES.items()))
+
+    # what iqtree would give back for the compressed alignment: the tree of the
+    # representatives and the states at the compressed columns, then the -fconst sites
+    patterns = SitePatterns.from_alignment(str(alignment),["OG"])
+    treefile = tmp_path / "compressed.treefile"
+    treefile.write_text(TREE + "\n")
+    state_file = tmp_path / "compressed.state"
+    with open(state_file,"w") as fw:
+        fw.write("# ancestral states\nNode\tSite\tState\tp_A\tp_C\tp_G\tp_T\n")
+        for node,seq in NODES.items():
+            for i,site in enumerate(patterns.sites):
+                base = seq[site-1]
+                probs = "\t".join("1.00000" if base == b else "0.00000" for b in "ACGT")
+                fw.write(f"{node}\t{i+1}\t{base}\t{probs}\n")
+            fw.write(f"{node}\t{len(patterns.sites)+1}\tA\t1.00000\t0.00000\t0.00000\t0.00000\n")
+    return str(alignment),str(treefile),str(state_file)
+
+def expand(tmp_path):
+    alignment,treefile,state_file = write_inputs(tmp_path)
+    expanded_tree = str(tmp_path / "expanded.treefile")
+    expanded_state = str(tmp_path / "expanded.state")
+    with contextlib.redirect_stdout(io.StringIO()):
+        expand_tree(treefile,alignment,expanded_tree,["OG"])
+        expand_state_file(state_file,expanded_tree,alignment,expanded_state,["OG"])
+    return alignment,expanded_tree,expanded_state
+
+
+def test_compress_alignment(tmp_path):
+    alignment,treefile,state_file = write_inputs(tmp_path)
+    with contextlib.redirect_stdout(io.StringIO()):
+        compress_alignment(alignment,str(tmp_path / "c.fasta"),str(tmp_path / "c.fconst"),["OG"])
+    assert (tmp_path / "c.fasta").read_text().count(">") == 5
+    assert (tmp_path / "c.fconst").read_text().strip() == "9,8,10,9"
+
+def test_expanded_states_are_at_genome_sites(tmp_path):
+    alignment,expanded_tree,expanded_state = expand(tmp_path)
+    node_states = NodeStates.from_files(expanded_state,alignment)
+
+    # the variable sites and the constant sites either side of them
+    assert node_states.sites.tolist() == [3,4,5,6,7,8,9,10,11,12,28,29,30,31,32,34,35,36,37,38]
+    for node,seq in NODES.items():
+        assert all(node_states.base(node,site) == seq[site-1] for site in node_states.sites)
+
+    # the node joining B and Bdup takes B's bases
+    joining_node = [name for name in node_states.names if name not in NODES and name not in SEQUENCES]
+    assert len(joining_node) == 1
+    assert node_states.base(joining_node[0],30) == "A"
+
+def test_reversions_on_expanded_state_file(tmp_path):
+    alignment,expanded_tree,expanded_state = expand(tmp_path)
+    refs = {"ref":np.frombuffer(ROOT.encode(),dtype=np.uint8)}
+    node_states = get_node_states_all_sites(expanded_state,alignment)
+    branch_snp_index = map_site_changes_to_branches(expanded_tree,node_states)
+
+    # from the state file and from the node states, the root is read at genome sites
+    for state_file,states in [(expanded_state,None),(None,node_states)]:
+        with contextlib.redirect_stdout(io.StringIO()):
+            possible_reversions,branch_reversions,will_be_reverted = flag_reversions(expanded_tree,branch_snp_index,state_file,refs,states)
+        assert [(int(row["site"]),row["taxon"],row["root_allele"],row["reversion_to"]) for row in possible_reversions] == [(30,"A","G","ref;Root")]